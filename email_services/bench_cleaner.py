@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmark email_api.cleaner against the original nine-pass cleaner.
+
+    python bench_cleaner.py [--repeat N]
+
+The corpus is generated deterministically: short plain-text mails, HTML newsletters
+and a few very large HTML messages. Outputs are checked to be identical before timing.
+"""
+import argparse
+import html
+import random
+import re
+import time
+
+from email_api.cleaner import clean_bodies, clean_email_body
+
+
+def legacy_clean_email_body(body):
+    clean_body = body.replace('\r\n', '\n').replace('\xa0', ' ')
+    clean_body = html.unescape(clean_body)
+    clean_body = re.sub(r'<[^>]+>', '', clean_body)
+    clean_body = re.sub(r'\u2060', '', clean_body)
+    clean_body = re.sub(r'[ \t]+$', '', clean_body, flags=re.MULTILINE)
+    clean_body = re.sub(r'\n{3,}', '\n\n', clean_body)
+    clean_body = re.sub(r'-\s*\n\s*', '- ', clean_body)
+    clean_body = re.sub(r'^\s*[-\u2022]+\s*$', '', clean_body, flags=re.MULTILINE)
+    clean_body = re.sub(r'\n\s*-\s*', '\n- ', clean_body)
+    return clean_body.strip()
+
+
+WORDS = 'the quick brown fox jumps over lazy dog invoice meeting update team project release notes'.split()
+
+
+def sentence(rng, length=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+
+def plain_mail(rng):
+    lines = [sentence(rng) for _ in range(rng.randint(5, 30))]
+    lines += ['', '--', 'Sent from my phone', '']
+    return '\r\n'.join(lines)
+
+
+def html_newsletter(rng, sections=40):
+    parts = ['<html><body><table width="100%">']
+    for _ in range(sections):
+        parts.append(
+            f'<tr><td style="padding:8px"><h2>{sentence(rng, 5)}</h2>'
+            f'<p>{sentence(rng)}&nbsp;{sentence(rng)} &amp; more&#8288;</p>'
+            f'<ul><li>&bull; {sentence(rng, 6)}</li><li>- {sentence(rng, 6)}</li></ul>'
+            '<a href="https://example.com/track?id=123">Read more</a>\xa0\xa0 \r\n\r\n\r\n</td></tr>'
+        )
+    parts.append('</table></body></html>')
+    return '\r\n'.join(parts)
+
+
+def build_corpus(seed=42):
+    rng = random.Random(seed)
+    return {
+        'plain': [plain_mail(rng) for _ in range(500)],
+        'html': [html_newsletter(rng) for _ in range(100)],
+        'very large': [html_newsletter(rng, sections=4000) for _ in range(3)],
+    }
+
+
+def timed(func, bodies, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(bodies)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = build_corpus()
+    print(f"{'corpus':<12}{'bodies':>8}{'MB':>8}{'legacy ms':>12}{'new ms':>10}{'speedup':>9}")
+    for name, bodies in corpus.items():
+        for body in bodies:
+            assert clean_email_body(body) == legacy_clean_email_body(body), name
+
+        legacy = timed(lambda b: [legacy_clean_email_body(x) for x in b], bodies, args.repeat)
+        new = timed(clean_bodies, bodies, args.repeat)
+        size = sum(len(body) for body in bodies) / 1e6
+        print(f'{name:<12}{len(bodies):>8}{size:>8.1f}{legacy * 1000:>12.1f}{new * 1000:>10.1f}{legacy / new:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,33 @@
 from django.contrib import admin
+from .models import Mailbox, Message, OutgoingEmail, SyncJob, Thread
 
-# Register your models here.
+
+@admin.register(Mailbox)
+class MailboxAdmin(admin.ModelAdmin):
+    list_display = ('user', 'history_id', 'synced_at')
+
+
+@admin.register(Thread)
+class ThreadAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'user', 'gmail_id', 'last_message_at')
+    search_fields = ('subject', 'gmail_id')
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'from_email', 'user', 'date', 'is_inbox')
+    list_filter = ('is_inbox',)
+    search_fields = ('subject', 'from_email', 'gmail_id')
+
+
+@admin.register(SyncJob)
+class SyncJobAdmin(admin.ModelAdmin):
+    list_display = ('user', 'status', 'attempts', 'run_after', 'leased_until', 'lease_owner')
+    list_filter = ('status',)
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('to', 'subject', 'user', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('to', 'subject', 'message_id', 'idempotency_key')
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import weakref
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .cleaner import clean_bodies
+from .gmail_client import IDEMPOTENT_METHODS, RETRY_STATUSES, backoff_delay, http_client, retry_after
+from .models import Message
+from .ratelimit import quota_units, rate_limiter
+from .utils import MESSAGE_BODY_PARAMS, GmailAPIError, decode_body, get_gmail_token, gmail_headers, gmail_url
+
+# httpx clients and semaphores belong to one event loop, so keep one set per loop.
+_clients = weakref.WeakKeyDictionary()
+# Per loop, a weak map of user id -> semaphore: an entry lives only while some request holds it.
+_user_limits = weakref.WeakKeyDictionary()
+
+
+def _client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        pool_size = getattr(settings, 'GMAIL_HTTP_POOL_SIZE', 20)
+        client = _clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                getattr(settings, 'GMAIL_HTTP_READ_TIMEOUT', 30),
+                connect=getattr(settings, 'GMAIL_HTTP_CONNECT_TIMEOUT', 5),
+            ),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+    return client
+
+
+def _user_limit(user):
+    """
+    Semaphore capping the user's in-flight Gmail calls at GMAIL_ASYNC_CONCURRENCY.
+    Callers must keep a reference for as long as they use it.
+    """
+    limits = _user_limits.setdefault(asyncio.get_running_loop(), weakref.WeakValueDictionary())
+    limit = limits.get(user.pk)
+    if limit is None:
+        limit = limits[user.pk] = asyncio.Semaphore(getattr(settings, 'GMAIL_ASYNC_CONCURRENCY', 10))
+    return limit
+
+
+async def arequest(method, url, metric=None, idempotent=None, quota=None, **kwargs):
+    """
+    Async counterpart of http_client.request with the same retry and rate limit policy.
+    Latency is recorded in http_client.stats().
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    name = metric or f'{method} {httpx.URL(url).path}'
+    max_retries = getattr(settings, 'GMAIL_HTTP_MAX_RETRIES', 4)
+
+    for attempt in range(max_retries + 1):
+        if quota:
+            wait = await sync_to_async(rate_limiter.reserve, thread_sensitive=False)(*quota, metric=name)
+            if wait:
+                await asyncio.sleep(wait)
+        start = time.monotonic()
+        try:
+            resp = await _client().request(method, url, **kwargs)
+        except httpx.TransportError:
+            http_client.record(name, time.monotonic() - start, None)
+            if attempt == max_retries or not idempotent:
+                raise
+            delay = backoff_delay(attempt)
+        else:
+            http_client.record(name, time.monotonic() - start, resp.status_code)
+            retryable = resp.status_code == 429 or (idempotent and resp.status_code in RETRY_STATUSES)
+            if not retryable or attempt == max_retries:
+                return resp
+            delay = retry_after(resp)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            delay = min(delay, getattr(settings, 'GMAIL_HTTP_BACKOFF_MAX', 32))
+
+        await asyncio.sleep(delay)
+
+
+async def agmail_request(user, method, path, metric=None, limit=None, **kwargs):
+    """
+    Call the Gmail API as `user`, within the user's concurrency limit (pass `limit` to reuse the
+    semaphore across a fan-out), retrying once with a refreshed token if Gmail answers 401.
+    """
+    access_token = await sync_to_async(get_gmail_token)(user)
+    if not access_token:
+        raise GmailAPIError("User not authenticated with Gmail.")
+
+    quota = (user.pk, quota_units(metric))
+    async with limit or _user_limit(user):
+        resp = await arequest(method, gmail_url(path), metric, headers=gmail_headers(access_token), quota=quota, **kwargs)
+        if resp.status_code == 401:
+            access_token = await sync_to_async(get_gmail_token)(user, rejected_token=access_token)
+            if not access_token:
+                raise GmailAPIError("User not authenticated with Gmail.")
+            resp = await arequest(method, gmail_url(path), metric, headers=gmail_headers(access_token), quota=quota, **kwargs)
+    return resp
+
+
+async def aload_bodies(user, messages):
+    """
+    Async counterpart of sync.load_bodies: fetches each missing body with its own messages.get,
+    all at once but at most GMAIL_ASYNC_CONCURRENCY in flight for the user. Messages that
+    cannot be fetched keep body_loaded=False.
+    """
+    missing = [message for message in messages if not message.body_loaded]
+    if not missing:
+        return messages
+    if not await sync_to_async(get_gmail_token)(user):
+        raise GmailAPIError("User not authenticated with Gmail.")
+
+    limit = _user_limit(user)
+
+    async def fetch(message):
+        resp = await agmail_request(
+            user, 'GET', f'/gmail/v1/users/me/messages/{message.gmail_id}', 'gmail.messages.get',
+            limit=limit, params=MESSAGE_BODY_PARAMS,
+        )
+        if resp.status_code != 200:
+            print("Gmail API Error:", message.gmail_id, resp.status_code)
+            return None
+        return resp.json()
+
+    loaded, raw = [], []
+    # One message failing (a dropped connection, an expired token) leaves just that body out.
+    for message, data in zip(missing, await asyncio.gather(*map(fetch, missing), return_exceptions=True)):
+        if isinstance(data, Exception):
+            print("Gmail API Error:", message.gmail_id, data)
+        elif data:
+            loaded.append(message)
+            raw.append(decode_body(data))
+    for message, body in zip(loaded, clean_bodies(raw)):
+        message.body = body
+        message.body_loaded = True
+    await sync_to_async(Message.objects.bulk_update)(loaded, ['body', 'body_loaded'])
+    return messages
@@ -0,0 +1,143 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from .ratelimit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+def retry_after(resp):
+    """
+    Seconds to wait according to a Retry-After header (delta-seconds or HTTP date), or None.
+    """
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter for the given zero-based retry attempt.
+    """
+    base = getattr(settings, 'GMAIL_HTTP_BACKOFF_BASE', 0.5)
+    cap = getattr(settings, 'GMAIL_HTTP_BACKOFF_MAX', 32)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HttpClient:
+    """
+    Shared keep-alive HTTP client for all Gmail and OAuth calls.
+
+    One requests.Session with a pooled adapter is shared by every thread; urllib3's pool
+    handles concurrent checkouts. Responses with a status in RETRY_STATUSES and connection
+    errors are retried with exponential backoff and full jitter, honouring Retry-After.
+    Non-idempotent requests are only retried on 429, which Gmail returns before doing any work.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    pool_size = getattr(settings, 'GMAIL_HTTP_POOL_SIZE', 20)
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def record(self, name, elapsed, status_code):
+        with self._lock:
+            stat = self._stats.setdefault(name, {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stat['count'] += 1
+            stat['total_ms'] += elapsed * 1000
+            stat['max_ms'] = max(stat['max_ms'], elapsed * 1000)
+            if status_code is None or status_code >= 400:
+                stat['errors'] += 1
+        logger.debug("%s -> %s in %.1f ms", name, status_code, elapsed * 1000)
+
+    def stats(self):
+        """
+        Per-call latency summary: {name: {'count', 'errors', 'total_ms', 'max_ms', 'avg_ms'}}.
+        """
+        with self._lock:
+            return {
+                name: dict(stat, avg_ms=stat['total_ms'] / stat['count'])
+                for name, stat in self._stats.items()
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def request(self, method, url, metric=None, idempotent=None, quota=None, **kwargs):
+        """
+        Send a request through the shared session, retrying transient failures.
+        `metric` names the call in stats() (defaults to "METHOD path"). `quota` is a
+        (user_id, units) pair charged to the user's rate limit before every attempt.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        name = metric or f'{method} {urlsplit(url).path}'
+        kwargs.setdefault('timeout', (
+            getattr(settings, 'GMAIL_HTTP_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'GMAIL_HTTP_READ_TIMEOUT', 30),
+        ))
+        max_retries = getattr(settings, 'GMAIL_HTTP_MAX_RETRIES', 4)
+
+        for attempt in range(max_retries + 1):
+            if quota:
+                rate_limiter.acquire(*quota, metric=name)
+            start = time.monotonic()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(name, time.monotonic() - start, None)
+                if attempt == max_retries or not idempotent:
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                self.record(name, time.monotonic() - start, resp.status_code)
+                retryable = resp.status_code == 429 or (idempotent and resp.status_code in RETRY_STATUSES)
+                if not retryable or attempt == max_retries:
+                    return resp
+                delay = retry_after(resp)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                delay = min(delay, getattr(settings, 'GMAIL_HTTP_BACKOFF_MAX', 32))
+
+            logger.info("Retrying %s in %.2fs (attempt %d)", name, delay, attempt + 1)
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+http_client = HttpClient()
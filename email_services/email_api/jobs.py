@@ -0,0 +1,138 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Mailbox, Message, SyncJob
+from .sync import load_bodies, recently_failed, sync_mailbox
+
+
+def _claimable(model, now):
+    # Queued items that are due, plus running ones whose worker let the lease expire.
+    return Q(status=model.QUEUED, run_after__lte=now) | Q(status=model.RUNNING, leased_until__lt=now)
+
+
+def enqueue_due_syncs():
+    """
+    Queue a job for every mailbox last synced more than GMAIL_SYNC_INTERVAL seconds ago,
+    so mail is fetched before its owner asks for it. Users whose last job failed recently
+    are skipped (see recently_failed); older failed jobs are replaced by the new ones.
+    Returns the number of jobs queued.
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'GMAIL_SYNC_INTERVAL', 60))
+    user_ids = list(
+        Mailbox.objects.filter(Q(synced_at__isnull=True) | Q(synced_at__lt=cutoff))
+        .exclude(user__sync_jobs__status__in=[SyncJob.QUEUED, SyncJob.RUNNING])
+        .exclude(user_id__in=recently_failed(now).values('user_id'))
+        .values_list('user_id', flat=True)
+    )
+    with transaction.atomic():
+        SyncJob.objects.filter(user_id__in=user_ids, status=SyncJob.FAILED).delete()
+        jobs = SyncJob.objects.bulk_create(
+            [SyncJob(user_id=user_id, run_after=now) for user_id in user_ids], ignore_conflicts=True,
+        )
+    return len(jobs)
+
+
+def claim_jobs(owner, limit, lease=None, model=SyncJob):
+    """
+    Lease up to `limit` due jobs to `owner` for `lease` seconds.
+    Each job is taken with a conditional UPDATE, so concurrent workers never claim the same one.
+    `model` is any queue model with SyncJob's status/run_after/lease fields, e.g. OutgoingEmail.
+    """
+    if limit <= 0:
+        return []
+    lease = lease or getattr(settings, 'GMAIL_SYNC_LEASE', 300)
+    now = timezone.now()
+    candidates = model.objects.filter(_claimable(model, now)).order_by('run_after').values_list('pk', flat=True)
+    claimed = []
+    for pk in candidates[:limit]:
+        updated = model.objects.filter(_claimable(model, now), pk=pk).update(
+            status=model.RUNNING,
+            lease_owner=owner,
+            leased_until=now + timedelta(seconds=lease),
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+        if updated:
+            claimed.append(pk)
+    return list(model.objects.filter(pk__in=claimed, lease_owner=owner).select_related('user').order_by('run_after'))
+
+
+def renew_leases(owner, job_ids, lease=None, model=SyncJob):
+    """
+    Extend the leases `owner` holds on still-running jobs.
+    """
+    lease = lease or getattr(settings, 'GMAIL_SYNC_LEASE', 300)
+    now = timezone.now()
+    return model.objects.filter(pk__in=list(job_ids), status=model.RUNNING, lease_owner=owner).update(
+        leased_until=now + timedelta(seconds=lease), updated_at=now,
+    )
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'GMAIL_SYNC_RETRY_BASE', 30)
+    return min(base * 2 ** max(attempts - 1, 0), getattr(settings, 'GMAIL_SYNC_RETRY_MAX', 3600))
+
+
+def leased(job):
+    """
+    The job's row, as long as the lease this worker took is still held.
+    """
+    return type(job).objects.filter(pk=job.pk, status=job.RUNNING, lease_owner=job.lease_owner)
+
+
+def requeue_or_fail(job, error, max_attempts, permanent=False):
+    """
+    Put a failed job back in the queue after retry_delay(), or mark it failed once it has
+    used `max_attempts` attempts or the error is `permanent`.
+    """
+    now = timezone.now()
+    if permanent or job.attempts >= max_attempts:
+        leased(job).update(status=job.FAILED, leased_until=None, last_error=error, updated_at=now)
+    else:
+        leased(job).update(
+            status=job.QUEUED,
+            run_after=now + timedelta(seconds=retry_delay(job.attempts)),
+            leased_until=None,
+            lease_owner='',
+            last_error=error,
+            updated_at=now,
+        )
+
+
+def prefetch_bodies(user):
+    """
+    Load bodies for the newest inbox messages so the inbox view has nothing left to fetch,
+    and for every message a view asked for in background mode.
+    """
+    limit = getattr(settings, 'GMAIL_PREFETCH_BODIES', 100)
+    missing = {}
+    if limit:
+        latest = Message.objects.filter(user=user, is_inbox=True, body_loaded=False).order_by('-internal_date')[:limit]
+        missing.update((message.pk, message) for message in latest)
+    requested = Message.objects.filter(user=user, body_requested=True)
+    missing.update((message.pk, message) for message in requested.filter(body_loaded=False))
+    load_bodies(user, list(missing.values()), background=False)
+    # Bodies Gmail would not return are asked for again on the next view.
+    requested.update(body_requested=False)
+
+
+def run_job(job):
+    """
+    Sync the job's mailbox and prefetch bodies. A finished job is deleted; a failed one is
+    requeued with exponential backoff until GMAIL_SYNC_MAX_ATTEMPTS, then left as failed.
+    Returns True on success.
+    """
+    try:
+        sync_mailbox(job.user, force_full=job.force_full)
+        prefetch_bodies(job.user)
+    except Exception as exc:
+        print("Sync Job Error:", job.user_id, exc)
+        requeue_or_fail(job, str(exc), getattr(settings, 'GMAIL_SYNC_MAX_ATTEMPTS', 5))
+        return False
+
+    leased(job).delete()
+    SyncJob.objects.filter(user=job.user, status=SyncJob.FAILED).delete()
+    return True
@@ -0,0 +1,41 @@
+from django.conf import settings
+from ...models import OutgoingEmail
+from ...outbox import deliver_batch
+from ..queue_worker import QueueWorkerCommand
+
+
+class Command(QueueWorkerCommand):
+    help = (
+        "Run the outbox worker. Delivers messages accepted by /api/send/, up to --concurrency at a "
+        "time, retrying transient failures. SIGINT/SIGTERM stop claiming work and wait for running sends."
+    )
+    model = OutgoingEmail
+    default_lease = 120
+
+    @property
+    def default_concurrency(self):
+        return getattr(settings, 'GMAIL_SEND_WORKER_CONCURRENCY', 4)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'GMAIL_BATCH_SIZE', 50)
+
+    def group(self, items):
+        """
+        One batch per user and GMAIL_BATCH_SIZE messages, so each is a single batched Gmail call.
+        """
+        by_user = {}
+        for item in items:
+            by_user.setdefault(item.user_id, []).append(item)
+        return [
+            user_items[offset:offset + self.batch_size]
+            for user_items in by_user.values()
+            for offset in range(0, len(user_items), self.batch_size)
+        ]
+
+    def process_batch(self, items):
+        for item, sent in zip(items, deliver_batch(items)):
+            if sent:
+                self.stdout.write(f"Sent outbox item {item.pk} to {item.to}.")
+            else:
+                self.stderr.write(f"Delivery of outbox item {item.pk} failed (attempt {item.attempts}).")
@@ -0,0 +1,29 @@
+from django.conf import settings
+from ...jobs import enqueue_due_syncs, run_job
+from ...models import SyncJob
+from ..queue_worker import QueueWorkerCommand
+
+
+class Command(QueueWorkerCommand):
+    help = (
+        "Run the background mailbox sync worker. Syncs stale mailboxes and queued jobs ahead of the "
+        "API, up to --concurrency at a time. SIGINT/SIGTERM stop claiming work and wait for running jobs."
+    )
+    model = SyncJob
+
+    @property
+    def default_concurrency(self):
+        return getattr(settings, 'GMAIL_SYNC_WORKER_CONCURRENCY', 4)
+
+    @property
+    def default_lease(self):
+        return getattr(settings, 'GMAIL_SYNC_LEASE', 300)
+
+    def schedule(self):
+        enqueue_due_syncs()
+
+    def process(self, job):
+        if run_job(job):
+            self.stdout.write(f"Synced mailbox of {job.user}.")
+        else:
+            self.stderr.write(f"Sync failed for {job.user} (attempt {job.attempts}).")
@@ -0,0 +1,93 @@
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from ..jobs import claim_jobs, renew_leases
+
+
+class QueueWorkerCommand(BaseCommand):
+    """
+    Base for the long-running queue workers. Claims due rows of `model` with a lease, runs up to
+    --concurrency batches of them on a thread pool via process_batch(), and keeps renewing the
+    leases while they run. SIGINT/SIGTERM stop claiming work and wait for the running items.
+    """
+    model = None
+    default_concurrency = 4
+    default_lease = 300
+    # Items claimed per free slot; group() splits them into the batches handed to process_batch().
+    batch_size = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=self.default_concurrency,
+                            help="items processed at the same time")
+        parser.add_argument('--poll-interval', type=float, default=5, help="seconds between queue polls")
+        parser.add_argument('--lease', type=int, default=self.default_lease,
+                            help="seconds a claimed item is reserved; renewed while it runs")
+        parser.add_argument('--once', action='store_true', help="run what is due now and exit")
+
+    def schedule(self):
+        """
+        Hook called before each poll (once with --once) to queue periodic work.
+        """
+
+    def group(self, items):
+        return [[item] for item in items]
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def process_batch(self, items):
+        for item in items:
+            self.process(item)
+
+    def handle(self, *args, **options):
+        concurrency = max(options['concurrency'], 1)
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            if not stop.is_set():
+                self.stdout.write("Stopping; waiting for running work to finish.")
+            stop.set()
+
+        previous = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                previous[signum] = signal.signal(signum, request_stop)
+
+        running = {}
+        scheduled = False
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                while not stop.is_set():
+                    for future in [f for f in running if f.done()]:
+                        del running[future]
+                    if not (options['once'] and scheduled):
+                        self.schedule()
+                        scheduled = True
+                    held = [pk for pks in running.values() for pk in pks]
+                    renew_leases(owner, held, options['lease'], model=self.model)
+                    free = concurrency - len(running)
+                    items = claim_jobs(owner, free * self.batch_size, options['lease'], model=self.model)
+                    for batch in self.group(items):
+                        running[pool.submit(self.run_batch, batch)] = [item.pk for item in batch]
+
+                    if options['once'] and not running:
+                        break
+                    if running:
+                        wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                    else:
+                        stop.wait(options['poll_interval'])
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def run_batch(self, items):
+        close_old_connections()
+        try:
+            self.process_batch(items)
+        finally:
+            close_old_connections()
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.3 on 2026-10-18 05:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mailbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('history_id', models.BigIntegerField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gmail_id', models.CharField(max_length=64)),
+                ('subject', models.TextField(blank=True)),
+                ('last_message_at', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='email_threads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gmail_id', models.CharField(max_length=64)),
+                ('from_email', models.TextField(blank=True)),
+                ('subject', models.TextField(blank=True)),
+                ('date', models.CharField(blank=True, max_length=255)),
+                ('internal_date', models.BigIntegerField(default=0)),
+                ('label_ids', models.JSONField(default=list)),
+                ('is_inbox', models.BooleanField(default=False)),
+                ('body', models.TextField(blank=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='email_messages', to=settings.AUTH_USER_MODEL)),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='email_api.thread')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['user', '-last_message_at'], name='email_api_t_user_id_d6dc86_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='thread',
+            constraint=models.UniqueConstraint(fields=('user', 'gmail_id'), name='unique_thread_per_user'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', 'is_inbox', '-internal_date'], name='email_api_m_user_id_134988_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('user', 'gmail_id'), name='unique_message_per_user'),
+        ),
+    ]
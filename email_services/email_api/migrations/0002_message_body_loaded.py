@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 05:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='body_loaded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
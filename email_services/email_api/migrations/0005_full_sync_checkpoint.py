@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_api', '0004_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='full_sync_history_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='full_sync_page_token',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='full_sync_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
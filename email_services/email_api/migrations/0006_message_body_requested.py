@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 07:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_api', '0005_full_sync_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='body_requested',
+            field=models.BooleanField(default=False),
+        ),
+    ]
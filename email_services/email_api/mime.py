@@ -0,0 +1,99 @@
+import base64
+import codecs
+from email.message import Message
+
+# Body parts in order of preference; the first match anywhere in the tree wins.
+BODY_PREFERENCE = ('text/plain', 'text/html')
+
+
+def _header(part, name):
+    name = name.lower()
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name), '')
+
+
+def is_attachment(part):
+    if part.get('filename') or part.get('body', {}).get('attachmentId'):
+        return True
+    return _header(part, 'Content-Disposition').lower().startswith('attachment')
+
+
+def iter_parts(payload):
+    """
+    Yield the leaf parts of a Gmail message payload depth-first, skipping attachments
+    and not descending into them.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if is_attachment(part):
+            continue
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+
+def select_body_part(payload, preference=BODY_PREFERENCE):
+    """
+    Return the leaf part whose mimeType ranks best in `preference`, or None.
+    """
+    best, best_rank = None, len(preference)
+    for part in iter_parts(payload):
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type in preference and preference.index(mime_type) < best_rank:
+            best, best_rank = part, preference.index(mime_type)
+            if best_rank == 0:
+                break
+    return best
+
+
+def part_charset(part):
+    content_type = _header(part, 'Content-Type')
+    if not content_type:
+        return 'utf-8'
+    message = Message()
+    message['Content-Type'] = content_type
+    charset = message.get_content_charset() or 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return 'utf-8'
+    return charset
+
+
+def decode_part(part, max_bytes=None):
+    """
+    Decode a part's base64url body with its declared charset; malformed data gives ''.
+    With `max_bytes`, only the base64 needed for that many bytes is decoded, and a
+    multi-byte character cut off at the limit is dropped rather than mangled.
+    """
+    data = part.get('body', {}).get('data', '')
+    if not data:
+        return ''
+
+    full_length = len(data)
+    if max_bytes is not None:
+        # Every 4 base64 characters carry 3 bytes.
+        data = data[:-(-max_bytes // 3) * 4]
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except ValueError:
+        # binascii.Error (e.g. a length of 1 mod 4) or non-ASCII data: treat the body as empty.
+        return ''
+    truncated = len(data) < full_length or (max_bytes is not None and len(raw) > max_bytes)
+    if max_bytes is not None:
+        raw = raw[:max_bytes]
+
+    decoder = codecs.getincrementaldecoder(part_charset(part))(errors='replace')
+    return decoder.decode(raw, final=not truncated)
+
+
+def extract_body(payload, max_bytes=None, preference=BODY_PREFERENCE):
+    """
+    Decoded text of the preferred body part of a Gmail message payload, or '' if there is none.
+    """
+    part = select_body_part(payload, preference)
+    if part is None:
+        return ''
+    return decode_part(part, max_bytes)
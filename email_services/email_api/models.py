@@ -1,3 +1,209 @@
+from itertools import groupby
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class Mailbox(models.Model):
+    """
+    Sync state of a user's local copy of their Gmail mailbox.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='mailbox')
+    history_id = models.BigIntegerField(null=True, blank=True)
+    synced_at = models.DateTimeField(null=True, blank=True)
+    # Checkpoint of a full sync in progress, so an interrupted one resumes at the next page.
+    full_sync_started_at = models.DateTimeField(null=True, blank=True)
+    full_sync_history_id = models.BigIntegerField(null=True, blank=True)
+    full_sync_page_token = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return f'{self.user} @ {self.history_id}'
+
+
+class SyncJob(models.Model):
+    """
+    A queued mailbox sync for the background worker (manage.py sync_worker).
+    A user has at most one queued or running job; finished jobs are deleted and a failed one
+    is kept only until the user's next job is queued.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (FAILED, 'Failed')]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sync_jobs')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    force_full = models.BooleanField(default=False)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField()
+    leased_until = models.DateTimeField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=255, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(status__in=['queued', 'running']),
+                name='one_active_sync_job_per_user',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f'{self.user} ({self.status})'
+
+
+class OutgoingEmail(models.Model):
+    """
+    A message accepted by SendEmailView and delivered by the outbox worker (manage.py send_worker).
+    `message_id` is the RFC 822 Message-ID sent with it, so a retry after an unclear outcome can
+    ask Gmail whether the message already went out instead of sending it twice.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Sending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='outbox')
+    to = models.TextField()
+    subject = models.TextField(blank=True)
+    body = models.TextField()
+    thread_id = models.CharField(max_length=64, blank=True)
+    idempotency_key = models.CharField(max_length=255)
+    message_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField()
+    leased_until = models.DateTimeField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=255, blank=True)
+    last_error = models.TextField(blank=True)
+    gmail_id = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_outgoing_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f'{self.to}: {self.subject} ({self.status})'
+
+    def matches(self, to, subject, body, thread_id=None):
+        """
+        Whether this item holds the given message, i.e. a repeated idempotency key is a true retry.
+        """
+        return (self.to, self.subject, self.body, self.thread_id) == (to, subject or '', body, thread_id or '')
+
+    def as_dict(self):
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'to': self.to,
+            'subject': self.subject,
+            'thread_id': self.thread_id or None,
+            'attempts': self.attempts,
+            'gmail_id': self.gmail_id or None,
+            'error': self.last_error or None,
+            'created_at': self.created_at,
+            'sent_at': self.sent_at,
+        }
+
+
+class Thread(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='email_threads')
+    gmail_id = models.CharField(max_length=64)
+    subject = models.TextField(blank=True)
+    last_message_at = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'gmail_id'], name='unique_thread_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at']),
+        ]
+
+    def __str__(self):
+        return self.subject
+
+    def as_dict(self, messages, include_body=True):
+        return {
+            'thread_id': self.gmail_id,
+            'subject': self.subject,
+            'messages': [message.as_dict(include_body) for message in messages],
+        }
+
+
+class Message(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='email_messages')
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='messages')
+    gmail_id = models.CharField(max_length=64)
+    from_email = models.TextField(blank=True)
+    subject = models.TextField(blank=True)
+    date = models.CharField(max_length=255, blank=True)
+    internal_date = models.BigIntegerField(default=0)
+    label_ids = models.JSONField(default=list)
+    is_inbox = models.BooleanField(default=False)
+    body = models.TextField(blank=True)
+    body_loaded = models.BooleanField(default=False)
+    # Set by a view in background mode; the sync worker's prefetch loads the body.
+    body_requested = models.BooleanField(default=False)
+    synced_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'gmail_id'], name='unique_message_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'is_inbox', '-internal_date']),
+        ]
+
+    def __str__(self):
+        return self.subject
+
+    def as_dict(self, include_body=True):
+        data = {
+            'id': self.gmail_id,
+            'thread_id': self.thread.gmail_id,
+            'from_email': self.from_email,
+            'subject': self.subject,
+            'date': self.date,
+        }
+        if include_body:
+            data['body'] = self.body
+        return data
+
+
+def group_threads(messages, include_body=True):
+    """
+    Group Message rows into the API's {thread_id: {'subject', 'messages'}} shape.
+    """
+    threads = {}
+    for message in messages:
+        thread_id = message.thread.gmail_id
+        if thread_id not in threads:
+            threads[thread_id] = {
+                'subject': message.thread.subject,
+                'messages': []
+            }
+        threads[thread_id]['messages'].append(message.as_dict(include_body))
+    return threads
+
+
+def iter_thread_groups(messages):
+    """
+    Yield (thread, [messages]) for a Message queryset ordered by thread,
+    reading rows with .iterator() so memory stays bounded.
+    """
+    rows = messages.select_related('thread').iterator(chunk_size=500)
+    for thread, thread_messages in groupby(rows, key=lambda m: m.thread):
+        yield thread, list(thread_messages)
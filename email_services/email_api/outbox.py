@@ -0,0 +1,191 @@
+import uuid
+from email.utils import make_msgid
+import requests
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .jobs import leased, requeue_or_fail
+from .models import OutgoingEmail
+from .utils import GmailAPIError, batch_send, build_send_payload, get_gmail_token, gmail_get, gmail_post
+
+# Statuses worth retrying: rate limits, expired tokens and server errors. 0 is "no answer".
+TRANSIENT_STATUSES = {0, 401, 429}
+
+
+def _new_item(user, domain, to, subject, body, thread_id, idempotency_key, now):
+    return OutgoingEmail(
+        user=user,
+        to=to,
+        subject=subject or '',
+        body=body,
+        thread_id=thread_id or '',
+        idempotency_key=idempotency_key or uuid.uuid4().hex,
+        message_id=make_msgid(domain=domain),
+        run_after=now,
+    )
+
+
+def _domain(user):
+    return user.email.rpartition('@')[2] or 'localhost'
+
+
+def enqueue_email(user, to, subject, body, thread_id=None, idempotency_key=None):
+    """
+    Put a message in the user's outbox. Returns (item, created); a repeated idempotency key
+    returns the item first stored under it.
+    """
+    item = _new_item(user, _domain(user), to, subject, body, thread_id, idempotency_key, timezone.now())
+    try:
+        with transaction.atomic():
+            item.save()
+            return item, True
+    except IntegrityError:
+        return OutgoingEmail.objects.get(user=user, idempotency_key=item.idempotency_key), False
+
+
+def enqueue_emails(user, messages):
+    """
+    Outbox many messages at once: dicts with to, subject, body and optional thread_id and
+    idempotency_key. Returns (item, created) per message, in order. Keys already in the outbox
+    return their stored item, which OutgoingEmail.matches() tells apart from a reused key with a
+    different message; everything else is inserted with one bulk INSERT.
+    """
+    now = timezone.now()
+    domain = _domain(user)
+    items = [
+        _new_item(user, domain, m['to'], m.get('subject'), m['body'], m.get('thread_id'), m.get('idempotency_key'), now)
+        for m in messages
+    ]
+    keys = [item.idempotency_key for item in items]
+    existing = {}
+    for offset in range(0, len(keys), 500):
+        existing.update(
+            (item.idempotency_key, item)
+            for item in OutgoingEmail.objects.filter(user=user, idempotency_key__in=keys[offset:offset + 500])
+        )
+
+    results, new = [], {}
+    for item in items:
+        if item.idempotency_key in existing:
+            results.append((existing[item.idempotency_key], False))
+        elif item.idempotency_key in new:
+            results.append((new[item.idempotency_key], False))
+        else:
+            new[item.idempotency_key] = item
+            results.append((item, True))
+    try:
+        with transaction.atomic():
+            OutgoingEmail.objects.bulk_create(new.values(), batch_size=500)
+    except IntegrityError:
+        # Another request stored some of these keys meanwhile; fall back to one insert each.
+        return [enqueue_email(user, m['to'], m.get('subject'), m['body'], m.get('thread_id'), key)
+                for m, key in zip(messages, keys)]
+    if any(item.pk is None for item in new.values()):
+        # Backends that do not return primary keys from bulk_create.
+        stored = {i.idempotency_key: i for i in OutgoingEmail.objects.filter(user=user, idempotency_key__in=list(new))}
+        results = [(stored.get(item.idempotency_key, item), created) for item, created in results]
+    return results
+
+
+def _find_sent(item, access_token):
+    """
+    Gmail id of a message already sent with the item's Message-ID, or None.
+    """
+    params = {'q': f'rfc822msgid:{item.message_id.strip("<>")}', 'maxResults': 1}
+    resp, _ = gmail_get(item.user, access_token, '/gmail/v1/users/me/messages', params, metric='gmail.messages.list')
+    if resp.status_code != 200:
+        print("Gmail API Error:", resp.status_code, resp.text)
+        raise GmailAPIError("Failed to check for an earlier delivery.")
+    messages = resp.json().get('messages') or []
+    return messages[0]['id'] if messages else None
+
+
+def _mark_sent(items, gmail_ids):
+    now = timezone.now()
+    for item in items:
+        if item.pk in gmail_ids:
+            leased(item).update(
+                status=OutgoingEmail.SENT, gmail_id=gmail_ids[item.pk], sent_at=now,
+                leased_until=None, last_error='', updated_at=now,
+            )
+
+
+def _settle_failure(item, status_code, max_attempts):
+    """
+    Requeue an item after a transient failure, or fail it for good after a rejection.
+    """
+    if status_code in TRANSIENT_STATUSES or status_code >= 500:
+        error = f"Gmail answered {status_code}." if status_code else "Gmail did not answer."
+        requeue_or_fail(item, error, max_attempts)
+    else:
+        requeue_or_fail(item, f"Gmail rejected the message ({status_code}).", max_attempts, permanent=True)
+
+
+def deliver(item):
+    """
+    Send one claimed outbox item. Rate limits, server errors and network failures are retried
+    with backoff; any other rejection fails the item at once. A retry first looks the Message-ID
+    up in Gmail, so a send whose response was lost is not repeated. Returns True once sent.
+    """
+    max_attempts = getattr(settings, 'GMAIL_SEND_MAX_ATTEMPTS', 8)
+    try:
+        access_token = get_gmail_token(item.user)
+        if not access_token:
+            raise GmailAPIError("User not authenticated with Gmail.")
+
+        gmail_id = _find_sent(item, access_token) if item.attempts > 1 else None
+        if gmail_id is None:
+            payload = build_send_payload(item.to, item.subject, item.body, item.thread_id, item.message_id)
+            resp, _ = gmail_post(item.user, access_token, '/gmail/v1/users/me/messages/send', payload, metric='gmail.send')
+            if resp.status_code != 200:
+                print("Send Email Error:", resp.status_code, resp.text)
+                _settle_failure(item, resp.status_code, max_attempts)
+                return False
+            gmail_id = resp.json().get('id', '')
+    except (GmailAPIError, requests.RequestException) as exc:
+        print("Send Email Error:", item.pk, exc)
+        requeue_or_fail(item, str(exc), max_attempts)
+        return False
+
+    _mark_sent([item], {item.pk: gmail_id})
+    return True
+
+
+def deliver_batch(items):
+    """
+    deliver() for many claimed items of one user: their messages.send calls go out through the
+    batch endpoint, GMAIL_BATCH_SIZE per round trip. Returns True/False per item, in order.
+    """
+    if len(items) == 1:
+        return [deliver(items[0])]
+
+    max_attempts = getattr(settings, 'GMAIL_SEND_MAX_ATTEMPTS', 8)
+    access_token = get_gmail_token(items[0].user)
+    if not access_token:
+        for item in items:
+            requeue_or_fail(item, "User not authenticated with Gmail.", max_attempts)
+        return [False] * len(items)
+
+    gmail_ids, pending = {}, []
+    for item in items:
+        if item.attempts > 1:
+            try:
+                gmail_id = _find_sent(item, access_token)
+            except (GmailAPIError, requests.RequestException) as exc:
+                requeue_or_fail(item, str(exc), max_attempts)
+                continue
+            if gmail_id:
+                gmail_ids[item.pk] = gmail_id
+                continue
+        pending.append(item)
+
+    payloads = [build_send_payload(i.to, i.subject, i.body, i.thread_id, i.message_id) for i in pending]
+    for item, (status_code, data) in zip(pending, batch_send(items[0].user, access_token, payloads)):
+        if status_code == 200:
+            gmail_ids[item.pk] = data.get('id', '')
+        else:
+            print("Send Email Error:", item.pk, status_code)
+            _settle_failure(item, status_code, max_attempts)
+
+    _mark_sent(items, gmail_ids)
+    return [item.pk in gmail_ids for item in items]
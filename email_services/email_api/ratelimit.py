@@ -0,0 +1,170 @@
+import logging
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Gmail API quota units per call, keyed by the metric names used with http_client.
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'gmail.profile': 1,
+    'gmail.history.list': 2,
+    'gmail.messages.list': 5,
+    'gmail.messages.get': 5,
+    'gmail.threads.list': 10,
+    'gmail.threads.get': 10,
+    'gmail.send': 100,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+
+def quota_units(metric, count=1):
+    """
+    Quota cost of `count` calls of the kind named by `metric` (a batch is charged per sub-request).
+    """
+    return QUOTA_UNITS.get(metric, DEFAULT_QUOTA_UNITS) * count
+
+
+def take(tokens, updated, now, units, rate, capacity):
+    """
+    Refill a bucket last seen at `updated` and reserve `units` from it.
+    The balance may go negative: callers queue behind earlier reservations instead of racing
+    for capacity. Returns (new_balance, seconds to wait before the reservation is covered).
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    tokens -= units
+    return tokens, max(0.0, -tokens / rate)
+
+
+class MemoryBucketStore:
+    """
+    Token buckets in this process only; for a single worker process or tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def reserve(self, key, units, rate, capacity):
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (None, now))
+            tokens, wait = take(tokens, updated, now, units, rate, capacity)
+            self._buckets[key] = (tokens, now)
+        return wait
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a SQLite file (GMAIL_RATE_LIMIT_PATH), so every process on the host draws
+    from the same per-user budget. Each reservation is one short IMMEDIATE transaction.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or getattr(settings, 'GMAIL_RATE_LIMIT_PATH', 'ratelimit.sqlite3'))
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+        return conn
+
+    def reserve(self, key, units, rate, capacity):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = take(row[0] if row else None, row[1] if row else now, now, units, rate, capacity)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class RateLimiter:
+    """
+    Per-user token bucket in Gmail quota units: GMAIL_RATE_LIMIT units per second with bursts of
+    up to GMAIL_RATE_LIMIT_BURST. Callers over budget are delayed until their units are covered
+    rather than sent on to collect a 429. The bucket store is GMAIL_RATE_LIMIT_STORAGE, a dotted
+    path to a class with reserve(key, units, rate, capacity) -> seconds to wait.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._store = None
+        self._store_config = None
+        self._stats = {}
+
+    def store(self):
+        config = (
+            getattr(settings, 'GMAIL_RATE_LIMIT_STORAGE', 'email_api.ratelimit.MemoryBucketStore'),
+            getattr(settings, 'GMAIL_RATE_LIMIT_PATH', None),
+        )
+        with self._lock:
+            if self._store is None or self._store_config != config:
+                self._store = import_string(config[0])()
+                self._store_config = config
+            return self._store
+
+    def reserve(self, user_id, units, metric=None):
+        """
+        Reserve `units` of the user's quota and return how long to wait before using them.
+        The wait is recorded in stats() under `metric`.
+        """
+        rate = getattr(settings, 'GMAIL_RATE_LIMIT', None)
+        if not rate or user_id is None:
+            return 0.0
+        capacity = getattr(settings, 'GMAIL_RATE_LIMIT_BURST', None) or rate
+        wait = self.store().reserve(f'gmail:{user_id}', units, rate, capacity)
+        self.record(metric or 'gmail', wait)
+        if wait:
+            logger.info("Waiting %.2fs for %d Gmail quota units (user %s, %s)", wait, units, user_id, metric)
+        return wait
+
+    def acquire(self, user_id, units, metric=None):
+        """
+        reserve() and sleep until the units are available. Returns the seconds waited.
+        """
+        wait = self.reserve(user_id, units, metric)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def record(self, name, wait):
+        with self._lock:
+            stat = self._stats.setdefault(name, {'count': 0, 'delayed': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0})
+            stat['count'] += 1
+            stat['delayed'] += bool(wait)
+            stat['total_wait_ms'] += wait * 1000
+            stat['max_wait_ms'] = max(stat['max_wait_ms'], wait * 1000)
+
+    def stats(self):
+        """
+        Queueing delay per call: {name: {'count', 'delayed', 'total_wait_ms', 'max_wait_ms', 'avg_wait_ms'}}.
+        """
+        with self._lock:
+            return {
+                name: dict(stat, avg_wait_ms=stat['total_wait_ms'] / stat['count'])
+                for name, stat in self._stats.items()
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+
+rate_limiter = RateLimiter()
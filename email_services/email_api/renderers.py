@@ -0,0 +1,21 @@
+import json
+from rest_framework.renderers import BaseRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline-delimited JSON. Streaming views write their own lines; this renders
+    ordinary responses (e.g. errors) as a single line.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return ndjson_line(data)
+
+
+def ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
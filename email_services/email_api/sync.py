@@ -0,0 +1,312 @@
+from datetime import timedelta
+import requests
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .cleaner import clean_bodies
+from .models import Mailbox, Message, SyncJob, Thread
+from .utils import (
+    MESSAGE_BODY_PARAMS, MESSAGE_METADATA_PARAMS, THREAD_METADATA_PARAMS, GmailAPIError,
+    batch_get_messages, decode_body, get_gmail_token, gmail_get, gmail_headers, iter_thread_pages,
+    parse_message,
+)
+
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+
+class SyncPending(Exception):
+    """
+    Raised in background mode when the mailbox has never been synced and a job has been queued.
+    """
+
+
+def _store_messages(user, messages):
+    """
+    Insert or update one page of metadata-format Gmail messages and their threads.
+    Bodies are left alone; load_bodies fills them in on demand.
+    """
+    now = timezone.now()
+    rows = []
+    for msg_data in messages:
+        parsed = parse_message(msg_data)
+        parsed['internal_date'] = int(msg_data.get('internalDate') or 0)
+        parsed['label_ids'] = msg_data.get('labelIds', [])
+        rows.append(parsed)
+    if not rows:
+        return
+
+    threads = {
+        t.gmail_id: t
+        for t in Thread.objects.filter(user=user, gmail_id__in={row['thread_id'] for row in rows})
+    }
+    changed = set()
+    for row in sorted(rows, key=lambda r: r['internal_date']):
+        thread = threads.get(row['thread_id'])
+        if thread is None:
+            thread = threads[row['thread_id']] = Thread(
+                user=user, gmail_id=row['thread_id'], subject=row['subject'], last_message_at=row['internal_date'],
+            )
+            changed.add(row['thread_id'])
+        elif row['internal_date'] > thread.last_message_at:
+            thread.last_message_at = row['internal_date']
+            changed.add(row['thread_id'])
+
+    Thread.objects.bulk_create([threads[t] for t in changed if threads[t].pk is None])
+    Thread.objects.bulk_update([threads[t] for t in changed if threads[t].pk is not None], ['last_message_at'])
+    # bulk_create does not return primary keys for every backend, so look new threads up again.
+    threads = {
+        t.gmail_id: t
+        for t in Thread.objects.filter(user=user, gmail_id__in=threads.keys())
+    }
+
+    Message.objects.bulk_create(
+        [
+            Message(
+                user=user,
+                thread=threads[row['thread_id']],
+                gmail_id=row['id'],
+                from_email=row['from_email'],
+                subject=row['subject'],
+                date=row['date'],
+                internal_date=row['internal_date'],
+                label_ids=row['label_ids'],
+                is_inbox='INBOX' in row['label_ids'],
+                synced_at=now,
+            )
+            for row in rows
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'gmail_id'],
+        update_fields=['thread', 'from_email', 'subject', 'date', 'internal_date', 'label_ids', 'is_inbox', 'synced_at'],
+    )
+
+
+def _delete_messages(user, msg_ids):
+    msg_ids = list(msg_ids)
+    for offset in range(0, len(msg_ids), 500):
+        Message.objects.filter(user=user, gmail_id__in=msg_ids[offset:offset + 500]).delete()
+    Thread.objects.filter(user=user, messages__isnull=True).delete()
+
+
+def _full_sync(user, mailbox):
+    """
+    List every thread matching GMAIL_SYNC_QUERY into the local store, one page per transaction.
+    The next page token is checkpointed on the mailbox with each page, so a sync cut short by a
+    request timeout or a worker restart resumes where it stopped instead of starting over.
+    Checkpoints older than GMAIL_FULL_SYNC_RESUME_WINDOW seconds are discarded. A thread Gmail
+    keeps failing on aborts the sync, since unstamped messages are deleted at the end.
+    """
+    window = timedelta(seconds=getattr(settings, 'GMAIL_FULL_SYNC_RESUME_WINDOW', 24 * 3600))
+    started_at = mailbox.full_sync_started_at
+    if started_at is None or timezone.now() - started_at > window:
+        access_token = get_gmail_token(user)
+        if not access_token:
+            raise GmailAPIError("User not authenticated with Gmail.")
+
+        # Record the history id before listing, so changes made while we page through are replayed next sync.
+        resp, access_token = gmail_get(user, access_token, '/gmail/v1/users/me/profile', metric='gmail.profile')
+        if resp.status_code != 200:
+            print("Gmail API Error:", resp.status_code, resp.text)
+            raise GmailAPIError("Failed to sync mailbox.")
+        mailbox.full_sync_history_id = int(resp.json()['historyId'])
+        mailbox.full_sync_started_at = started_at = timezone.now()
+        mailbox.full_sync_page_token = ''
+        mailbox.save(update_fields=['full_sync_history_id', 'full_sync_started_at', 'full_sync_page_token'])
+
+    query = getattr(settings, 'GMAIL_SYNC_QUERY', None)
+    pages = iter_thread_pages(
+        user, query, error_message="Failed to sync mailbox.", params=THREAD_METADATA_PARAMS,
+        page_token=mailbox.full_sync_page_token or None,
+    )
+    for threads, next_page_token in pages:
+        with transaction.atomic():
+            _store_messages(user, [msg_data for thread in threads for msg_data in thread['messages']])
+            mailbox.full_sync_page_token = next_page_token or ''
+            mailbox.save(update_fields=['full_sync_page_token'])
+
+    # Every message still listed was stored (and stamped) after the sync started.
+    stale = Message.objects.filter(user=user).filter(Q(synced_at__isnull=True) | Q(synced_at__lt=started_at))
+    with transaction.atomic():
+        _delete_messages(user, stale.values_list('gmail_id', flat=True))
+        mailbox.history_id = mailbox.full_sync_history_id
+        mailbox.synced_at = timezone.now()
+        mailbox.full_sync_started_at = None
+        mailbox.full_sync_history_id = None
+        mailbox.full_sync_page_token = ''
+        mailbox.save()
+
+
+def _incremental_sync(user, mailbox):
+    """
+    Apply users.history.list deltas since mailbox.history_id.
+    Returns False if Gmail no longer has that history id and a full sync is needed.
+    """
+    access_token = get_gmail_token(user)
+    if not access_token:
+        raise GmailAPIError("User not authenticated with Gmail.")
+
+    params = {'startHistoryId': mailbox.history_id, 'historyTypes': HISTORY_TYPES}
+    history_id = mailbox.history_id
+    added, deleted, relabelled = set(), set(), {}
+
+    while True:
+        resp, access_token = gmail_get(user, access_token, '/gmail/v1/users/me/history', params, metric='gmail.history.list')
+        if resp.status_code == 404:
+            return False
+        if resp.status_code != 200:
+            print("Gmail API Error:", resp.status_code, resp.text)
+            raise GmailAPIError("Failed to sync mailbox.")
+
+        data = resp.json()
+        for record in data.get('history', []):
+            for item in record.get('messagesAdded', []):
+                added.add(item['message']['id'])
+                deleted.discard(item['message']['id'])
+            for item in record.get('messagesDeleted', []):
+                deleted.add(item['message']['id'])
+                added.discard(item['message']['id'])
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                relabelled[item['message']['id']] = item['message'].get('labelIds', [])
+
+        history_id = int(data.get('historyId', history_id))
+        if not data.get('nextPageToken'):
+            break
+        params['pageToken'] = data['nextPageToken']
+
+    fetched, failed = batch_get_messages(gmail_headers(access_token), sorted(added), MESSAGE_METADATA_PARAMS, user)
+    if failed:
+        # Keep the old history id so the next sync picks these messages up again.
+        raise GmailAPIError("Failed to sync mailbox.")
+    with transaction.atomic():
+        _store_messages(user, fetched.values())
+        _delete_messages(user, deleted)
+        for msg_id, label_ids in relabelled.items():
+            if msg_id not in added:
+                Message.objects.filter(user=user, gmail_id=msg_id).update(
+                    label_ids=label_ids, is_inbox='INBOX' in label_ids,
+                )
+        mailbox.history_id = history_id
+        mailbox.synced_at = timezone.now()
+        mailbox.save()
+    return True
+
+
+def load_bodies(user, messages, background=None):
+    """
+    Fetch and store bodies for the Message rows that so far only have metadata.
+    Rows are updated in place; messages Gmail no longer has keep an empty body.
+
+    With GMAIL_BACKGROUND_SYNC (or `background`) nothing is fetched: the missing bodies are
+    flagged and a sync job is queued, whose prefetch loads them. The rows stay without a body
+    until then.
+    """
+    missing = [message for message in messages if not message.body_loaded]
+    if not missing:
+        return messages
+
+    if background is None:
+        background = getattr(settings, 'GMAIL_BACKGROUND_SYNC', False)
+    if background:
+        Message.objects.filter(pk__in=[message.pk for message in missing]).update(body_requested=True)
+        enqueue_sync(user)
+        return messages
+
+    access_token = get_gmail_token(user)
+    if not access_token:
+        raise GmailAPIError("User not authenticated with Gmail.")
+
+    try:
+        fetched, _ = batch_get_messages(
+            gmail_headers(access_token), [m.gmail_id for m in missing], MESSAGE_BODY_PARAMS, user,
+        )
+    except requests.RequestException as exc:
+        print("Gmail API Error:", exc)
+        raise GmailAPIError("Gmail could not be reached.") from exc
+    loaded = [message for message in missing if message.gmail_id in fetched]
+    bodies = clean_bodies([decode_body(fetched[message.gmail_id]) for message in loaded])
+    for message, body in zip(loaded, bodies):
+        message.body = body
+        message.body_loaded = True
+    Message.objects.bulk_update(loaded, ['body', 'body_loaded'])
+    return messages
+
+
+def sync_mailbox(user, force_full=False):
+    """
+    Bring the user's local Message/Thread tables up to date with Gmail.
+    Uses the history API when a history id is stored and falls back to a full resync
+    only when there is none or Gmail reports it as expired.
+    """
+    mailbox, _ = Mailbox.objects.get_or_create(user=user)
+    if mailbox.history_id and not force_full and _incremental_sync(user, mailbox):
+        return mailbox
+    _full_sync(user, mailbox)
+    return mailbox
+
+
+def recently_failed(now):
+    """
+    Jobs that failed for good within the last GMAIL_SYNC_RETRY_MAX seconds. Their users are not
+    queued again until then, so a mailbox that keeps failing is retried at the backoff cap
+    rather than on every poll.
+    """
+    cutoff = now - timedelta(seconds=getattr(settings, 'GMAIL_SYNC_RETRY_MAX', 3600))
+    return SyncJob.objects.filter(status=SyncJob.FAILED, updated_at__gte=cutoff)
+
+
+def enqueue_sync(user, force_full=False):
+    """
+    Queue a sync job for the background worker unless one is already queued or running, or
+    (without force_full) the user's last job failed recently. Returns the user's active or
+    failed job. A new job replaces the user's failed ones.
+    """
+    now = timezone.now()
+    if not force_full:
+        failed = recently_failed(now).filter(user=user).first()
+        if failed:
+            return failed
+    try:
+        with transaction.atomic():
+            SyncJob.objects.filter(user=user, status=SyncJob.FAILED).delete()
+            return SyncJob.objects.create(user=user, force_full=force_full, run_after=now)
+    except IntegrityError:
+        job = SyncJob.objects.filter(user=user, status__in=[SyncJob.QUEUED, SyncJob.RUNNING]).first()
+        if job and force_full and not job.force_full:
+            SyncJob.objects.filter(pk=job.pk).update(force_full=True)
+        return job
+
+
+def ensure_synced(user, background=None):
+    """
+    Sync the mailbox unless it was synced within the last GMAIL_SYNC_INTERVAL seconds.
+    Raises GmailAPIError only if the sync fails (Gmail errors or an unreachable Gmail) and
+    there is no local copy to fall back to.
+
+    With GMAIL_BACKGROUND_SYNC (or `background`) the sync is queued for manage.py sync_worker
+    instead and the local copy is served as it is; SyncPending is raised if there is no local copy yet.
+    """
+    mailbox = Mailbox.objects.filter(user=user).first()
+    interval = timedelta(seconds=getattr(settings, 'GMAIL_SYNC_INTERVAL', 60))
+    if mailbox and mailbox.synced_at and timezone.now() - mailbox.synced_at < interval:
+        return mailbox
+
+    if background is None:
+        background = getattr(settings, 'GMAIL_BACKGROUND_SYNC', False)
+    if background:
+        enqueue_sync(user)
+        if mailbox and mailbox.synced_at:
+            return mailbox
+        raise SyncPending("Mailbox sync queued.")
+
+    try:
+        return sync_mailbox(user)
+    except GmailAPIError:
+        if mailbox and mailbox.synced_at:
+            return mailbox
+        raise
+    except requests.RequestException as exc:
+        print("Gmail API Error:", exc)
+        if mailbox and mailbox.synced_at:
+            return mailbox
+        raise GmailAPIError("Gmail could not be reached.") from exc
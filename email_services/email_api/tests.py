@@ -1,3 +1,1198 @@
-from django.test import TestCase
+import base64
+import html
+import io
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from email import message_from_bytes
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from social_django.models import UserSocialAuth
+
+from . import async_client, sync, utils
+from .cleaner import clean_bodies, clean_email_body
+from .jobs import claim_jobs, enqueue_due_syncs, run_job
+from .mime import extract_body
+from .outbox import deliver, deliver_batch
+from .ratelimit import SQLiteBucketStore, rate_limiter, take
+from .gmail_client import http_client
+from .models import Mailbox, Message, OutgoingEmail, SyncJob, Thread
+from .sync import enqueue_sync
+from .tokens import token_manager
+
+
+# Only RateLimiterTests exercise the quota limiter; everything else runs unthrottled.
+_rate_limit_off = override_settings(GMAIL_RATE_LIMIT=None)
+
+
+def setUpModule():
+    _rate_limit_off.enable()
+
+
+def tearDownModule():
+    _rate_limit_off.disable()
+
+
+def make_message(msg_id, thread_id, subject, body, date='Mon, 1 Jan 2024 10:00:00 +0000', sender='alice@example.com',
+                 internal_date=None, label_ids=('INBOX',)):
+    return {
+        'id': msg_id,
+        'threadId': thread_id,
+        'internalDate': str(internal_date if internal_date is not None else int(msg_id.strip('m') or 0)),
+        'labelIds': list(label_ids),
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [
+                {'name': 'Subject', 'value': subject},
+                {'name': 'From', 'value': sender},
+                {'name': 'Date', 'value': date},
+            ],
+            'body': {'data': base64.urlsafe_b64encode(body.encode()).decode()},
+        },
+    }
+
+
+class FakeGmail:
+    """
+    Minimal local stand-in for the Gmail REST API. Every HTTP request it receives is recorded in `requests`.
+    """
+
+    def __init__(self, messages=()):
+        self.messages = {m['id']: m for m in messages}
+        self.requests = []
+        self.batch_failures = set()
+        self.failures = set()
+        self.token_delay = 0
+        self.tokens_issued = 0
+        self.history_id = 100
+        self.history = []
+        self.history_floor = 0
+        self.connections = 0
+        self.fail_with = []
+        self.delay = 0
+        self.in_flight = 0
+        self.sent = []
+        self.send_failures = []
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def do_GET(self):
+                fake.requests.append(('GET', self.path))
+                if not fake.scripted_failure(self):
+                    fake.handle_get(self)
+
+            def do_POST(self):
+                fake.requests.append(('POST', self.path))
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if not fake.scripted_failure(self):
+                    fake.handle_post(self, body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method, path):
+        """
+        Return (status, json) for a single Gmail REST call.
+        """
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if method == 'GET' and url.path == '/gmail/v1/users/me/messages' and 'q' in query:
+            msgid = query['q'][0].removeprefix('rfc822msgid:')
+            return 200, {'messages': [{'id': m['id']} for m in self.sent if m['message_id'].strip('<>') == msgid]}
+        if method == 'GET' and url.path in ('/gmail/v1/users/me/messages', '/gmail/v1/users/me/threads'):
+            collection = url.path.rsplit('/', 1)[-1]
+            ids = list(self.messages) if collection == 'messages' else list(self.threads())
+            start = int(query.get('pageToken', ['0'])[0])
+            end = start + int(query.get('maxResults', ['100'])[0])
+            page = {collection: [{'id': item_id} for item_id in ids[start:end]]}
+            if end < len(ids):
+                page['nextPageToken'] = str(end)
+            return 200, page
+        metadata = query.get('format') == ['metadata']
+        if url.path.rsplit('/', 1)[-1] in self.failures:
+            return 500, {'error': {'code': 500}}
+        match = re.fullmatch(r'/gmail/v1/users/me/threads/([^/]+)', url.path)
+        if method == 'GET' and match:
+            messages = self.threads().get(match.group(1))
+            if not messages:
+                return 404, {'error': {'code': 404}}
+            return 200, {'id': match.group(1), 'messages': [self.render(m, metadata) for m in messages]}
+        if method == 'GET' and url.path == '/gmail/v1/users/me/profile':
+            return 200, {'historyId': str(self.history_id)}
+        if method == 'GET' and url.path == '/gmail/v1/users/me/history':
+            start = int(query['startHistoryId'][0])
+            if start < self.history_floor:
+                return 404, {'error': {'code': 404}}
+            return 200, {'history': [h for h in self.history if int(h['id']) > start], 'historyId': str(self.history_id)}
+        match = re.fullmatch(r'/gmail/v1/users/me/messages/([^/]+)', url.path)
+        if method == 'GET' and match:
+            message = self.messages.get(match.group(1))
+            return (200, self.render(message, metadata)) if message else (404, {'error': {'code': 404}})
+        return 404, {'error': {'code': 404}}
+
+    def render(self, message, metadata):
+        if not metadata:
+            return message
+        return dict(message, payload={'headers': message['payload']['headers']})
+
+    def threads(self):
+        threads = {}
+        for message in self.messages.values():
+            threads.setdefault(message['threadId'], []).append(message)
+        return threads
+
+    def add(self, message):
+        self.messages[message['id']] = message
+        self.history_id += 1
+        self.history.append({'id': str(self.history_id), 'messagesAdded': [{'message': {'id': message['id']}}]})
+
+    def delete(self, msg_id):
+        del self.messages[msg_id]
+        self.history_id += 1
+        self.history.append({'id': str(self.history_id), 'messagesDeleted': [{'message': {'id': msg_id}}]})
+
+    def store_sent(self, data):
+        mime = message_from_bytes(base64.urlsafe_b64decode(data['raw']))
+        sent = {
+            'id': f's{len(self.sent) + 1}', 'threadId': data.get('threadId'), 'to': mime['To'],
+            'subject': mime['Subject'], 'message_id': mime['Message-ID'], 'body': mime.get_payload(decode=True).decode(),
+        }
+        self.sent.append(sent)
+        return {'id': sent['id'], 'threadId': sent['threadId'] or sent['id']}
+
+    def scripted_failure(self, handler):
+        """
+        Answer with the next (status, headers) queued in `fail_with`, if any.
+        """
+        if not self.fail_with:
+            return False
+        status, headers = self.fail_with.pop(0)
+        self.send_json(handler, status, {'error': {'code': status}}, headers)
+        return True
+
+    def send_json(self, handler, status, data, headers=None):
+        body = json.dumps(data).encode()
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle_get(self, handler):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        self.send_json(handler, *self.route('GET', handler.path))
+
+    def handle_post(self, handler, body):
+        if handler.path == '/token':
+            time.sleep(self.token_delay)
+            self.tokens_issued += 1
+            self.send_json(handler, 200, {'access_token': f'token-{self.tokens_issued}', 'expires_in': 3600})
+            return
+        if handler.path == '/gmail/v1/users/me/messages/send':
+            self.send_json(handler, 200, self.store_sent(json.loads(body)))
+            return
+        if handler.path != '/batch/gmail/v1':
+            self.send_json(handler, 404, {})
+            return
+
+        boundary = re.search(r'boundary=(\S+)', handler.headers['Content-Type']).group(1)
+        out = []
+        for part in body.decode().split(f'--{boundary}')[1:-1]:
+            content_id = re.search(r'Content-ID: <([^>]+)>', part).group(1)
+            method, path = re.search(r'^(GET|POST) (\S+)', part, re.MULTILINE).groups()
+            item_id = urlsplit(path).path.rsplit('/', 1)[-1]
+            if item_id in self.batch_failures:
+                status, data = 500, {'error': {'code': 500}}
+            elif method == 'POST' and path == '/gmail/v1/users/me/messages/send':
+                status = self.send_failures.pop(0) if self.send_failures else 200
+                data = self.store_sent(json.loads(part.split('\r\n\r\n', 2)[2])) if status == 200 else {}
+            else:
+                status, data = self.route(method, path)
+            payload = json.dumps(data)
+            out.append(
+                f'--reply\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n\r\n{payload}\r\n'
+            )
+        data = (''.join(out) + '--reply--\r\n').encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'multipart/mixed; boundary=reply')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+class GmailUserMixin:
+    """
+    Logs in a fresh user "alice" whose Gmail access token is always "token".
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('alice', 'alice@example.com')
+        self.client.force_login(self.user)
+        patcher = mock.patch.object(token_manager, 'get_token', return_value='token')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def fetch_threads(user, query=None):
+    return {thread['id']: thread for threads, _ in utils.iter_thread_pages(user, query) for thread in threads}
+
+
+class BatchFetchTests(GmailUserMixin, TestCase):
+    def test_inbox_uses_two_round_trips(self):
+        messages = [make_message(f'm{i}', f't{i % 5}', f'Subject {i % 5}', f'body {i}') for i in range(40)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            threads = fetch_threads(self.user, 'in:inbox')
+
+        self.assertEqual(len(fake.requests), 2)
+        self.assertEqual(fake.requests[1], ('POST', '/batch/gmail/v1'))
+        self.assertEqual(len(threads), 5)
+        self.assertEqual(sum(len(t['messages']) for t in threads.values()), 40)
+        self.assertEqual(utils.decode_body(threads['t1']['messages'][0]), 'body 1')
+
+    def test_failed_batch_items_are_retried_individually(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', f'body {i}') for i in range(3)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            fake.batch_failures = {'t1'}
+            threads = fetch_threads(self.user, 'from:alice@example.com')
+
+        self.assertIn(('GET', '/gmail/v1/users/me/threads/t1'), fake.requests)
+        self.assertEqual(list(threads), ['t0', 't1', 't2'])
+
+    def test_thread_messages_are_ordered_by_internal_date(self):
+        messages = [
+            make_message('m1', 't0', 'Hello', 'second', date='Tue, 2 Jan 2024 10:00:00 +0000', internal_date=200),
+            make_message('m2', 't0', 'Re: Hello', 'first', date='Wed, 3 Jan 2024 10:00:00 +0000', internal_date=100),
+        ]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            threads = fetch_threads(self.user, 'in:inbox')
+
+        self.assertEqual([m['id'] for m in threads['t0']['messages']], ['m2', 'm1'])
+        self.assertEqual(len(fake.requests), 2)
+
+    @override_settings(GMAIL_BATCH_SIZE=10)
+    def test_batches_are_split_by_size(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', 'x') for i in range(25)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            fetch_threads(self.user, 'in:inbox')
+
+        self.assertEqual([r for r in fake.requests if r[0] == 'POST'], [('POST', '/batch/gmail/v1')] * 3)
+
+
+@override_settings(GMAIL_HTTP_BACKOFF_BASE=0.01)
+class HttpClientTests(TestCase):
+    def test_connections_are_reused(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'x')]) as fake:
+            for _ in range(10):
+                self.assertEqual(http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1').status_code, 200)
+
+        self.assertEqual(fake.connections, 1)
+
+    def test_transient_errors_are_retried(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'x')]) as fake:
+            fake.fail_with = [(503, {}), (500, {})]
+            resp = http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(fake.requests), 3)
+
+    def test_retry_after_is_honoured(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'x')]) as fake, \
+                mock.patch('email_api.gmail_client.time.sleep') as sleep:
+            fake.fail_with = [(429, {'Retry-After': '7'})]
+            resp = http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1')
+
+        self.assertEqual(resp.status_code, 200)
+        sleep.assert_called_once_with(7.0)
+
+    @override_settings(GMAIL_HTTP_MAX_RETRIES=2)
+    def test_gives_up_after_max_retries(self):
+        with FakeGmail() as fake:
+            fake.fail_with = [(503, {})] * 5
+            resp = http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1')
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(len(fake.requests), 3)
+
+    def test_non_idempotent_requests_only_retry_429(self):
+        with FakeGmail() as fake:
+            fake.fail_with = [(503, {})]
+            resp = http_client.post(f'{fake.url}/gmail/v1/users/me/messages/send', json={})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(len(fake.requests), 1)
+
+    def test_latency_is_recorded_per_call(self):
+        http_client.reset_stats()
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'x')]) as fake:
+            http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1', metric='gmail.messages.get')
+            http_client.get(f'{fake.url}/gmail/v1/users/me/messages/m1', metric='gmail.messages.get')
+
+        stats = http_client.stats()['gmail.messages.get']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assertGreater(stats['max_ms'], 0)
+
+
+class StreamingInboxTests(GmailUserMixin, TestCase):
+    @override_settings(GMAIL_PAGE_SIZE=10)
+    def test_thread_pages_follow_page_tokens(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', 'x') for i in range(25)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            pages = [threads for threads, _ in utils.iter_thread_pages(self.user, 'in:inbox')]
+
+        self.assertEqual([len(threads) for threads in pages], [10, 10, 5])
+        self.assertEqual(len([r for r in fake.requests if r[0] == 'GET']), 3)
+
+    @override_settings(GMAIL_PAGE_SIZE=10)
+    def test_inbox_streams_ndjson(self):
+        messages = [make_message(f'm{i}', f't{i % 12}', f'Subject {i % 12}', 'x') for i in range(12)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            response = self.client.get('/api/inbox/', HTTP_ACCEPT='application/x-ndjson')
+            lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(lines), 12)
+        self.assertEqual(json.loads(lines[0])['thread_id'], 't11')
+
+    def test_inbox_reports_upstream_errors(self):
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=f'{fake.url}/missing'):
+            response = self.client.get('/api/inbox/?format=ndjson')
+
+        self.assertEqual(response.status_code, 400)
+
+
+class MailboxSyncTests(GmailUserMixin, TestCase):
+    def test_repeat_inbox_loads_are_served_locally(self):
+        messages = [make_message(f'm{i}', 't0', 'Hello', f'body {i}') for i in range(5)]
+        messages.append(make_message('m9', 't1', 'Archived', 'old', label_ids=()))
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            first = self.client.get('/api/inbox/').json()
+            calls = len(fake.requests)
+            second = self.client.get('/api/inbox/').json()
+
+        self.assertEqual(len(fake.requests), calls)
+        self.assertEqual(first, second)
+        self.assertEqual(list(first), ['t0'])
+        self.assertEqual([m['id'] for m in first['t0']['messages']], ['m0', 'm1', 'm2', 'm3', 'm4'])
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 6)
+
+    @override_settings(GMAIL_SYNC_INTERVAL=0)
+    def test_incremental_sync_applies_history(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a'), make_message('m2', 't0', 'Hello', 'b')]) as fake, \
+                override_settings(GMAIL_API_URL=fake.url):
+            self.client.get('/api/inbox/')
+            fake.add(make_message('m3', 't1', 'New', 'c'))
+            fake.delete('m1')
+            fake.requests.clear()
+            inbox = self.client.get('/api/inbox/').json()
+
+        self.assertEqual(
+            [r[1].split('?')[0] for r in fake.requests],
+            ['/gmail/v1/users/me/history', '/batch/gmail/v1', '/batch/gmail/v1'],
+        )
+        self.assertEqual([m['id'] for m in inbox['t0']['messages']], ['m2'])
+        self.assertEqual(inbox['t1']['subject'], 'New')
+        self.assertEqual(Mailbox.objects.get(user=self.user).history_id, fake.history_id)
+
+    @override_settings(GMAIL_SYNC_INTERVAL=0)
+    def test_expired_history_triggers_full_resync(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            self.client.get('/api/inbox/')
+            fake.messages = {'m2': make_message('m2', 't2', 'Fresh', 'b')}
+            fake.history_floor = fake.history_id + 1
+            fake.history_id += 5
+            inbox = self.client.get('/api/inbox/').json()
+
+        self.assertEqual(list(inbox), ['t2'])
+        self.assertFalse(Thread.objects.filter(user=self.user, gmail_id='t0').exists())
+
+    @override_settings(GMAIL_PAGE_SIZE=10)
+    def test_interrupted_full_sync_resumes_from_checkpoint(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', 'x') for i in range(25)]
+        store = sync._store_messages
+        calls = []
+
+        def store_or_time_out(user, page):
+            calls.append(len(page))
+            if len(calls) == 2:
+                raise utils.GmailAPIError("Request timed out.")
+            store(user, page)
+
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            with mock.patch('email_api.sync._store_messages', side_effect=store_or_time_out):
+                with self.assertRaises(utils.GmailAPIError):
+                    sync.sync_mailbox(self.user)
+            mailbox = Mailbox.objects.get(user=self.user)
+            self.assertEqual(mailbox.full_sync_page_token, '10')
+            self.assertIsNone(mailbox.history_id)
+
+            fake.requests.clear()
+            sync.sync_mailbox(self.user)
+
+        lists = [r[1] for r in fake.requests if r[1].startswith('/gmail/v1/users/me/threads?')]
+        self.assertNotIn(('GET', '/gmail/v1/users/me/profile'), fake.requests)
+        self.assertIn('pageToken=10', lists[0])
+        self.assertEqual(len(lists), 2)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 25)
+        mailbox.refresh_from_db()
+        self.assertEqual(mailbox.history_id, fake.history_id)
+        self.assertIsNone(mailbox.full_sync_started_at)
+        self.assertEqual(mailbox.full_sync_page_token, '')
+
+    @override_settings(GMAIL_HTTP_MAX_RETRIES=0)
+    def test_failing_thread_aborts_the_full_sync(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', 'x') for i in range(3)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            sync.sync_mailbox(self.user)
+            fake.failures = {'t1'}
+            with self.assertRaises(utils.GmailAPIError):
+                sync.sync_mailbox(self.user, force_full=True)
+
+            mailbox = Mailbox.objects.get(user=self.user)
+            self.assertIsNotNone(mailbox.full_sync_started_at)
+            self.assertEqual(sorted(Message.objects.values_list('gmail_id', flat=True)), ['m0', 'm1', 'm2'])
+
+            fake.failures = set()
+            sync.sync_mailbox(self.user, force_full=True)
+
+        self.assertEqual(Message.objects.count(), 3)
+
+    @override_settings(GMAIL_HTTP_MAX_RETRIES=0)
+    def test_failing_new_message_keeps_the_history_id(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            mailbox = sync.sync_mailbox(self.user)
+            history_id = mailbox.history_id
+            fake.add(make_message('m2', 't0', 'Hello', 'b'))
+            fake.failures = {'m2'}
+            with self.assertRaises(utils.GmailAPIError):
+                sync.sync_mailbox(self.user)
+            mailbox.refresh_from_db()
+            self.assertEqual(mailbox.history_id, history_id)
+
+            fake.failures = set()
+            sync.sync_mailbox(self.user)
+
+        self.assertEqual(sorted(Message.objects.values_list('gmail_id', flat=True)), ['m1', 'm2'])
+
+    @override_settings(GMAIL_SYNC_INTERVAL=0, GMAIL_HTTP_MAX_RETRIES=0)
+    def test_unreachable_gmail_serves_the_local_copy(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            self.client.get('/api/inbox/')
+            url = fake.url
+
+        with override_settings(GMAIL_API_URL=url):
+            inbox = self.client.get('/api/inbox/')
+            thread = self.client.get('/api/threads/t0/')
+
+        self.assertEqual(inbox.status_code, 200)
+        self.assertEqual(list(inbox.json()), ['t0'])
+        self.assertEqual(thread.status_code, 200)
+
+    @override_settings(GMAIL_HTTP_MAX_RETRIES=0)
+    def test_unreachable_gmail_without_local_copy_is_an_error(self):
+        with FakeGmail() as fake:
+            url = fake.url
+        with override_settings(GMAIL_API_URL=url):
+            response = self.client.get('/api/inbox/')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Gmail could not be reached.'})
+
+    def test_threads_view_filters_local_messages_by_sender(self):
+        messages = [
+            make_message('m1', 't0', 'Hello', 'a', sender='Bob <bob@example.com>'),
+            make_message('m2', 't1', 'Other', 'b', sender='carol@example.com'),
+        ]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            threads = self.client.post('/api/threads/', {'email': 'bob@example.com'}).json()
+
+        self.assertEqual(list(threads), ['t0'])
+
+
+class ConditionalResponseTests(GmailUserMixin, TestCase):
+    @override_settings(GMAIL_SYNC_INTERVAL=0)
+    def test_inbox_answers_304_until_the_mailbox_changes(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            first = self.client.get('/api/inbox/')
+            etag = first['ETag']
+            with mock.patch('email_api.views.latest_messages') as build:
+                cached = self.client.get('/api/inbox/', HTTP_IF_NONE_MATCH=etag)
+            build.assert_not_called()
+
+            fake.add(make_message('m2', 't0', 'Hello', 'b'))
+            changed = self.client.get('/api/inbox/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        self.assertEqual(len(changed.json()['t0']['messages']), 2)
+
+    def test_etag_depends_on_view_and_format(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            full = self.client.get('/api/inbox/')['ETag']
+            listed = self.client.get('/api/inbox/?view=list')
+            stream = self.client.get('/api/inbox/', HTTP_ACCEPT='application/x-ndjson', HTTP_IF_NONE_MATCH=full)
+
+        self.assertEqual(listed.status_code, 200)
+        self.assertNotEqual(listed['ETag'], full)
+        # A stream can break off with an error line, so it is never cached.
+        self.assertEqual(stream.status_code, 200)
+        self.assertFalse(stream.has_header('ETag'))
+
+    @override_settings(GMAIL_HTTP_MAX_RETRIES=0)
+    def test_response_with_a_missing_body_has_no_etag(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            fake.failures = {'m1'}
+            partial = self.client.get('/api/inbox/')
+            threads = self.client.post('/api/threads/', {'email': 'alice@example.com'})
+            fake.failures = set()
+            whole = self.client.get('/api/inbox/')
+
+        self.assertEqual(partial.json()['t0']['messages'][0]['body'], '')
+        self.assertFalse(partial.has_header('ETag'))
+        self.assertFalse(threads.has_header('ETag'))
+        self.assertEqual(whole.json()['t0']['messages'][0]['body'], 'a')
+        self.assertTrue(whole.has_header('ETag'))
+
+    def test_threads_etag_is_per_sender(self):
+        messages = [
+            make_message('m1', 't0', 'Hello', 'a', sender='bob@example.com'),
+            make_message('m2', 't1', 'Other', 'b', sender='carol@example.com'),
+        ]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            bob = self.client.post('/api/threads/', {'email': 'bob@example.com'})
+            again = self.client.post('/api/threads/', {'email': 'bob@example.com'}, HTTP_IF_NONE_MATCH=bob['ETag'])
+            carol = self.client.post('/api/threads/', {'email': 'carol@example.com'}, HTTP_IF_NONE_MATCH=bob['ETag'])
+
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(carol.status_code, 200)
+        self.assertEqual(list(carol.json()), ['t1'])
+
+
+class LazyBodyTests(GmailUserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = [make_message(f'm{i}', f't{i % 2}', f'Subject {i % 2}', f'body {i}') for i in range(4)]
+
+    def test_list_mode_returns_headers_without_fetching_bodies(self):
+        with FakeGmail(self.messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            inbox = self.client.get('/api/inbox/?view=list').json()
+
+        self.assertEqual(len(fake.requests), 3)
+        self.assertEqual(inbox['t0']['messages'][0], {
+            'id': 'm0', 'thread_id': 't0', 'from_email': 'alice@example.com',
+            'subject': 'Subject 0', 'date': 'Mon, 1 Jan 2024 10:00:00 +0000',
+        })
+        self.assertFalse(Message.objects.filter(body_loaded=True).exists())
+
+    def test_bodies_are_loaded_on_demand_and_cached(self):
+        with FakeGmail(self.messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            self.client.get('/api/inbox/?view=list')
+            fake.requests.clear()
+            thread = self.client.get('/api/threads/t1/').json()
+            message = self.client.get('/api/messages/m1/').json()
+            missing = self.client.get('/api/messages/nope/')
+
+        self.assertEqual([m['body'] for m in thread['messages']], ['body 1', 'body 3'])
+        self.assertEqual(message['body'], 'body 1')
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(missing.status_code, 404)
+
+
+class SyncWorkerTests(GmailUserMixin, TransactionTestCase):
+    def test_one_active_job_per_user(self):
+        first = enqueue_sync(self.user)
+        second = enqueue_sync(self.user, force_full=True)
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(SyncJob.objects.count(), 1)
+        self.assertTrue(SyncJob.objects.get().force_full)
+
+    def test_leased_jobs_are_not_claimed_twice(self):
+        enqueue_sync(self.user)
+        claimed = claim_jobs('worker-1', 5)
+
+        self.assertEqual([job.user for job in claimed], [self.user])
+        self.assertEqual(claimed[0].attempts, 1)
+        self.assertEqual(claim_jobs('worker-2', 5), [])
+
+        SyncJob.objects.update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(claim_jobs('worker-2', 5)), 1)
+
+    @override_settings(GMAIL_SYNC_MAX_ATTEMPTS=2, GMAIL_SYNC_RETRY_BASE=30)
+    def test_failed_jobs_back_off_then_give_up(self):
+        enqueue_sync(self.user)
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=f'{fake.url}/missing'):
+            self.assertFalse(run_job(claim_jobs('worker', 1)[0]))
+            job = SyncJob.objects.get()
+            self.assertEqual((job.status, job.attempts), (SyncJob.QUEUED, 1))
+            self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=25))
+            self.assertEqual(claim_jobs('worker', 1), [])
+
+            SyncJob.objects.update(run_after=timezone.now())
+            self.assertFalse(run_job(claim_jobs('worker', 1)[0]))
+
+        job = SyncJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (SyncJob.FAILED, 2))
+        self.assertIn('Failed to sync mailbox.', job.last_error)
+
+    @override_settings(GMAIL_SYNC_INTERVAL=0, GMAIL_SYNC_RETRY_MAX=600)
+    def test_failed_users_are_not_requeued_every_tick(self):
+        Mailbox.objects.create(user=self.user)
+        SyncJob.objects.create(user=self.user, status=SyncJob.FAILED, run_after=timezone.now(), attempts=5)
+
+        self.assertEqual(enqueue_due_syncs(), 0)
+        self.assertEqual(enqueue_due_syncs(), 0)
+        self.assertEqual(enqueue_sync(self.user).status, SyncJob.FAILED)
+        self.assertEqual(SyncJob.objects.count(), 1)
+
+        SyncJob.objects.update(updated_at=timezone.now() - timedelta(seconds=601))
+        self.assertEqual(enqueue_due_syncs(), 1)
+        job = SyncJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (SyncJob.QUEUED, 0))
+
+    @override_settings(GMAIL_BACKGROUND_SYNC=True)
+    def test_views_serve_data_prepared_by_the_worker(self):
+        messages = [make_message(f'm{i}', 't0', 'Hello', f'body {i}') for i in range(3)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            pending = self.client.get('/api/inbox/')
+            self.assertEqual(fake.requests, [])
+
+            call_command('sync_worker', '--once', '--concurrency', '2', stdout=io.StringIO())
+            fake.requests.clear()
+            inbox = self.client.get('/api/inbox/').json()
+
+        self.assertEqual(pending.status_code, 202)
+        self.assertEqual(fake.requests, [])
+        self.assertEqual([m['body'] for m in inbox['t0']['messages']], ['body 0', 'body 1', 'body 2'])
+        self.assertFalse(SyncJob.objects.exists())
+
+    @override_settings(GMAIL_BACKGROUND_SYNC=True, GMAIL_PREFETCH_BODIES=1)
+    def test_body_misses_are_queued_for_the_worker(self):
+        messages = [
+            make_message('m1', 't0', 'Hello', 'from bob', sender='bob@example.com'),
+            make_message('m2', 't1', 'Other', 'newest'),
+        ]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            enqueue_sync(self.user)
+            call_command('sync_worker', '--once', stdout=io.StringIO())
+            fake.requests.clear()
+            missing = self.client.post('/api/threads/', {'email': 'bob@example.com'})
+            self.assertEqual(fake.requests, [])
+            self.assertTrue(SyncJob.objects.filter(user=self.user, status=SyncJob.QUEUED).exists())
+
+            call_command('sync_worker', '--once', stdout=io.StringIO())
+            loaded = self.client.post('/api/threads/', {'email': 'bob@example.com'})
+
+        self.assertEqual(missing.json()['t0']['messages'][0]['body'], '')
+        self.assertFalse(missing.has_header('ETag'))
+        self.assertEqual(loaded.json()['t0']['messages'][0]['body'], 'from bob')
+        self.assertFalse(Message.objects.filter(body_requested=True).exists())
+
+    @override_settings(GMAIL_BACKGROUND_SYNC=True, GMAIL_SYNC_INTERVAL=0)
+    def test_stale_mailboxes_are_queued_and_served_locally(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            enqueue_sync(self.user)
+            call_command('sync_worker', '--once', stdout=io.StringIO())
+            fake.add(make_message('m2', 't0', 'Hello', 'b'))
+            fake.requests.clear()
+            inbox = self.client.get('/api/inbox/').json()
+            self.assertEqual(fake.requests, [])
+            self.assertTrue(SyncJob.objects.filter(user=self.user, status=SyncJob.QUEUED).exists())
+
+            call_command('sync_worker', '--once', stdout=io.StringIO())
+            refreshed = self.client.get('/api/inbox/').json()
+
+        self.assertEqual([m['id'] for m in inbox['t0']['messages']], ['m1'])
+        self.assertEqual([m['id'] for m in refreshed['t0']['messages']], ['m1', 'm2'])
+
+
+class OutboxTests(GmailUserMixin, TransactionTestCase):
+    def send(self, **data):
+        data = dict({'to': 'bob@example.com', 'subject': 'Hi', 'body': 'Hello Bob'}, **data)
+        headers = {'HTTP_IDEMPOTENCY_KEY': data.pop('key')} if 'key' in data else {}
+        return self.client.post('/api/send/', data, **headers)
+
+    def test_send_is_accepted_without_calling_gmail(self):
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            response = self.send()
+            queued = self.client.get(response.json()['status_url']).json()
+            call_command('send_worker', '--once', stdout=io.StringIO())
+            sent = self.client.get(response.json()['status_url']).json()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(queued['status'], 'queued')
+        self.assertEqual(sent['status'], 'sent')
+        self.assertEqual(sent['gmail_id'], 's1')
+        self.assertEqual([(m['to'], m['subject'], m['body']) for m in fake.sent], [('bob@example.com', 'Hi', 'Hello Bob')])
+        self.assertEqual(fake.sent[0]['message_id'], OutgoingEmail.objects.get().message_id)
+
+    def test_idempotency_key_deduplicates_requests(self):
+        first = self.send(key='abc')
+        second = self.send(key='abc')
+        conflict = self.send(key='abc', body='Something else')
+
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
+
+    def test_status_is_private_to_the_sender(self):
+        item_id = self.send().json()['id']
+        self.client.force_login(User.objects.create_user('mallory'))
+
+        self.assertEqual(self.client.get(f'/api/send/{item_id}/').status_code, 404)
+
+    def test_transient_failures_are_retried_without_duplicates(self):
+        self.send()
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            fake.fail_with = [(503, {})]
+            self.assertFalse(deliver(claim_jobs('worker', 1, model=OutgoingEmail)[0]))
+            item = OutgoingEmail.objects.get()
+            self.assertEqual((item.status, item.last_error), ('queued', 'Gmail answered 503.'))
+
+            # The retry finds nothing under the Message-ID and sends; a further retry finds it.
+            OutgoingEmail.objects.update(run_after=timezone.now())
+            self.assertTrue(deliver(claim_jobs('worker', 1, model=OutgoingEmail)[0]))
+            OutgoingEmail.objects.update(status='queued', run_after=timezone.now())
+            self.assertTrue(deliver(claim_jobs('worker', 1, model=OutgoingEmail)[0]))
+
+        self.assertEqual(len(fake.sent), 1)
+        self.assertEqual(OutgoingEmail.objects.get().status, 'sent')
+
+    def test_rejected_messages_fail_without_retry(self):
+        self.send()
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            fake.fail_with = [(400, {})]
+            call_command('send_worker', '--once', stdout=io.StringIO(), stderr=io.StringIO())
+
+        item = OutgoingEmail.objects.get()
+        self.assertEqual((item.status, item.attempts), ('failed', 1))
+        self.assertEqual(fake.sent, [])
+
+
+class BatchSendTests(GmailUserMixin, TransactionTestCase):
+    def post(self, data, **headers):
+        return self.client.post('/api/send/batch/', data, content_type='application/json', **headers)
+
+    @override_settings(GMAIL_BATCH_SIZE=10)
+    def test_template_batch_is_sent_in_batched_calls(self):
+        recipients = [{'to': f'user{i}@example.com', 'variables': {'name': f'User {i}'}} for i in range(25)]
+        response = self.post({'template': {'subject': 'Hi $name', 'body': 'Hello ${name}, this is for $to.'},
+                              'recipients': recipients})
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            call_command('send_worker', '--once', '--concurrency', '1', stdout=io.StringIO())
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['accepted'], 25)
+        self.assertEqual(fake.requests, [('POST', '/batch/gmail/v1')] * 3)
+        self.assertEqual(len(fake.sent), 25)
+        self.assertEqual(fake.sent[3]['subject'], 'Hi User 3')
+        self.assertEqual(fake.sent[3]['body'], 'Hello User 3, this is for user3@example.com.')
+        self.assertFalse(OutgoingEmail.objects.exclude(status='sent').exists())
+
+    @mock.patch('email_api.views.SEND_BATCH_LIMIT', 3)
+    def test_oversized_batch_is_rejected_before_rendering(self):
+        recipients = [{'to': f'user{i}@example.com'} for i in range(4)]
+        with mock.patch('email_api.views.render_batch') as render:
+            response = self.post({'template': {'subject': 'Hi', 'body': 'Hello'}, 'recipients': recipients})
+
+        self.assertEqual(response.status_code, 400)
+        render.assert_not_called()
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_invalid_items_are_reported_per_item(self):
+        response = self.post({'messages': [
+            {'to': 'bob@example.com', 'subject': 'Hi', 'body': 'a'},
+            {'to': 'carol@example.com', 'body': 'b'},
+            'nonsense',
+        ]})
+        results = response.json()['results']
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual(results[0]['status'], 'queued')
+        self.assertEqual(results[1]['error'], 'Either "subject" or "thread_id" is required')
+        self.assertEqual(results[2]['error'], 'Each message must be an object')
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
+
+    def test_missing_template_variables_reject_the_item(self):
+        response = self.post({'template': {'subject': 'Hi $name', 'body': 'x'}, 'recipients': [{'to': 'bob@example.com'}]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("'name'", response.json()['results'][0]['error'])
+
+    def test_malformed_variables_or_items_are_rejected(self):
+        template = {'subject': 'Hi $name', 'body': 'x'}
+        response = self.post({'template': template, 'recipients': [
+            {'to': 'bob@example.com', 'variables': ['name']},
+            {'to': 'carol@example.com', 'variables': 'name'},
+            {'to': 'dave@example.com', 'variables': {'name': 'Dave'}},
+        ]})
+        results = response.json()['results']
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([r.get('error') for r in results[:2]], ['"variables" must be an object'] * 2)
+        self.assertEqual(results[2]['status'], 'queued')
+        self.assertEqual(self.post({'messages': {'to': 'bob@example.com'}}).status_code, 400)
+        self.assertEqual(self.post({'template': template, 'recipients': 'bob@example.com'}).status_code, 400)
+
+    def test_reused_key_with_different_content_is_a_conflict(self):
+        data = {'messages': [{'to': f'u{i}@example.com', 'subject': 'Hi', 'body': 'x'} for i in range(2)]}
+        first = self.post(data, HTTP_IDEMPOTENCY_KEY='job-1').json()['results']
+        data['messages'][1]['body'] = 'changed'
+        second = self.post(data, HTTP_IDEMPOTENCY_KEY='job-1').json()
+
+        self.assertEqual(second['results'][0]['id'], first[0]['id'])
+        self.assertEqual(second['results'][1], {'index': 1, 'error': 'Idempotency-Key was already used for a different message'})
+        self.assertEqual((second['accepted'], second['rejected']), (1, 1))
+        self.assertEqual(OutgoingEmail.objects.get(pk=first[1]['id']).body, 'x')
+
+    def test_retried_request_queues_nothing_twice(self):
+        data = {'messages': [{'to': f'u{i}@example.com', 'subject': 'Hi', 'body': 'x'} for i in range(3)]}
+        first = self.post(data, HTTP_IDEMPOTENCY_KEY='job-1').json()['results']
+        second = self.post(data, HTTP_IDEMPOTENCY_KEY='job-1').json()['results']
+
+        self.assertEqual([r['id'] for r in first], [r['id'] for r in second])
+        self.assertEqual(OutgoingEmail.objects.count(), 3)
+
+    def test_batch_items_fail_or_retry_individually(self):
+        data = {'messages': [{'to': f'u{i}@example.com', 'subject': 'Hi', 'body': 'x'} for i in range(3)]}
+        self.post(data)
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            fake.send_failures = [200, 503, 400]
+            sent = deliver_batch(claim_jobs('worker', 3, model=OutgoingEmail))
+
+        self.assertEqual(sent, [True, False, False])
+        self.assertEqual(
+            list(OutgoingEmail.objects.order_by('pk').values_list('status', flat=True)), ['sent', 'queued', 'failed'],
+        )
+
+
+class RateLimiterTests(GmailUserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = f'{tmp.name}/ratelimit.sqlite3'
+        rate_limiter.reset_stats()
+
+    def test_reservations_queue_behind_each_other(self):
+        tokens, wait = take(None, 0, 0, 10, rate=10, capacity=10)
+        self.assertEqual((tokens, wait), (0, 0))
+        tokens, wait = take(tokens, 0, 0, 5, rate=10, capacity=10)
+        self.assertEqual(wait, 0.5)
+        tokens, wait = take(tokens, 0, 0.2, 5, rate=10, capacity=10)
+        self.assertAlmostEqual(wait, 0.8)
+        self.assertAlmostEqual(take(tokens, 0.2, 100, 1, rate=10, capacity=10)[0], 9)
+
+    def test_sqlite_buckets_are_shared_between_stores(self):
+        first, second = SQLiteBucketStore(self.path), SQLiteBucketStore(self.path)
+
+        self.assertEqual(first.reserve('gmail:1', 500, 250, 500), 0)
+        self.assertAlmostEqual(second.reserve('gmail:1', 250, 250, 500), 1.0, places=1)
+        self.assertEqual(second.reserve('gmail:2', 100, 250, 500), 0)
+
+    def test_calls_wait_for_quota_and_report_the_delay(self):
+        messages = [make_message(f'm{i}', f't{i}', 'Hello', 'x') for i in range(3)]
+        with FakeGmail(messages) as fake, mock.patch('email_api.ratelimit.time.sleep') as sleep, override_settings(
+            GMAIL_API_URL=fake.url, GMAIL_RATE_LIMIT=100, GMAIL_RATE_LIMIT_BURST=10,
+            GMAIL_RATE_LIMIT_STORAGE='email_api.ratelimit.SQLiteBucketStore', GMAIL_RATE_LIMIT_PATH=self.path,
+        ):
+            threads = fetch_threads(self.user, 'in:inbox')
+
+        # threads.list (10 units) drains the burst; the batch of three threads.get (30 units) waits 0.3s.
+        self.assertEqual(len(threads), 3)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.3, places=1)
+        stats = rate_limiter.stats()
+        self.assertEqual((stats['gmail.threads.list']['delayed'], stats['gmail.batch']['delayed']), (0, 1))
+        self.assertAlmostEqual(stats['gmail.batch']['max_wait_ms'], 300, delta=50)
+
+
+class AsyncViewTests(GmailUserMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_client.cookies = self.client.cookies
+
+    async def test_unsynced_mailbox_is_queued_not_synced_inline(self):
+        with FakeGmail([make_message('m1', 't0', 'Hello', 'a')]) as fake, override_settings(GMAIL_API_URL=fake.url):
+            response = await self.async_client.get('/api/async/inbox/')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(fake.requests, [])
+        self.assertEqual(await SyncJob.objects.filter(user=self.user).acount(), 1)
+
+    @override_settings(GMAIL_ASYNC_CONCURRENCY=3)
+    async def test_bodies_are_fetched_concurrently_within_user_limit(self):
+        messages = [make_message(f'm{i}', f't{i}', f'Subject {i}', f'body {i}') for i in range(9)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            await sync_to_async(sync.sync_mailbox)(self.user)
+            fake.delay = 0.05
+            fake.max_in_flight = 0
+            response = await self.async_client.get('/api/async/inbox/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['t4']['messages'][0]['body'], 'body 4')
+        self.assertEqual(len([r for r in fake.requests if r[1].startswith('/gmail/v1/users/me/messages/')]), 9)
+        self.assertEqual(fake.max_in_flight, 3)
+        self.assertEqual(await Message.objects.filter(body_loaded=True).acount(), 9)
+        # The per-user semaphore goes away once no request holds it.
+        self.assertFalse(any(async_client._user_limits.values()))
+
+    async def test_inbox_is_served_from_the_store_with_etags(self):
+        messages = [make_message(f'm{i}', f't{i}', f'Subject {i}', f'body {i}') for i in range(3)]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            await sync_to_async(sync.sync_mailbox)(self.user)
+            first = await self.async_client.get('/api/async/inbox/')
+            with mock.patch('email_api.views.latest_messages') as build:
+                cached = await self.async_client.get('/api/async/inbox/', headers={'If-None-Match': first['ETag']})
+            build.assert_not_called()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['t1']['messages'][0]['body'], 'body 1')
+        self.assertEqual(await Message.objects.acount(), 3)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], first['ETag'])
+
+    async def test_threads_are_filtered_by_sender(self):
+        messages = [
+            make_message('m1', 't0', 'Hello', 'a', sender='bob@example.com'),
+            make_message('m2', 't1', 'Other', 'b', sender='carol@example.com'),
+        ]
+        with FakeGmail(messages) as fake, override_settings(GMAIL_API_URL=fake.url):
+            await sync_to_async(sync.sync_mailbox)(self.user)
+            response = await self.async_client.post(
+                '/api/async/threads/', {'email': 'bob@example.com'}, content_type='application/json',
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()), ['t0'])
+
+    async def test_send_is_queued_in_the_outbox(self):
+        data = {'to': 'bob@example.com', 'subject': 'Hi', 'body': 'Hello Bob'}
+        with FakeGmail() as fake, override_settings(GMAIL_API_URL=fake.url):
+            first = await self.async_client.post('/api/async/send/', data, content_type='application/json',
+                                                 headers={'Idempotency-Key': 'abc'})
+            again = await self.async_client.post('/api/async/send/', data, content_type='application/json',
+                                                 headers={'Idempotency-Key': 'abc'})
+            conflict = await self.async_client.post('/api/async/send/', dict(data, body='Other'),
+                                                    content_type='application/json', headers={'Idempotency-Key': 'abc'})
+
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(first.json()['status'], 'queued')
+        self.assertIn('status_url', first.json())
+        self.assertEqual(again.json()['id'], first.json()['id'])
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(fake.sent, [])
+        self.assertEqual(await OutgoingEmail.objects.acount(), 1)
+
+    async def test_threads_requires_sender(self):
+        response = await self.async_client.post('/api/async/threads/', {}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_anonymous_requests_are_rejected(self):
+        self.async_client.cookies.clear()
+        response = await self.async_client.get('/api/async/inbox/')
+        self.assertEqual(response.status_code, 403)
+
+
+class TokenManagerTests(TransactionTestCase):
+    def setUp(self):
+        token_manager.clear()
+        self.addCleanup(token_manager.clear)
+        self.user = User.objects.create_user('alice', 'alice@example.com')
+        self.user_auth = UserSocialAuth.objects.create(
+            user=self.user, provider='google-oauth2', uid='alice',
+            extra_data={'access_token': 'stale', 'refresh_token': 'refresh'},
+        )
+
+    def test_valid_token_is_reused(self):
+        with FakeGmail() as fake, override_settings(GOOGLE_TOKEN_URL=f'{fake.url}/token'):
+            tokens = {utils.get_gmail_token(self.user) for _ in range(5)}
+
+        self.assertEqual(tokens, {'token-1'})
+        self.assertEqual(fake.tokens_issued, 1)
+        self.user_auth.refresh_from_db()
+        self.assertEqual(self.user_auth.extra_data['access_token'], 'token-1')
+
+    def test_unexpired_stored_token_needs_no_refresh(self):
+        self.user_auth.extra_data['token_expires_at'] = time.time() + 600
+        self.user_auth.save()
+        with FakeGmail() as fake, override_settings(GOOGLE_TOKEN_URL=f'{fake.url}/token'):
+            self.assertEqual(utils.get_gmail_token(self.user), 'stale')
+
+        self.assertEqual(fake.tokens_issued, 0)
+
+    def test_rejected_token_forces_refresh(self):
+        with FakeGmail() as fake, override_settings(GOOGLE_TOKEN_URL=f'{fake.url}/token'):
+            first = utils.get_gmail_token(self.user)
+            second = utils.get_gmail_token(self.user, rejected_token=first)
+            third = utils.get_gmail_token(self.user, rejected_token=first)
+
+        self.assertEqual((first, second, third), ('token-1', 'token-2', 'token-2'))
+
+    def test_concurrent_requests_share_one_refresh(self):
+        results = []
+        with FakeGmail() as fake, override_settings(GOOGLE_TOKEN_URL=f'{fake.url}/token'):
+            fake.token_delay = 0.2
+            workers = [
+                threading.Thread(target=lambda: results.append(utils.get_gmail_token(self.user)))
+                for _ in range(8)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        self.assertEqual(fake.tokens_issued, 1)
+        self.assertEqual(results, ['token-1'] * 8)
+
+
+def legacy_clean_email_body(body):
+    """
+    The original nine-pass cleaner, kept as the reference for CleanerTests.
+    """
+    clean_body = body.replace('\r\n', '\n').replace('\xa0', ' ')
+    clean_body = html.unescape(clean_body)
+    clean_body = re.sub(r'<[^>]+>', '', clean_body)
+    clean_body = re.sub(r'\u2060', '', clean_body)
+    clean_body = re.sub(r'[ \t]+$', '', clean_body, flags=re.MULTILINE)
+    clean_body = re.sub(r'\n{3,}', '\n\n', clean_body)
+    clean_body = re.sub(r'-\s*\n\s*', '- ', clean_body)
+    clean_body = re.sub(r'^\s*[-\u2022]+\s*$', '', clean_body, flags=re.MULTILINE)
+    clean_body = re.sub(r'\n\s*-\s*', '\n- ', clean_body)
+
+    return clean_body.strip()
+
+
+class CleanerTests(TestCase):
+    samples = [
+        '',
+        'plain text only',
+        'Hello <b>world</b>&nbsp;&amp; friends\r\n\r\n\r\n\r\nBye',
+        '<\u2060>kept?</\u2060>\u2060joined',
+        '&lt;b&gt;escaped tags&lt;/b&gt; are stripped after unescaping',
+        'line with trailing spaces   \t\nnext\xa0line\xa0\n',
+        'hyphen-\n   break and\n  - dash item\n\u2022\n- \n--\nend',
+        '&#8288;word&#x2060;joiner and &bull; bullet',
+        '\n\n\n\n  \n\n\t\n-\n\n\u2022\u2022\n',
+    ]
+
+    def test_matches_legacy_output_on_samples(self):
+        for sample in self.samples:
+            self.assertEqual(clean_email_body(sample), legacy_clean_email_body(sample), repr(sample))
+
+    def test_matches_legacy_output_on_random_input(self):
+        rng = random.Random(1234)
+        alphabet = ['<', '>', '-', '\u2022', '\u2060', '\n', '\r', '\r\n', ' ', '\t', '&amp;', '&nbsp;', '&lt;', '\xa0', 'a', 'b']
+        for _ in range(2000):
+            sample = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+            self.assertEqual(clean_email_body(sample), legacy_clean_email_body(sample), repr(sample))
+
+    def test_clean_bodies_keeps_order(self):
+        self.assertEqual(clean_bodies(self.samples), [legacy_clean_email_body(s) for s in self.samples])
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def part(mime_type, data=b'', charset=None, **extra):
+    content_type = f'{mime_type}; charset="{charset}"' if charset else mime_type
+    return dict({
+        'mimeType': mime_type,
+        'headers': [{'name': 'Content-Type', 'value': content_type}],
+        'body': {'data': b64(data)} if data else {'size': 0},
+    }, **extra)
+
+
+class MimeWalkerTests(TestCase):
+    def test_nested_alternative_inside_mixed(self):
+        payload = part('multipart/mixed', parts=[
+            part('multipart/alternative', parts=[
+                part('text/html', b'<p>html</p>'),
+                part('text/plain', b'plain text'),
+            ]),
+            part('application/pdf', b'%PDF', filename='a.pdf'),
+        ])
+        self.assertEqual(extract_body(payload), 'plain text')
+
+    def test_html_is_used_when_there_is_no_plain_part(self):
+        payload = part('multipart/related', parts=[part('text/html', b'<b>hi</b>'), part('image/png', b'x')])
+        self.assertEqual(extract_body(payload), '<b>hi</b>')
+
+    def test_attachments_are_never_decoded(self):
+        attachment = part('text/plain', b'attached', filename='notes.txt')
+        attachment['body'] = {'data': '!!not base64!!'}
+        payload = part('multipart/mixed', parts=[attachment, part('text/plain', b'body')])
+        self.assertEqual(extract_body(payload), 'body')
+
+    def test_declared_charset_is_used(self):
+        payload = part('text/plain', 'Grüße aus Köln'.encode('iso-8859-1'), charset='iso-8859-1')
+        self.assertEqual(extract_body(payload), 'Grüße aus Köln')
+
+    def test_unknown_charset_falls_back_to_utf8(self):
+        payload = part('text/plain', 'naïve'.encode(), charset='x-unknown')
+        self.assertEqual(extract_body(payload), 'naïve')
+
+    def test_malformed_base64_gives_an_empty_body(self):
+        payload = part('text/plain', b'')
+        for data in ('abcde', 'Zm9vé'):
+            payload['body'] = {'data': data}
+            self.assertEqual(extract_body(payload), '')
+            self.assertEqual(extract_body(payload, max_bytes=100), '')
+
+    def test_truncation_does_not_split_characters(self):
+        payload = part('text/plain', ('é' * 100).encode())
+        self.assertEqual(extract_body(payload, max_bytes=11), 'é' * 5)
+        self.assertEqual(extract_body(payload, max_bytes=1000), 'é' * 100)
+
+    def test_gmail_message_body_uses_walker(self):
+        msg_data = {'payload': part('multipart/mixed', parts=[
+            part('multipart/alternative', parts=[part('text/plain', b'Hello <b>there</b>')]),
+        ])}
+        self.assertEqual(utils.message_body(msg_data), 'Hello there')
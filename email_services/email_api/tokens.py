@@ -0,0 +1,91 @@
+import threading
+import time
+from django.conf import settings
+from .gmail_client import http_client
+
+
+class TokenManager:
+    """
+    Per-process cache of Gmail access tokens keyed by user id.
+    Tokens are reused until they are within TOKEN_EXPIRY_MARGIN seconds of expiring or Gmail rejects
+    them with a 401. Refreshes are serialised per user, so concurrent requests share a single refresh.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, user_id):
+        with self._locks_guard:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def _is_fresh(self, entry, rejected_token):
+        if not entry or not entry[0] or entry[0] == rejected_token:
+            return False
+        margin = getattr(settings, 'TOKEN_EXPIRY_MARGIN', 60)
+        return entry[1] - margin > time.time()
+
+    def _load(self, user_auth):
+        extra_data = user_auth.extra_data
+        expires_at = extra_data.get('token_expires_at')
+        if expires_at is None and extra_data.get('auth_time') and extra_data.get('expires'):
+            expires_at = extra_data['auth_time'] + extra_data['expires']
+        return extra_data.get('access_token'), expires_at or 0
+
+    def get_token(self, user, rejected_token=None):
+        """
+        Return a valid access token for `user`, or None if the user has not linked Gmail.
+        Pass the token Gmail just answered 401 to as `rejected_token` to force a refresh.
+        """
+        entry = self._tokens.get(user.pk)
+        if self._is_fresh(entry, rejected_token):
+            return entry[0]
+
+        with self._lock_for(user.pk):
+            # Another request may have refreshed while this one waited for the lock.
+            entry = self._tokens.get(user.pk)
+            if self._is_fresh(entry, rejected_token):
+                return entry[0]
+
+            user_auth = user.social_auth.filter(provider='google-oauth2').first()
+            if not user_auth:
+                return None
+
+            entry = self._load(user_auth)
+            if not self._is_fresh(entry, rejected_token):
+                entry = self._refresh(user_auth) or entry
+            self._tokens[user.pk] = entry
+            return entry[0]
+
+    def _refresh(self, user_auth):
+        refresh_token = user_auth.extra_data.get('refresh_token')
+        if not refresh_token:
+            return None
+
+        data = {
+            'client_id': settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY,
+            'client_secret': settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token',
+        }
+
+        token_url = getattr(settings, 'GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+        resp = http_client.post(token_url, data=data, metric='oauth.token', idempotent=True)
+        if resp.status_code != 200:
+            print("Refresh token error:", resp.text)
+            return None
+
+        token_data = resp.json()
+        new_token = token_data.get('access_token')
+        expires_at = time.time() + token_data.get('expires_in', 3600)
+        user_auth.extra_data['access_token'] = new_token
+        user_auth.extra_data['token_expires_at'] = expires_at
+        user_auth.save(update_fields=['extra_data'])
+        return new_token, expires_at
+
+    def clear(self):
+        self._tokens.clear()
+
+
+token_manager = TokenManager()
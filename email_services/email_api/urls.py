@@ -1,8 +1,19 @@
 from django.urls import path
-from .views import EmailThreadView, SendEmailView,InboxView
+from .views import (
+    EmailThreadView, SendEmailView, BatchSendView, SendStatusView, InboxView, ThreadDetailView, MessageDetailView,
+    AsyncInboxView, AsyncEmailThreadView, AsyncSendEmailView,
+)
 
 urlpatterns = [
     path('threads/', EmailThreadView.as_view()),
+    path('threads/<str:thread_id>/', ThreadDetailView.as_view(), name='thread_detail'),
+    path('messages/<str:message_id>/', MessageDetailView.as_view(), name='message_detail'),
     path('send/', SendEmailView.as_view()),
+    path('send/batch/', BatchSendView.as_view(), name='send_batch'),
+    path('send/<int:outbox_id>/', SendStatusView.as_view(), name='send_status'),
     path('inbox/', InboxView.as_view(), name='inbox_emails'),
+    # Async variants for ASGI deployments (email_service.asgi).
+    path('async/inbox/', AsyncInboxView.as_view(), name='async_inbox_emails'),
+    path('async/threads/', AsyncEmailThreadView.as_view()),
+    path('async/send/', AsyncSendEmailView.as_view()),
 ]
@@ -1,253 +1,351 @@
-import html
+import json
 import re
-import requests
+import uuid
 from email.mime.text import MIMEText
+from email.parser import BytesParser
+from urllib.parse import urlencode
 import base64
+import requests
 from django.conf import settings
+from .cleaner import clean_email_body
+from .gmail_client import http_client
+from .mime import extract_body
+from .ratelimit import quota_units
+from .tokens import token_manager
 
 
-def refresh_access_token(user):
-    user_auth = user.social_auth.filter(provider='google-oauth2').first()
-    if not user_auth:
-        return None
+def get_gmail_token(user, rejected_token=None):
+    """
+    Return a cached access token, refreshing it only when it is close to expiry
+    or when Gmail rejected `rejected_token` with a 401.
+    """
+    return token_manager.get_token(user, rejected_token=rejected_token)
 
-    refresh_token = user_auth.extra_data.get('refresh_token')
-    if not refresh_token:
-        return None
 
-    data = {
-        'client_id': settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY,
-        'client_secret': settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET,
-        'refresh_token': refresh_token,
-        'grant_type': 'refresh_token',
+def gmail_headers(access_token):
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Accept': 'application/json',
     }
 
-    resp = requests.post('https://oauth2.googleapis.com/token', data=data)
-    if resp.status_code == 200:
-        new_token = resp.json().get('access_token')
-        user_auth.extra_data['access_token'] = new_token
-        user_auth.save()
-        return new_token
-    else:
-        print("Refresh token error:", resp.text)
-        return None
-
-
-def get_gmail_token(user):
-    user_auth = user.social_auth.filter(provider='google-oauth2').first()
-    if not user_auth:
-        return None
-
-    access_token = user_auth.extra_data.get('access_token')
-    new_token = refresh_access_token(user)
-    return new_token or access_token
 
+def gmail_url(path):
+    """
+    Build a Gmail API URL. GMAIL_API_URL can point the app at another host (e.g. a local fake in tests).
+    """
+    base_url = getattr(settings, 'GMAIL_API_URL', 'https://gmail.googleapis.com')
+    return f'{base_url}{path}'
 
 
-def clean_email_body(body):
+def _build_batch_body(boundary, calls):
     """
-    Clean raw email body text to remove html tags, excess whitespace, etc.
+    Multipart body for /batch/gmail/v1. `calls` holds GET paths or (method, path, json_body) tuples.
     """
-    clean_body = body.replace('\r\n', '\n').replace('\xa0', ' ')
-    clean_body = html.unescape(clean_body)
-    clean_body = re.sub(r'<[^>]+>', '', clean_body)
-    clean_body = re.sub(r'\u2060', '', clean_body)
-    clean_body = re.sub(r'[ \t]+$', '', clean_body, flags=re.MULTILINE)
-    clean_body = re.sub(r'\n{3,}', '\n\n', clean_body)
-    clean_body = re.sub(r'-\s*\n\s*', '- ', clean_body)
-    clean_body = re.sub(r'^\s*[-\u2022]+\s*$', '', clean_body, flags=re.MULTILINE)
-    clean_body = re.sub(r'\n\s*-\s*', '\n- ', clean_body)
-
-    return clean_body.strip()
+    lines = []
+    for index, call in enumerate(calls):
+        method, path, body = ('GET', call, None) if isinstance(call, str) else call
+        lines += [
+            f'--{boundary}',
+            'Content-Type: application/http',
+            f'Content-ID: <item-{index}>',
+            '',
+            f'{method} {path}',
+        ]
+        if body is None:
+            lines.append('')
+        else:
+            lines += ['Content-Type: application/json', '', json.dumps(body)]
+    lines.append(f'--{boundary}--')
+    return '\r\n'.join(lines) + '\r\n'
 
 
-def fetch_all_inbox_emails(user):
+def _parse_batch_response(resp):
     """
-    Fetch all unread emails from the user's Gmail inbox.
-    Returns a dict grouped by threadId, each with subject and message list.
+    Split a multipart/mixed batch response into {index: (status_code, json_or_none)}.
     """
-    access_token = get_gmail_token(user)
-    if not access_token:
-        return {"error": "User not authenticated with Gmail."}
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json',
-    }
+    raw = b'Content-Type: ' + resp.headers.get('Content-Type', '').encode() + b'\r\n\r\n' + resp.content
+    container = BytesParser().parsebytes(raw)
+    if not container.is_multipart():
+        return {}
+
+    results = {}
+    for part in container.get_payload():
+        content_id = part.get('Content-ID', '')
+        match = re.search(r'item-(\d+)', content_id)
+        if not match:
+            continue
 
-    params = {
-        'q': 'in:inbox',
-        'maxResults': 100
-    }
+        inner = part.get_payload(decode=True) or b''
+        head, _, body = inner.replace(b'\r\n', b'\n').partition(b'\n\n')
+        status_line = head.split(b'\n', 1)[0].split()
+        status_code = int(status_line[1]) if len(status_line) > 1 else 0
 
-    search_url = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
-    resp = requests.get(search_url, headers=headers, params=params)
-    if resp.status_code != 200:
-        print("Gmail API Error:", resp.status_code, resp.text)
-        return {"error": "Failed to fetch unread emails."}
+        data = None
+        if status_code == 200:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                status_code = 0
+        results[int(match.group(1))] = (status_code, data)
+    return results
+
+
+# Request only what list views render: three headers plus the fields the local store needs.
+MESSAGE_METADATA_PARAMS = {
+    'format': 'metadata',
+    'metadataHeaders': ['Subject', 'From', 'Date'],
+    'fields': 'id,threadId,labelIds,internalDate,payload/headers',
+}
+THREAD_METADATA_PARAMS = dict(
+    MESSAGE_METADATA_PARAMS,
+    fields='id,messages(id,threadId,labelIds,internalDate,payload/headers)',
+)
+MESSAGE_BODY_PARAMS = {
+    'format': 'full',
+    'fields': 'id,payload',
+}
+
+
+def user_quota(user, metric, count=1):
+    """
+    The `quota` argument for http_client calls made on behalf of `user`.
+    """
+    return (user.pk, quota_units(metric, count)) if user is not None else None
 
-    messages = resp.json().get('messages', [])
-    threads = {}
 
-    for msg in messages:
-        msg_id = msg['id']
-        msg_url = f'https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}'
-        msg_resp = requests.get(msg_url, headers=headers)
-        if msg_resp.status_code != 200:
+def batch_get(headers, collection, ids, params=None, user=None):
+    """
+    Fetch many messages or threads (`collection`) through Gmail's batch endpoint,
+    GMAIL_BATCH_SIZE sub-requests per round trip.
+    Returns ({id: json}, [ids that still failed]). Failed sub-requests are retried once with a
+    plain GET; items Gmail answers 404 for are in neither. Pass `user` to charge the calls to their rate limit.
+    """
+    batch_size = getattr(settings, 'GMAIL_BATCH_SIZE', 50)
+    query = f'?{urlencode(params, doseq=True)}' if params else ''
+    results = {}
+    failed, still_failed = [], []
+
+    for offset in range(0, len(ids), batch_size):
+        chunk = ids[offset:offset + batch_size]
+        boundary = f'batch_{uuid.uuid4().hex}'
+        paths = [f'/gmail/v1/users/me/{collection}/{item_id}{query}' for item_id in chunk]
+        batch_headers = dict(headers, **{'Content-Type': f'multipart/mixed; boundary={boundary}'})
+
+        resp = http_client.post(
+            gmail_url('/batch/gmail/v1'),
+            headers=batch_headers,
+            data=_build_batch_body(boundary, paths).encode(),
+            metric='gmail.batch',
+            idempotent=True,
+            quota=user_quota(user, f'gmail.{collection}.get', len(chunk)),
+        )
+        if resp.status_code != 200:
+            print("Gmail Batch Error:", resp.status_code, resp.text)
+            failed.extend(chunk)
             continue
-        msg_data = msg_resp.json()
-
-        headers_list = msg_data.get('payload', {}).get('headers', [])
-        subject = next((h['value'] for h in headers_list if h['name'] == 'Subject'), 'No Subject')
-        from_email = next((h['value'] for h in headers_list if h['name'] == 'From'), '')
-        date = next((h['value'] for h in headers_list if h['name'] == 'Date'), '')
-        thread_id = msg_data.get('threadId')
-
-        body = ''
-        parts = msg_data.get('payload', {}).get('parts', [])
-        if not parts:
-            body = msg_data.get('payload', {}).get('body', {}).get('data', '')
-        else:
-            for part in parts:
-                if part['mimeType'] == 'text/plain':
-                    body = part['body'].get('data', '')
-                    break
 
-        if body:
-            try:
-                body = base64.urlsafe_b64decode(body).decode('utf-8')
-            except Exception:
-                body = ''
+        parsed = _parse_batch_response(resp)
+        for index, item_id in enumerate(chunk):
+            status_code, data = parsed.get(index, (0, None))
+            if status_code == 200 and data is not None:
+                results[item_id] = data
+            elif status_code != 404:
+                failed.append(item_id)
+
+    for item_id in failed:
+        item_resp = http_client.get(
+            gmail_url(f'/gmail/v1/users/me/{collection}/{item_id}'),
+            headers=headers,
+            params=params,
+            metric=f'gmail.{collection}.get',
+            quota=user_quota(user, f'gmail.{collection}.get'),
+        )
+        if item_resp.status_code == 200:
+            results[item_id] = item_resp.json()
+        else:
+            print("Gmail API Error:", item_id, item_resp.status_code)
+            if item_resp.status_code != 404:
+                still_failed.append(item_id)
 
-        thread_data = {
-            'id': msg_id,
-            'thread_id': thread_id,
-            'from_email': from_email,
-            'subject': subject,
-            'date': date,
-            'body': clean_email_body(body),
-        }
-        if thread_id not in threads:
-            threads[thread_id] = {
-                'subject': subject,
-                'messages': []
-            }
-        threads[thread_id]['messages'].append(thread_data)
+    return results, still_failed
 
-    for thread in threads.values():
-        thread['messages'].sort(key=lambda x: x['date'])
 
-    return threads
+def batch_get_messages(headers, msg_ids, params=None, user=None):
+    return batch_get(headers, 'messages', msg_ids, params, user)
 
 
-def fetch_email_threads(user, sender_email):
+def decode_body(msg_data):
     """
-    Fetch emails from a specific sender email.
-    Returns emails grouped by threadId with subject and message list.
+    Decode the preferred text body of a full-format Gmail message without cleaning it.
+    Nested multiparts are walked, attachments skipped, and the text is cut at GMAIL_MAX_BODY_BYTES.
     """
-    access_token = get_gmail_token(user)
-    if not access_token:
-        return {"error": "User not authenticated with Gmail."}
+    return extract_body(msg_data.get('payload', {}), getattr(settings, 'GMAIL_MAX_BODY_BYTES', 512 * 1024))
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json',
-    }
 
-    params = {
-        'q': f'from:{sender_email}',
-        'maxResults': 100
+def message_body(msg_data):
+    """
+    Decode and clean the text/plain body of a full-format Gmail message.
+    """
+    return clean_email_body(decode_body(msg_data))
+
+
+def parse_message(msg_data):
+    headers_list = msg_data.get('payload', {}).get('headers', [])
+    subject = next((h['value'] for h in headers_list if h['name'] == 'Subject'), 'No Subject')
+    from_email = next((h['value'] for h in headers_list if h['name'] == 'From'), '')
+    date = next((h['value'] for h in headers_list if h['name'] == 'Date'), '')
+
+    return {
+        'id': msg_data.get('id'),
+        'thread_id': msg_data.get('threadId'),
+        'from_email': from_email,
+        'subject': subject,
+        'date': date,
+        'body': message_body(msg_data),
     }
 
-    search_url = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
-    resp = requests.get(search_url, headers=headers, params=params)
-    if resp.status_code != 200:
-        print("Gmail API Error:", resp.status_code, resp.text)
-        return {"error": "Failed to fetch email list."}
-
-    messages = resp.json().get('messages', [])
-    threads = {}
-
-    for msg in messages:
-        msg_id = msg['id']
-        msg_url = f'https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}'
-        msg_resp = requests.get(msg_url, headers=headers)
-        if msg_resp.status_code != 200:
-            continue
-        msg_data = msg_resp.json()
-
-        headers_list = msg_data.get('payload', {}).get('headers', [])
-        subject = next((h['value'] for h in headers_list if h['name'] == 'Subject'), 'No Subject')
-        from_email = next((h['value'] for h in headers_list if h['name'] == 'From'), '')
-        date = next((h['value'] for h in headers_list if h['name'] == 'Date'), '')
-        thread_id = msg_data.get('threadId')
-
-        body = ''
-        parts = msg_data.get('payload', {}).get('parts', [])
-        if not parts:
-            body = msg_data.get('payload', {}).get('body', {}).get('data', '')
-        else:
-            for part in parts:
-                if part['mimeType'] == 'text/plain':
-                    body = part['body'].get('data', '')
-                    break
-
-        if body:
-            try:
-                body = base64.urlsafe_b64decode(body).decode('utf-8')
-            except Exception:
-                body = ''
-
-        thread_data = {
-            'id': msg_id,
-            'thread_id': thread_id,
-            'from_email': from_email,
-            'subject': subject,
-            'date': date,
-            'body': clean_email_body(body),
-        }
-        if thread_id not in threads:
-            threads[thread_id] = {
-                'subject': subject,
-                'messages': []
-            }
-        threads[thread_id]['messages'].append(thread_data)
-
-    for thread in threads.values():
-        thread['messages'].sort(key=lambda x: x['date'])
 
-    return threads
+class GmailAPIError(Exception):
+    pass
 
 
-def send_email(user, to, subject, body, thread_id=None):
+def gmail_get(user, access_token, path, params=None, metric=None):
+    """
+    GET a Gmail API path, retrying once with a refreshed token if Gmail answers 401.
+    Returns (response, access_token) so callers keep using the token that worked.
+    """
+    url = gmail_url(path)
+    quota = user_quota(user, metric)
+    resp = http_client.get(url, headers=gmail_headers(access_token), params=params, metric=metric, quota=quota)
+    if resp.status_code == 401:
+        access_token = get_gmail_token(user, rejected_token=access_token)
+        if not access_token:
+            raise GmailAPIError("User not authenticated with Gmail.")
+        resp = http_client.get(url, headers=gmail_headers(access_token), params=params, metric=metric, quota=quota)
+    return resp, access_token
+
+
+def gmail_post(user, access_token, path, json=None, metric=None):
     """
-    Send an email via Gmail API.
-    If thread_id is provided, sends as reply to that thread.
+    POST to a Gmail API path with the same 401 handling as gmail_get.
     """
+    url = gmail_url(path)
+    quota = user_quota(user, metric)
+    resp = http_client.post(url, headers=gmail_headers(access_token), json=json, metric=metric, quota=quota)
+    if resp.status_code == 401:
+        access_token = get_gmail_token(user, rejected_token=access_token)
+        if not access_token:
+            raise GmailAPIError("User not authenticated with Gmail.")
+        resp = http_client.post(url, headers=gmail_headers(access_token), json=json, metric=metric, quota=quota)
+    return resp, access_token
+
+
+def _iter_pages(user, collection, query, max_results, error_message, item_params=None, page_token=None):
+    # Yields (items, next_page_token); next_page_token is None after the last page.
     access_token = get_gmail_token(user)
     if not access_token:
-        return {"error": "User not authenticated with Gmail."}
+        raise GmailAPIError("User not authenticated with Gmail.")
+
+    page_size = getattr(settings, 'GMAIL_PAGE_SIZE', 100)
+    remaining = max_results
+
+    while True:
+        params = {'maxResults': page_size if remaining is None else min(page_size, remaining)}
+        if query:
+            params['q'] = query
+        if page_token:
+            params['pageToken'] = page_token
+
+        resp, access_token = gmail_get(
+            user, access_token, f'/gmail/v1/users/me/{collection}', params, metric=f'gmail.{collection}.list',
+        )
+        if resp.status_code != 200:
+            print("Gmail API Error:", resp.status_code, resp.text)
+            raise GmailAPIError(error_message)
+
+        page = resp.json()
+        ids = [item['id'] for item in page.get(collection, [])]
+        fetched, failed = batch_get(gmail_headers(access_token), collection, ids, item_params, user)
+        if failed:
+            # Leaving them out would look like they had been deleted.
+            raise GmailAPIError(error_message)
+        if remaining is not None:
+            remaining -= len(ids)
+        page_token = page.get('nextPageToken')
+        if remaining is not None and remaining <= 0:
+            page_token = None
+        yield [fetched[item_id] for item_id in ids if item_id in fetched], page_token
+
+        if not page_token:
+            return
+
+
+def iter_thread_pages(user, query=None, max_results=None, error_message="Failed to fetch email list.", params=None,
+                      page_token=None):
+    """
+    Yield the Gmail threads matching `query` as one list per result page, following nextPageToken.
+    Each whole thread is fetched with one threads.get sub-request (`params`, e.g. THREAD_METADATA_PARAMS),
+    and its messages are ordered by their numeric internalDate. Only one page (GMAIL_PAGE_SIZE threads)
+    is held in memory at a time. Raises GmailAPIError on failure.
+    Yields (threads, next_page_token) so a caller can checkpoint and later resume from `page_token`.
+    """
+    for threads, next_page_token in _iter_pages(user, 'threads', query, max_results, error_message, params, page_token):
+        for thread in threads:
+            thread['messages'] = sorted(thread.get('messages', []), key=lambda m: int(m.get('internalDate') or 0))
+        yield threads, next_page_token
 
+
+def build_send_payload(to, subject, body, thread_id=None, message_id=None):
+    """
+    Build the JSON body for messages.send.
+    """
     message = MIMEText(body)
     message['to'] = to
     message['subject'] = subject or 'No Subject'
+    if message_id:
+        message['Message-ID'] = message_id
 
     raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    
+
     email_data = {'raw': raw}
     if thread_id:
         email_data['threadId'] = thread_id
+    return email_data
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json',
-    }
 
-    send_url = 'https://gmail.googleapis.com/gmail/v1/users/me/messages/send'
-    send_resp = requests.post(send_url, headers=headers, json=email_data)
+def batch_send(user, access_token, payloads):
+    """
+    Send many messages.send payloads through Gmail's batch endpoint, GMAIL_BATCH_SIZE per round trip.
+    Returns one (status_code, json_or_none) per payload, in order. A failed round trip gives every
+    item in it that round trip's status, or 0 if no answer arrived at all.
+    """
+    batch_size = getattr(settings, 'GMAIL_BATCH_SIZE', 50)
+    results = []
+    for offset in range(0, len(payloads), batch_size):
+        chunk = payloads[offset:offset + batch_size]
+        boundary = f'batch_{uuid.uuid4().hex}'
+        data = _build_batch_body(boundary, [('POST', '/gmail/v1/users/me/messages/send', p) for p in chunk]).encode()
+        quota = user_quota(user, 'gmail.send', len(chunk))
+        try:
+            for _ in range(2):
+                headers = dict(gmail_headers(access_token), **{'Content-Type': f'multipart/mixed; boundary={boundary}'})
+                resp = http_client.post(
+                    gmail_url('/batch/gmail/v1'), headers=headers, data=data, metric='gmail.batch.send', quota=quota,
+                )
+                if resp.status_code != 401:
+                    break
+                access_token = get_gmail_token(user, rejected_token=access_token)
+                if not access_token:
+                    break
+        except requests.RequestException as exc:
+            print("Gmail Batch Error:", exc)
+            results += [(0, None)] * len(chunk)
+            continue
 
-    if send_resp.status_code == 200:
-        return {"message": "Email sent successfully."}
-    else:
-        print("Send Email Error:", send_resp.status_code, send_resp.text)
-        return {"error": "Failed to send email."}
+        if resp.status_code != 200:
+            print("Gmail Batch Error:", resp.status_code, resp.text)
+            results += [(resp.status_code, None)] * len(chunk)
+            continue
+        parsed = _parse_batch_response(resp)
+        results += [parsed.get(index, (0, None)) for index in range(len(chunk))]
+    return results
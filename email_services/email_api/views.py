@@ -1,8 +1,228 @@
+import hashlib
+import json
+from itertools import islice
+from string import Template
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
+from django.views import View
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.settings import api_settings
 from rest_framework import status
-from .utils import fetch_email_threads, send_email, fetch_all_inbox_emails
+from .async_client import aload_bodies
+from .models import Message, OutgoingEmail, Thread, group_threads, iter_thread_groups
+from .outbox import enqueue_email, enqueue_emails
+from .renderers import NDJSONRenderer, ndjson_line
+from .sync import SyncPending, ensure_synced, load_bodies
+from .utils import GmailAPIError
+
+MESSAGE_LIMIT = 100
+STREAM_CHUNK = 50
+SEND_BATCH_LIMIT = 1000
+IDEMPOTENCY_CONFLICT = 'Idempotency-Key was already used for a different message'
+
+
+def is_list_mode(request):
+    """
+    `?view=list` returns headers only; bodies are then fetched per message or thread.
+    """
+    return request.GET.get('view') == 'list'
+
+
+def mailbox_etag(request, mailbox, *parts):
+    """
+    Strong ETag for a response built only from the local store: it changes whenever a sync
+    moves the mailbox to a new Gmail historyId, and differs per user, query and output format.
+    """
+    if not mailbox or not mailbox.history_id:
+        return None
+    renderer = getattr(request, 'accepted_renderer', None)
+    key = [mailbox.user_id, mailbox.history_id, renderer.format if renderer else 'json', is_list_mode(request), *parts]
+    return quote_etag(hashlib.sha256(repr(key).encode()).hexdigest()[:32])
+
+
+def etag_matches(request, etag):
+    """
+    True if the request's If-None-Match already holds `etag`.
+    """
+    header = request.headers.get('If-None-Match')
+    if not etag or not header:
+        return False
+    tags = parse_etags(header)
+    return '*' in tags or etag in [tag.removeprefix('W/') for tag in tags]
+
+
+def not_modified(request, etag):
+    """
+    304 response if the request's If-None-Match already holds `etag`, else None.
+    """
+    if etag_matches(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return None
+
+
+def complete_etag(etag, messages, include_body):
+    """
+    `etag`, unless a body the response should carry could not be loaded: an incomplete
+    answer must not be cached and revalidated as if it were whole.
+    """
+    if include_body and not all(message.body_loaded for message in messages):
+        return None
+    return etag
+
+
+def with_etag(response, etag):
+    if etag:
+        response['ETag'] = etag
+    return response
+
+
+def send_error(to, subject, body, thread_id):
+    """
+    Validation message for one outgoing email, or None if it can be queued.
+    """
+    if not to or not body:
+        return 'Both "to" and "body" are required'
+    if not subject and not thread_id:
+        return 'Either "subject" or "thread_id" is required'
+    return None
+
+
+def queue_email(user, data, idempotency_key=None):
+    """
+    Validate one outgoing email and queue it in the outbox. Returns (response data, status code).
+    Delivery happens in `manage.py send_worker`; the client polls the status URL.
+    """
+    to = data.get('to')
+    subject = data.get('subject')
+    body = data.get('body')
+    thread_id = data.get('thread_id')
+
+    error = send_error(to, subject, body, thread_id)
+    if error:
+        return {'error': error}, status.HTTP_400_BAD_REQUEST
+
+    item, created = enqueue_email(user, to, subject, body, thread_id, idempotency_key)
+    if not created and not item.matches(to, subject, body, thread_id):
+        return {'error': IDEMPOTENCY_CONFLICT}, status.HTTP_409_CONFLICT
+
+    result = item.as_dict()
+    result['status_url'] = reverse('send_status', args=[item.pk])
+    return result, status.HTTP_202_ACCEPTED
+
+
+def render_batch(data):
+    """
+    Expand a /api/send/batch/ payload into ([(index, message dict)], {index: error}).
+    Accepts {"messages": [...]} or {"template": {"subject", "body"}, "recipients": [{"to", "variables"}]};
+    templates use $name / ${name} placeholders.
+    """
+    template = data.get('template')
+    items = (data.get('recipients') if template else data.get('messages')) or []
+    if template:
+        subject = Template(template.get('subject') or '')
+        body = Template(template.get('body') or '')
+
+    messages, errors = [], {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = 'Each message must be an object'
+            continue
+        if template:
+            if not isinstance(item.get('variables') or {}, dict):
+                errors[index] = '"variables" must be an object'
+                continue
+            variables = dict(item.get('variables') or {}, to=item.get('to'))
+            try:
+                item = dict(
+                    item,
+                    subject=subject.substitute(variables),
+                    body=body.substitute(variables),
+                    thread_id=item.get('thread_id') or template.get('thread_id'),
+                )
+            except (KeyError, ValueError) as exc:
+                errors[index] = f'Template variable {exc} is missing or invalid'
+                continue
+        error = send_error(item.get('to'), item.get('subject'), item.get('body'), item.get('thread_id'))
+        if error:
+            errors[index] = error
+        else:
+            messages.append((index, item))
+    return messages, errors
+
+
+def latest_messages(messages):
+    """
+    The newest MESSAGE_LIMIT messages of a queryset, oldest first.
+    """
+    return sorted(
+        messages.select_related('thread').order_by('-internal_date')[:MESSAGE_LIMIT],
+        key=lambda m: m.internal_date,
+    )
+
+
+def stored_messages(request, user, etag_parts=(), background=None, **filters):
+    """
+    Sync `user`'s mailbox (see ensure_synced) and pick the newest stored messages matching `filters`.
+    Returns (messages, response data, status code, etag); messages is None when the answer is
+    already decided: 202 or 400 with `data`, or 304.
+    """
+    try:
+        mailbox = ensure_synced(user, background)
+    except SyncPending as exc:
+        return None, {'message': str(exc)}, status.HTTP_202_ACCEPTED, None
+    except GmailAPIError as exc:
+        return None, {'error': str(exc)}, status.HTTP_400_BAD_REQUEST, None
+
+    etag = mailbox_etag(request, mailbox, *etag_parts)
+    if etag_matches(request, etag):
+        return None, None, status.HTTP_304_NOT_MODIFIED, etag
+    return latest_messages(Message.objects.filter(user=user, **filters)), None, status.HTTP_200_OK, etag
+
+
+def local_threads(request, user, etag_parts=(), **filters):
+    """
+    Group the messages picked by stored_messages by thread, loading missing bodies.
+    Returns (response data, status code, etag); the data is None when the answer is 304.
+    """
+    messages, data, code, etag = stored_messages(request, user, etag_parts, **filters)
+    if messages is None:
+        return data, code, etag
+
+    include_body = not is_list_mode(request)
+    try:
+        if include_body:
+            load_bodies(user, messages)
+    except GmailAPIError as exc:
+        return {'error': str(exc)}, status.HTTP_400_BAD_REQUEST, None
+    return group_threads(messages, include_body), status.HTTP_200_OK, complete_etag(etag, messages, include_body)
+
+
+def stream_threads(user, messages, include_body=True):
+    """
+    Stream every thread of a Message queryset as NDJSON, one thread per line, newest thread first.
+    Missing bodies are loaded STREAM_CHUNK threads at a time.
+    """
+    groups = iter_thread_groups(messages.order_by('-thread__last_message_at', 'thread_id', 'internal_date'))
+
+    def lines():
+        while True:
+            chunk = list(islice(groups, STREAM_CHUNK))
+            if not chunk:
+                return
+            if include_body:
+                try:
+                    load_bodies(user, [message for _, thread_messages in chunk for message in thread_messages])
+                except GmailAPIError as exc:
+                    yield ndjson_line({'error': str(exc)})
+                    return
+            for thread, thread_messages in chunk:
+                yield ndjson_line(thread.as_dict(thread_messages, include_body))
+
+    return StreamingHttpResponse(lines(), content_type=NDJSONRenderer.media_type)
 
 
 class DashboardView(APIView):
@@ -18,7 +238,11 @@ class DashboardView(APIView):
             },
             "endpoints": {
                 "fetch_threads": "/api/threads/",
+                "thread_detail": "/api/threads/<thread_id>/",
+                "message_detail": "/api/messages/<message_id>/",
                 "send_email": "/api/send/",
+                "send_status": "/api/send/<id>/",
+                "send_batch": "/api/send/batch/",
                 "inbox": "/api/inbox/"
             }
         })
@@ -32,48 +256,212 @@ class EmailThreadView(APIView):
         if not sender:
             return Response({'error': 'Email is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        threads = fetch_email_threads(request.user, sender)
-        if 'error' in threads:
-            return Response(threads, status=status.HTTP_400_BAD_REQUEST)
+        # A read-only query despite being a POST, so a matching If-None-Match is answered with 304.
+        data, code, etag = local_threads(request, request.user, [sender], from_email__icontains=sender)
+        return with_etag(Response(data, status=code), etag)
+
+
+class ThreadDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, thread_id):
+        thread = Thread.objects.filter(user=request.user, gmail_id=thread_id).first()
+        if not thread:
+            return Response({'error': 'Thread not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        messages = list(thread.messages.select_related('thread').order_by('internal_date'))
+        try:
+            load_bodies(request.user, messages)
+        except GmailAPIError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(thread.as_dict(messages))
+
+
+class MessageDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, message_id):
+        message = Message.objects.filter(user=request.user, gmail_id=message_id).select_related('thread').first()
+        if not message:
+            return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        return Response(threads)
+        try:
+            load_bodies(request.user, [message])
+        except GmailAPIError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(message.as_dict())
 
 
 class SendEmailView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        to = request.data.get('to')
-        subject = request.data.get('subject')
-        body = request.data.get('body')
-        thread_id = request.data.get('thread_id')
-
-        if not to or not body:
-            return Response({'error': 'Both "to" and "body" are required'}, status=status.HTTP_400_BAD_REQUEST)
-
-        if not subject and not thread_id:
-            return Response({'error': 'Either "subject" or "thread_id" is required'}, status=status.HTTP_400_BAD_REQUEST)
-
-        result = send_email(
-            user=request.user,
-            to=to,
-            subject=subject,
-            body=body,
-            thread_id=thread_id
-        )
+        data, code = queue_email(request.user, request.data, request.headers.get('Idempotency-Key'))
+        return Response(data, status=code)
 
-        if 'error' in result:
-            return Response(result, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(result)
+class BatchSendView(APIView):
+    """
+    Queue up to SEND_BATCH_LIMIT messages in one request. With an Idempotency-Key header, item i
+    is stored under "<key>:<i>" (unless it has its own idempotency_key), so a retried request
+    does not queue anything twice. Answers 202 with one result per item, in request order.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if not isinstance(request.data, dict) or not isinstance(request.data.get('template') or {}, dict):
+            return Response({'error': 'Expected a JSON object'}, status=status.HTTP_400_BAD_REQUEST)
+        items = request.data.get('recipients') if request.data.get('template') else request.data.get('messages')
+        if not isinstance(items or [], list):
+            return Response({'error': 'Expected a list of messages or recipients'}, status=status.HTTP_400_BAD_REQUEST)
+        # Reject oversized batches before rendering any of them.
+        if len(items or []) > SEND_BATCH_LIMIT:
+            return Response({'error': f'At most {SEND_BATCH_LIMIT} messages per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        messages, errors = render_batch(request.data)
+        total = len(messages) + len(errors)
+        if not total:
+            return Response({'error': 'Either "messages" or "template" and "recipients" is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        key = request.headers.get('Idempotency-Key')
+        outgoing = [
+            dict(item, idempotency_key=item.get('idempotency_key') or (f'{key}:{index}' if key else None))
+            for index, item in messages
+        ]
+        results = [{'index': index, 'error': error} for index, error in errors.items()]
+        accepted = 0
+        for (index, message), (item, created) in zip(messages, enqueue_emails(request.user, outgoing)):
+            if not created and not item.matches(
+                message['to'], message.get('subject'), message['body'], message.get('thread_id'),
+            ):
+                results.append({'index': index, 'error': IDEMPOTENCY_CONFLICT})
+                continue
+            accepted += 1
+            results.append({
+                'index': index,
+                'id': item.pk,
+                'status': item.status,
+                'status_url': reverse('send_status', args=[item.pk]),
+            })
+        results.sort(key=lambda result: result['index'])
+
+        code = status.HTTP_202_ACCEPTED if accepted else status.HTTP_400_BAD_REQUEST
+        return Response({'accepted': accepted, 'rejected': total - accepted, 'results': results}, status=code)
+
+
+class SendStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, outbox_id):
+        item = OutgoingEmail.objects.filter(user=request.user, pk=outbox_id).first()
+        if not item:
+            return Response({'error': 'Outgoing email not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(item.as_dict())
 
 
 class InboxView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
 
     def get(self, request):
         user = request.user
-        inbox_threads = fetch_all_inbox_emails(user)
-        if 'error' in inbox_threads:
-            return Response(inbox_threads, status=status.HTTP_400_BAD_REQUEST)
-        return Response(inbox_threads)
+        try:
+            mailbox = ensure_synced(user)
+        except SyncPending as exc:
+            return Response({'message': str(exc)}, status=status.HTTP_202_ACCEPTED)
+        except GmailAPIError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        messages = Message.objects.filter(user=user, is_inbox=True)
+        include_body = not is_list_mode(request)
+        if request.accepted_renderer.format == NDJSONRenderer.format:
+            # No ETag: the stream may end with an error line after its headers went out.
+            return stream_threads(user, messages, include_body)
+
+        etag = mailbox_etag(request, mailbox)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        try:
+            latest = latest_messages(messages)
+            if include_body:
+                load_bodies(user, latest)
+            return with_etag(Response(group_threads(latest, include_body)), complete_etag(etag, latest, include_body))
+        except GmailAPIError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncGmailView(View):
+    """
+    Base for the async endpoints served under ASGI. They answer from the same local store,
+    ETags and outbox as the sync views, but never sync inline: a stale mailbox is queued for
+    the sync worker whatever GMAIL_BACKGROUND_SYNC says. Missing bodies are fetched with the
+    async client, concurrently up to GMAIL_ASYNC_CONCURRENCY per user, so a slow request
+    holds no thread while it waits on Gmail.
+    """
+
+    async def authenticated_user(self, request):
+        # The social auth backends have no async get_user, so resolve request.user in a thread.
+        return await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+
+    def forbidden(self):
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_403_FORBIDDEN)
+
+    def request_data(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError:
+                return {}
+            return data if isinstance(data, dict) else {}
+        return request.POST
+
+    async def threads_response(self, request, user, etag_parts=(), **filters):
+        messages, data, code, etag = await sync_to_async(stored_messages)(
+            request, user, etag_parts, background=True, **filters,
+        )
+        if code == status.HTTP_304_NOT_MODIFIED:
+            return with_etag(HttpResponse(status=code), etag)
+        if messages is None:
+            return JsonResponse(data, status=code)
+
+        include_body = not is_list_mode(request)
+        if include_body:
+            try:
+                await aload_bodies(user, messages)
+            except GmailAPIError as exc:
+                return JsonResponse({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return with_etag(JsonResponse(group_threads(messages, include_body)), complete_etag(etag, messages, include_body))
+
+
+class AsyncInboxView(AsyncGmailView):
+    async def get(self, request):
+        user = await self.authenticated_user(request)
+        if not user:
+            return self.forbidden()
+        return await self.threads_response(request, user, is_inbox=True)
+
+
+class AsyncEmailThreadView(AsyncGmailView):
+    async def post(self, request):
+        user = await self.authenticated_user(request)
+        if not user:
+            return self.forbidden()
+
+        sender = self.request_data(request).get('email')
+        if not sender:
+            return JsonResponse({'error': 'Email is required'}, status=status.HTTP_400_BAD_REQUEST)
+        return await self.threads_response(request, user, [sender], from_email__icontains=sender)
+
+
+class AsyncSendEmailView(AsyncGmailView):
+    async def post(self, request):
+        user = await self.authenticated_user(request)
+        if not user:
+            return self.forbidden()
+
+        data, code = await sync_to_async(queue_email)(
+            user, self.request_data(request), request.headers.get('Idempotency-Key'),
+        )
+        return JsonResponse(data, status=code)
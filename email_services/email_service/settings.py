@@ -178,3 +178,37 @@ AUTHENTICATION_BACKENDS = (
 SOCIAL_AUTH_GOOGLE_OAUTH2_EXTRA_DATA = ['email', 'first_name', 'last_name', 'access_token', 'refresh_token']
 SOCIAL_AUTH_GOOGLE_OAUTH2_USE_UNIQUE_USER_ID = True
 
+
+# Gmail API client
+GMAIL_API_URL = 'https://gmail.googleapis.com'
+GOOGLE_TOKEN_URL = 'https://oauth2.googleapis.com/token'
+TOKEN_EXPIRY_MARGIN = 60            # refresh access tokens this many seconds before they expire
+GMAIL_BATCH_SIZE = 50               # sub-requests per /batch/gmail/v1 call (Gmail allows up to 100)
+GMAIL_PAGE_SIZE = 100               # list page size when following nextPageToken
+GMAIL_SYNC_INTERVAL = 60            # seconds a synced mailbox is served without asking Gmail
+GMAIL_MAX_BODY_BYTES = 512 * 1024   # decoded message bodies are truncated to this size
+GMAIL_SYNC_QUERY = None             # optional search query limiting what the local store mirrors
+GMAIL_FULL_SYNC_RESUME_WINDOW = 86400  # seconds an interrupted full sync can resume from its checkpoint
+GMAIL_HTTP_POOL_SIZE = 20
+GMAIL_HTTP_CONNECT_TIMEOUT = 5
+GMAIL_HTTP_READ_TIMEOUT = 30
+GMAIL_HTTP_MAX_RETRIES = 4
+GMAIL_HTTP_BACKOFF_BASE = 0.5
+GMAIL_HTTP_BACKOFF_MAX = 32
+GMAIL_ASYNC_CONCURRENCY = 10        # concurrent Gmail calls per user on the async endpoints
+# With it on, views only read the local store: syncs and missing bodies are queued for
+# `manage.py sync_worker`. Off by default so a single runserver works without a worker;
+# deployments that run the worker should turn it on.
+GMAIL_BACKGROUND_SYNC = False
+GMAIL_SYNC_WORKER_CONCURRENCY = 4   # sync jobs a worker runs at the same time
+GMAIL_SYNC_LEASE = 300              # seconds a claimed job is reserved before another worker may take it
+GMAIL_SYNC_MAX_ATTEMPTS = 5         # a job is marked failed after this many attempts
+GMAIL_SYNC_RETRY_BASE = 30          # sync and send retry backoff doubles from this many seconds ...
+GMAIL_SYNC_RETRY_MAX = 3600         # ... up to this cap
+GMAIL_PREFETCH_BODIES = 100         # newest inbox messages whose bodies the worker loads ahead of time
+GMAIL_SEND_WORKER_CONCURRENCY = 4   # outbox messages `manage.py send_worker` delivers at the same time
+GMAIL_SEND_MAX_ATTEMPTS = 8         # an outbox message is marked failed after this many attempts
+GMAIL_RATE_LIMIT = 250              # Gmail quota units per user per second (Gmail's per-user limit); None disables
+GMAIL_RATE_LIMIT_BURST = 500        # units a user can spend at once after being idle
+GMAIL_RATE_LIMIT_STORAGE = 'email_api.ratelimit.SQLiteBucketStore'  # or ...MemoryBucketStore for one process
+GMAIL_RATE_LIMIT_PATH = BASE_DIR / 'ratelimit.sqlite3'              # bucket state shared by every process on the host
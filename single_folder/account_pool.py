@@ -0,0 +1,133 @@
+"""
+Run the same IMAP task across many mailboxes in parallel.
+
+Accounts come from a JSON registry (a list of objects with name, email, imap_server,
+imap_port and either password or password_env) or from the single account in .env.
+run_accounts() executes a task per account on a thread pool, never holding more than
+`per_host_limit` connections to any one IMAP host, and yields one result dict per account
+as soon as it finishes. A failing account yields an error result; the others carry on.
+
+    python account_pool.py accounts.json [--workers 32] [--per-host 8]
+"""
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import imapclient
+
+DEFAULT_WORKERS = 16
+# Providers throttle concurrent IMAP sessions per client IP; stay well below typical limits.
+DEFAULT_PER_HOST_LIMIT = 8
+CONNECT_TIMEOUT = 60
+
+
+def load_accounts(path):
+    """
+    Read the account registry; "password_env" names an environment variable holding the password.
+    """
+    with open(path, encoding="utf-8") as f:
+        accounts = json.load(f)
+    for account in accounts:
+        account.setdefault("name", account["email"])
+        account.setdefault("imap_port", 993)
+        account.setdefault("folder", "INBOX")
+        if "password" not in account:
+            account["password"] = os.environ[account["password_env"]]
+    return accounts
+
+
+def env_account(env):
+    """
+    The single account configured in .env, in registry form.
+    """
+    return {
+        "name": env("EMAIL"),
+        "email": env("EMAIL"),
+        "password": env("PASSWORD"),
+        "imap_server": env("IMAP_SERVER"),
+        "imap_port": int(env("IMAP_PORT")),
+        "folder": "INBOX",
+    }
+
+
+def connect(account):
+    client = imapclient.IMAPClient(
+        account["imap_server"], int(account["imap_port"]), ssl=True,
+        timeout=account.get("timeout", CONNECT_TIMEOUT),
+    )
+    try:
+        client.login(account["email"], account["password"])
+    except Exception:
+        client.shutdown()
+        raise
+    return client
+
+
+class HostLimiter:
+    """
+    One semaphore per IMAP host, created on first use.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, host):
+        host = host.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+def _run_one(account, task, limiter):
+    result = {"account": account["name"]}
+    try:
+        with limiter(account["imap_server"]):
+            imap = connect(account)
+            try:
+                imap.select_folder(account.get("folder", "INBOX"))
+                result.update(status="ok", result=task(account, imap))
+            finally:
+                try:
+                    imap.logout()
+                except Exception:
+                    imap.shutdown()
+    except Exception as exc:
+        result.update(status="error", error=f"{type(exc).__name__}: {exc}")
+    return result
+
+
+def run_accounts(accounts, task, workers=DEFAULT_WORKERS, per_host_limit=DEFAULT_PER_HOST_LIMIT):
+    """
+    Call `task(account, imap)` for every account with a logged-in, folder-selected connection.
+    Yields {"account", "status": "ok", "result"} or {"account", "status": "error", "error"}
+    in completion order.
+    """
+    limiter = HostLimiter(per_host_limit)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_run_one, account, task, limiter) for account in accounts]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def unseen_count(account, imap):
+    return {"unseen": len(imap.search(['UNSEEN']))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count unread mail across every account in a registry.")
+    parser.add_argument("accounts", help="JSON account registry")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST_LIMIT)
+    args = parser.parse_args()
+
+    for result in run_accounts(load_accounts(args.accounts), unseen_count, args.workers, args.per_host):
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark the local JWZ threading pass on a synthetic mailbox.
+
+    python bench_threading.py [--messages 100000] [--seed 42]
+
+Conversations of 1-30 messages are generated with branching reply trees, trimmed or
+missing References headers, subjects shared by unrelated conversations and "Fwd: Re:"
+prefixes, in shuffled UID order. The pass is timed at several mailbox sizes to show that
+it scales near-linearly, and every conversation is checked to come back as exactly one thread.
+"""
+import argparse
+import random
+import time
+
+from conversations import jwz_thread
+
+SUBJECTS = ["Weekly sync", "Invoice", "Project update", "Lunch?", "Release notes", "Question"]
+PREFIXES = ["", "Re: ", "RE: ", "Fwd: Re: ", "Re: Re: ", "AW: "]
+
+
+def synthetic_mailbox(total, seed=42):
+    rng = random.Random(seed)
+    messages, truth = [], []
+    conversation = 0
+    while len(messages) < total:
+        size = min(rng.randint(1, 30), total - len(messages))
+        subject = f"{rng.choice(SUBJECTS)} #{rng.randint(1, total // 50 or 1)}"
+        ids = []
+        for position in range(size):
+            message_id = f"<{conversation}.{position}@example.com>"
+            references = []
+            if position:
+                parent = rng.randrange(position)
+                references = ids[parent][1] + [ids[parent][0]]
+            ids.append((message_id, references))
+            messages.append({
+                "message_id": message_id,
+                "in_reply_to": references[-1:],
+                # Some clients only send In-Reply-To or trim long References headers.
+                "references": references[-rng.choice([1, 3, 10]):] if rng.random() < 0.9 else [],
+                "subject": (rng.choice(PREFIXES[1:]) if position else "") + subject,
+            })
+            truth.append(conversation)
+        conversation += 1
+
+    order = list(range(len(messages)))
+    rng.shuffle(order)
+    for uid, index in enumerate(order, start=1):
+        messages[index]["uid"] = uid
+    return messages, truth
+
+
+def check(messages, truth, threads):
+    thread_of = {uid: position for position, thread in enumerate(threads) for uid in thread}
+    placed = {}
+    for message, conversation in zip(messages, truth):
+        thread = thread_of[message["uid"]]
+        if placed.setdefault(conversation, thread) != thread:
+            raise AssertionError(f"conversation {conversation} was split")
+    if len(set(placed.values())) != len(placed):
+        raise AssertionError("unrelated conversations were merged")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'messages':>10}{'threads':>10}{'seconds':>10}{'msgs/s':>12}")
+    for total in (args.messages // 10, args.messages // 2, args.messages):
+        messages, truth = synthetic_mailbox(total, args.seed)
+        start = time.perf_counter()
+        threads = jwz_thread(messages)
+        elapsed = time.perf_counter() - start
+        check(messages, truth, threads)
+        print(f"{total:>10}{len(threads):>10}{elapsed:>10.2f}{total / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
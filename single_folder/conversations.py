@@ -0,0 +1,199 @@
+"""
+Conversation threading for an IMAP folder.
+
+thread_uids() uses the best method the server offers:
+
+* "gmail"       - Gmail's X-GM-THRID thread ids (X-GM-EXT-1 capability)
+* "references"  - the server-side THREAD=REFERENCES command
+* "jwz"         - a local JWZ-style pass over Message-ID / In-Reply-To / References,
+                  fetched as headers only
+
+The local pass links each message under its nearest referenced ancestor, then attaches
+orphaned threads (root missing or itself a "Re: ...") to the thread with the same
+normalised subject. Two complete threads are never merged just because their subjects match. Apart from the ancestor
+walk used for loop detection, every step is linear in the number of messages.
+"""
+import re
+from collections import defaultdict
+
+from imap_fetch import DEFAULT_CHUNK_SIZE, header_fetch_item, iter_fetch, parse_headers, uid_ranges
+
+THREAD_HEADER_FIELDS = ("MESSAGE-ID", "IN-REPLY-TO", "REFERENCES", "SUBJECT")
+
+# Any run of reply/forward prefixes, including localised and counted forms: "Re: Fwd: RE[2]: AW:".
+_REPLY_PREFIXES = re.compile(r'^\s*(?:(?:re|fwd?|aw|wg|sv|vs|antw)\s*(?:\[\d+\]|\(\d+\))?\s*:\s*)+', re.IGNORECASE)
+_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+
+
+def normalize_subject(subject):
+    """
+    Strip every leading Re:/Fwd: style prefix and collapse whitespace.
+    """
+    return ' '.join(_REPLY_PREFIXES.sub('', subject or '').split())
+
+
+def is_reply_subject(subject):
+    return bool(_REPLY_PREFIXES.match(subject or ''))
+
+
+def message_ids(value):
+    return _MESSAGE_ID.findall(str(value or ''))
+
+
+def thread_method(imap):
+    capabilities = imap.capabilities()
+    if b'X-GM-EXT-1' in capabilities:
+        return "gmail"
+    if b'THREAD=REFERENCES' in capabilities:
+        return "references"
+    return "jwz"
+
+
+def thread_uids(imap, uids, method=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Group `uids` of the selected folder into conversations.
+    Returns a list of threads, each a list of UIDs in ascending order.
+    """
+    uids = sorted(set(uids))
+    if not uids:
+        return []
+    method = method or thread_method(imap)
+    if method == "gmail":
+        return _gmail_threads(imap, uids, chunk_size)
+    if method == "references":
+        return _server_threads(imap, uids)
+    return jwz_thread(iter_thread_headers(imap, uids, chunk_size))
+
+
+def _gmail_threads(imap, uids, chunk_size):
+    threads = defaultdict(list)
+    for uid, fetched in iter_fetch(imap, uids, ['X-GM-THRID'], chunk_size):
+        threads[fetched[b'X-GM-THRID']].append(uid)
+    return list(threads.values())
+
+
+def _flatten(node):
+    stack, flat = [node], []
+    while stack:
+        item = stack.pop()
+        if isinstance(item, (tuple, list)):
+            stack.extend(reversed(item))
+        else:
+            flat.append(item)
+    return flat
+
+
+def _server_threads(imap, uids):
+    wanted = set(uids)
+    threads = []
+    for root in imap.thread('REFERENCES', ['UID', ','.join(uid_ranges(uids))]):
+        thread = sorted(uid for uid in _flatten(root) if uid in wanted)
+        if thread:
+            threads.append(thread)
+    return threads
+
+
+def iter_thread_headers(imap, uids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the header dicts jwz_thread() expects, fetched without setting \\Seen.
+    """
+    for uid, fetched in iter_fetch(imap, uids, [header_fetch_item(THREAD_HEADER_FIELDS)], chunk_size):
+        headers = parse_headers(fetched)
+        yield {
+            "uid": uid,
+            "message_id": next(iter(message_ids(headers.get('Message-ID'))), None),
+            "in_reply_to": message_ids(headers.get('In-Reply-To')),
+            "references": message_ids(headers.get('References')),
+            "subject": str(headers.get('Subject', '')),
+        }
+
+
+class Container:
+    __slots__ = ("message", "parent", "children")
+
+    def __init__(self):
+        self.message = None
+        self.parent = None
+        self.children = []
+
+    def is_ancestor_of(self, other):
+        while other is not None:
+            if other is self:
+                return True
+            other = other.parent
+        return False
+
+    def set_parent(self, parent):
+        if self.parent is not None:
+            self.parent.children.remove(self)
+        self.parent = parent
+        parent.children.append(self)
+
+
+def jwz_thread(messages):
+    """
+    Thread header dicts (uid, message_id, in_reply_to, references, subject) into conversations.
+    Returns a list of threads, each a list of UIDs in ascending order.
+    """
+    containers = {}
+
+    for message in messages:
+        message_id = message["message_id"]
+        container = containers.get(message_id) if message_id else None
+        if container is None or container.message is not None:
+            # New, missing or duplicate Message-ID: the duplicate gets a container of its own.
+            container = Container()
+            key = message_id if message_id not in containers else None
+            containers[key or ("uid", message["uid"])] = container
+        container.message = message
+
+        references = list(message["references"])
+        for reply_to in message["in_reply_to"][-1:]:
+            if not references or references[-1] != reply_to:
+                references.append(reply_to)
+
+        parent = None
+        for reference in references:
+            ref_container = containers.get(reference)
+            if ref_container is None:
+                ref_container = containers[reference] = Container()
+            if (parent is not None and ref_container.parent is None
+                    and not ref_container.is_ancestor_of(parent)):
+                ref_container.set_parent(parent)
+            parent = ref_container
+
+        # The message's own References are authoritative for its parent.
+        if parent is not None and not container.is_ancestor_of(parent):
+            container.set_parent(parent)
+
+    threads = []
+    for root in containers.values():
+        if root.parent is not None:
+            continue
+        thread, stack = [], [root]
+        while stack:
+            node = stack.pop()
+            if node.message is not None:
+                thread.append(node.message)
+            stack.extend(node.children)
+        if thread:
+            # A thread is orphaned when its root message is missing or is itself a reply.
+            orphaned = root.message is None or is_reply_subject(root.message["subject"])
+            subject = normalize_subject((root.message or thread[0])["subject"])
+            threads.append((subject, orphaned, thread))
+
+    # Orphaned threads join the thread with the same subject; complete threads are never merged.
+    by_subject = {}
+    for subject, orphaned, thread in threads:
+        if subject and not orphaned:
+            by_subject.setdefault(subject, thread)
+    merged = []
+    for subject, orphaned, thread in threads:
+        if subject and orphaned:
+            target = by_subject.setdefault(subject, thread)
+            if target is not thread:
+                target.extend(thread)
+                continue
+        merged.append(thread)
+
+    return sorted((sorted(m["uid"] for m in thread) for thread in merged), key=lambda uids: uids[0])
@@ -0,0 +1,115 @@
+"""
+Non-interactive command line for the toolkit operations, writing one JSON object per line.
+
+    python email_cli.py read [--all] [--from ADDRESS] [--limit N]
+    python email_cli.py threads [--with-bodies]
+    python email_cli.py senders [--from ADDRESS]
+
+Messages are fetched in chunks and written as they arrive, so memory stays flat however
+large the mailbox is, and the output can be piped straight into jq or another tool.
+Nothing is marked as read. Connection settings come from the same .env as the toolkits.
+"""
+import argparse
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from email.utils import parseaddr
+from pathlib import Path
+
+import environ
+
+from account_pool import connect, env_account
+from conversations import thread_uids
+from email_parsing import parse_email_data
+from imap_fetch import DEFAULT_CHUNK_SIZE, iter_fetch, iter_headers
+
+ENV_FILE = Path(__file__).resolve().parent.parent / ".env"
+
+
+def emit(obj):
+    sys.stdout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+
+def search_criteria(args):
+    criteria = ['ALL'] if args.all else ['UNSEEN']
+    if getattr(args, 'sender', None):
+        criteria += ['FROM', args.sender]
+    return criteria
+
+
+def read_messages(imap, args):
+    uids = imap.search(search_criteria(args))
+    if args.limit:
+        uids = sorted(uids)[-args.limit:]
+    for uid, fetched in iter_fetch(imap, uids, ['BODY.PEEK[]', 'INTERNALDATE'], args.chunk_size):
+        emit(parse_email_data(uid, fetched))
+
+
+def list_threads(imap, args):
+    threads = thread_uids(imap, imap.search(['ALL']), chunk_size=args.chunk_size)
+    for offset in range(0, len(threads), args.chunk_size):
+        batch = threads[offset:offset + args.chunk_size]
+        subjects = {uid: str(headers.get('Subject', '')) for uid, headers in
+                    iter_headers(imap, [thread[0] for thread in batch], ("SUBJECT",), args.chunk_size)}
+        for position, thread in enumerate(batch, start=offset):
+            line = {"thread": position, "subject": subjects.get(thread[0], ""), "uids": thread}
+            if args.with_bodies:
+                messages = [parse_email_data(uid, fetched) for uid, fetched in
+                            iter_fetch(imap, thread, ['BODY.PEEK[]', 'INTERNALDATE'], args.chunk_size)]
+                line["messages"] = sorted(messages, key=lambda x: x['date'])
+            emit(line)
+
+
+def group_by_sender(imap, args):
+    criteria = ['FROM', args.sender] if args.sender else ['ALL']
+    subjects = defaultdict(Counter)
+    for uid, headers in iter_headers(imap, imap.search(criteria), chunk_size=args.chunk_size):
+        sender = parseaddr(str(headers.get('From', '')))[1].lower()
+        subjects[sender][str(headers.get('Subject', '')).strip()] += 1
+    for sender, counts in subjects.items():
+        emit({"sender": sender, "total": sum(counts.values()), "subjects": dict(counts)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read, thread and group mail as JSON lines.")
+    parser.add_argument("--folder", default="INBOX")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    read = commands.add_parser("read", help="one line per message (unread only unless --all)")
+    read.add_argument("--all", action="store_true")
+    read.add_argument("--from", dest="sender")
+    read.add_argument("--limit", type=int, help="only the newest N messages")
+    read.set_defaults(handler=read_messages)
+
+    threads = commands.add_parser("threads", help="one line per conversation")
+    threads.add_argument("--with-bodies", action="store_true", help="include each thread's parsed messages")
+    threads.set_defaults(handler=list_threads)
+
+    senders = commands.add_parser("senders", help="one line per sender with message counts by subject")
+    senders.add_argument("--from", dest="sender")
+    senders.set_defaults(handler=group_by_sender)
+
+    args = parser.parse_args(argv)
+
+    env = environ.Env()
+    if ENV_FILE.exists():
+        environ.Env.read_env(ENV_FILE)
+    else:
+        raise Exception(f".env file not found! at {ENV_FILE}")
+
+    imap = connect(env_account(env))
+    try:
+        imap.select_folder(args.folder, readonly=True)
+        args.handler(imap, args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader (e.g. `head`) went away; silence the flush at interpreter exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        imap.logout()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 import os
 import environ
 from pathlib import Path
-import smtplib
 import imapclient
-import pyzmail
+from preview import iter_previews
+from smtp_sender import SMTPSender
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -33,26 +33,26 @@ imap = imapclient.IMAPClient(IMAP_SERVER, IMAP_PORT, ssl=True)
 imap.login(EMAIL, PASSWORD)
 imap.select_folder("INBOX")
 
+# SMTP (Sending Replies; connects on first use and stays open)
+sender = SMTPSender(SMTP_SERVER, SMTP_PORT, EMAIL, PASSWORD)
+
 # Find All Unread Emails
 UIDs = imap.search(['UNSEEN'])
 
-# Process Each Unread Email
-for uid in UIDs:
-    raw_message = imap.fetch([uid], ['BODY[]', 'FLAGS'])
-    message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
-    
+# Process Each Unread Email (preview only: the start of the text part, no attachments)
+for preview in iter_previews(imap, UIDs):
+    uid = preview['uid']
+
     # Extract Email Details
-    subject = message.get_subject()
-    from_name, from_email = message.get_addresses('from')[0]
-    body = ""
-    if message.text_part:
-        body = message.text_part.get_payload().decode(message.text_part.charset)
+    subject = preview['subject']
+    from_name, from_email = preview['from_name'], preview['sender']
+    body = preview['preview']
 
     # Display Email to User
     print("\n" + "-"*50)
     print(f"From: {from_name} <{from_email}>")
     print(f"Subject: {subject}")
-    print("Body Preview:\n", body[:500], "..." if len(body) > 500 else "")
+    print("Body Preview:\n", body[:500], "..." if preview['truncated'] or len(body) > 500 else "")
     
     # Prompt User to Reply
     choice = input("Do you want to reply to this email? (yes/no): ").strip().lower()
@@ -66,15 +66,16 @@ for uid in UIDs:
         msg['Subject'] = f"Re: {subject}"
         msg.attach(MIMEText(reply_text, 'plain'))
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL, PASSWORD)
-            server.sendmail(EMAIL, from_email, msg.as_string())
-        print("Reply sent.")
+        result = sender.send(msg, EMAIL, from_email)
+        if result["status"] == "sent":
+            print("Reply sent.")
+        else:
+            print("Reply failed:", result["error"])
 
     # Mark Email as Seen
     imap.add_flags([uid], [b'\\Seen'])
 
 # Logout
+sender.close()
 imap.logout()
 
@@ -2,7 +2,7 @@ import os
 import environ
 from pathlib import Path
 import imapclient
-import pyzmail
+from imap_fetch import iter_headers
 from collections import defaultdict
 
 # --- Environment Setup ---
@@ -39,11 +39,9 @@ else:
     subject_counts = defaultdict(int)
     
     # Process Each Unread Email
-    for uid in UIDs:
-        raw_message = imap.fetch([uid], ['BODY[]'])
-        message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
-        # Extract Email Details
-        subject = message.get_subject().strip()
+    for uid, headers in iter_headers(imap, UIDs):
+        # Only the Subject/From/Date headers are downloaded, and PEEK leaves \Seen unchanged
+        subject = str(headers.get('Subject', '')).strip()
         subject_counts[subject] += 1
 
     # Display Total Emails and Subjects
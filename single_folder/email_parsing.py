@@ -0,0 +1,50 @@
+"""
+Parsing helpers shared by the single_folder scripts; importing this module never connects.
+"""
+import sys
+from pathlib import Path
+
+import pyzmail
+
+from conversations import normalize_subject
+
+# The body cleaner is shared with the Django app and has no Django dependencies.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "email_services"))
+from email_api.cleaner import clean_email_body as clean_text
+
+
+def clean_email_body(message):
+    body = ""
+    if message.text_part:
+        try:
+            body = message.text_part.get_payload().decode(message.text_part.charset or "utf-8")
+        except:
+            body = message.text_part.get_payload().decode("utf-8", errors="replace")
+    elif message.html_part:
+        try:
+            body = message.html_part.get_payload().decode(message.html_part.charset or "utf-8")
+        except:
+            body = message.html_part.get_payload().decode("utf-8", errors="replace")
+
+    return clean_text(body)
+
+
+def parse_email_data(uid, fetched):
+    message = pyzmail.PyzMessage.factory(fetched[b'BODY[]'])
+    date_obj = fetched[b'INTERNALDATE']
+    date_str = date_obj.strftime("%Y-%m-%d %H:%M:%S")
+
+    subject_raw = message.get_subject()
+    subject_clean = normalize_subject(subject_raw)
+    from_name, from_email = message.get_addresses('from')[0]
+    body = clean_email_body(message)
+
+    return {
+        "uid": uid,
+        "date": date_str,
+        "from_name": from_name,
+        "sender": from_email,
+        "subject": subject_raw,
+        "subject_clean": subject_clean,
+        "body": body
+    }
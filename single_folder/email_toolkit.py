@@ -1,9 +1,10 @@
 import os
 import environ
 from pathlib import Path
-import smtplib
 import imapclient
-import pyzmail
+from smtp_sender import SMTPSender
+from imap_fetch import iter_headers
+from preview import iter_previews
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from collections import defaultdict
@@ -33,6 +34,9 @@ imap = imapclient.IMAPClient(IMAP_SERVER, IMAP_PORT, ssl=True)
 imap.login(EMAIL, PASSWORD)
 imap.select_folder("INBOX")
 
+# --- SMTP (Sending Replies; connects on first use and stays open) ---
+sender = SMTPSender(SMTP_SERVER, SMTP_PORT, EMAIL, PASSWORD)
+
 # --- Menu ---
 try:
     while True:
@@ -52,27 +56,20 @@ try:
             # Find All Unread Emails
             UIDs = imap.search(['UNSEEN'])
 
-            # Process Each Unread Email
-            for uid in UIDs:
-                raw_message = imap.fetch([uid], ['BODY[]', 'FLAGS'])
-                message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
+            # Process Each Unread Email (preview only: the start of the text part, no attachments)
+            for preview in iter_previews(imap, UIDs):
+                uid = preview['uid']
 
                 # Extract Email Details
-                subject = message.get_subject()
-                from_name, from_email = message.get_addresses('from')[0]
-                body = ""
-                if message.text_part:
-                    body = message.text_part.get_payload().decode(message.text_part.charset)
-                elif message.html_part:
-                    body = message.html_part.get_payload().decode(message.html_part.charset)
-                else:
-                    body = "(No text body found)"
+                subject = preview['subject']
+                from_name, from_email = preview['from_name'], preview['sender']
+                body = preview['preview'] or "(No text body found)"
 
                 # Display Email to User
                 print("\n" + "-"*50)
                 print(f"From: {from_name} <{from_email}>")
                 print(f"Subject: {subject}")
-                print("Body Preview:\n", body[:500], "..." if len(body) > 500 else "")
+                print("Body Preview:\n", body[:500], "..." if preview['truncated'] or len(body) > 500 else "")
 
                 # Prompt User to Reply
                 reply = input("Do you want to reply to this email? (yes/no): ").strip().lower()
@@ -86,11 +83,11 @@ try:
                     msg['Subject'] = f"Re: {subject}"
                     msg.attach(MIMEText(reply_text, 'plain'))
 
-                    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                        server.starttls()
-                        server.login(EMAIL, PASSWORD)
-                        server.sendmail(EMAIL, from_email, msg.as_string())
-                    print("Reply sent.")
+                    result = sender.send(msg, EMAIL, from_email)
+                    if result["status"] == "sent":
+                        print("Reply sent.")
+                    else:
+                        print("Reply failed:", result["error"])
 
                 # Mark Email as Read or Seen
                 imap.add_flags([uid], [b'\\Seen'])
@@ -111,11 +108,9 @@ try:
                 subject_counts = defaultdict(int)
                 
                 # Process Each Unread Email
-                for uid in UIDs:
-                    raw_message = imap.fetch([uid], ['BODY[]'])
-                    message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
-                    # Extract Email Details
-                    subject = message.get_subject().strip()
+                for uid, headers in iter_headers(imap, UIDs):
+                    # Only the Subject/From/Date headers are downloaded, and PEEK leaves \Seen unchanged
+                    subject = str(headers.get('Subject', '')).strip()
                     subject_counts[subject] += 1
 
                 # Display Total Emails and Subjects
@@ -136,4 +131,5 @@ try:
 
 # --- Logout ---
 finally:
+    sender.close()
     imap.logout()
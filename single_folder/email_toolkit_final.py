@@ -1,20 +1,26 @@
 import os
 import environ
 from pathlib import Path
-import smtplib
 import imapclient
-import pyzmail
+from smtp_sender import SMTPSender
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from collections import defaultdict
 import json
-import html
-import re
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 ENV_FILE = BASE_DIR / ".env"
 
+from account_pool import connect, env_account
+from email_parsing import parse_email_data
+from idle_watcher import IdleWatcher
+from imap_fetch import DEFAULT_CHUNK_SIZE, iter_fetch, iter_headers
+from message_cache import MessageCache, enable_sync_extensions
+from preview import PREVIEW_BYTES as DEFAULT_PREVIEW_BYTES, iter_previews
+from conversations import thread_uids
+from subject_index import SubjectIndex
+
 env = environ.Env()
 if ENV_FILE.exists():
     environ.Env.read_env(ENV_FILE)
@@ -27,69 +33,67 @@ IMAP_SERVER = env("IMAP_SERVER")
 IMAP_PORT = int(env("IMAP_PORT"))
 SMTP_SERVER = env("SMTP_SERVER")
 SMTP_PORT = int(env("SMTP_PORT"))
+FETCH_CHUNK_SIZE = env.int("FETCH_CHUNK_SIZE", default=DEFAULT_CHUNK_SIZE)
+PREVIEW_BYTES = env.int("PREVIEW_BYTES", default=DEFAULT_PREVIEW_BYTES)
+INDEX_PATH = env("INDEX_PATH", default=str(Path(__file__).resolve().parent / "subject_index.sqlite3"))
+CACHE_PATH = env("CACHE_PATH", default=str(Path(__file__).resolve().parent / "message_cache.sqlite3"))
+
+
+ACCOUNT = env_account(env)
+
 
+def connect_imap():
+    return connect(ACCOUNT)
 
-imap = imapclient.IMAPClient(IMAP_SERVER, IMAP_PORT, ssl=True)
-imap.login(EMAIL, PASSWORD)
+
+imap = connect_imap()
+sync_extensions = enable_sync_extensions(imap)
 imap.select_folder("INBOX")
+index = SubjectIndex(INDEX_PATH, account=EMAIL, folder="INBOX")
+cache = MessageCache(CACHE_PATH, account=EMAIL, folder="INBOX")
+# Replies share one SMTP connection, opened on first use.
+sender = SMTPSender(SMTP_SERVER, SMTP_PORT, EMAIL, PASSWORD)
+
 
+def sync_cache():
+    result = cache.sync(imap, sync_extensions, FETCH_CHUNK_SIZE)
+    print(f"Local cache: {result['new']} new, {result['flags']} flag change(s), {result['vanished']} removed.")
 
-def clean_email_body(message):
-    body = ""
-    if message.text_part:
-        try:
-            body = message.text_part.get_payload().decode(message.text_part.charset or "utf-8")
-        except:
-            body = message.text_part.get_payload().decode("utf-8", errors="replace")
-    elif message.html_part:
-        try:
-            body = message.html_part.get_payload().decode(message.html_part.charset or "utf-8")
-        except:
-            body = message.html_part.get_payload().decode("utf-8", errors="replace")
-
-    clean_body = body.replace('\r\n', '\n').replace('\xa0', ' ')
-    clean_body = html.unescape(clean_body)
-    clean_body = re.sub(r'<[^>]+>', '', clean_body)
-    clean_body = re.sub(r'\u2060', '', clean_body)
-    clean_body = re.sub(r'[ \t]+$', '', clean_body, flags=re.MULTILINE)
-    clean_body = re.sub(r'\n{3,}', '\n\n', clean_body)
-    clean_body = re.sub(r'-\s*\n\s*', '- ', clean_body)
-    clean_body = re.sub(r'^\s*[-•]+\s*$', '', clean_body, flags=re.MULTILINE)
-    clean_body = re.sub(r'\n\s*-\s*', '\n- ', clean_body)
-
-    return clean_body.strip()
+
+def iter_email_data(uids):
+    """
+    Stream parsed emails for `uids` from the local cache; anything not cached yet is
+    fetched FETCH_CHUNK_SIZE messages per round trip.
+    """
+    for uid, fetched in cache.iter_messages(uids):
+        yield parse_email_data(uid, fetched)
+    for uid, fetched in iter_fetch(imap, cache.missing(uids), ['BODY.PEEK[]', 'INTERNALDATE'], FETCH_CHUNK_SIZE):
+        yield parse_email_data(uid, fetched)
 
 
 def get_email_data(uid):
-    raw_message = imap.fetch([uid], ['BODY[]', 'INTERNALDATE'])
-    message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
-    date_obj = raw_message[uid][b'INTERNALDATE']
-    date_str = date_obj.strftime("%Y-%m-%d %H:%M:%S")
-
-    subject_raw = message.get_subject()
-    subject_clean = re.sub(r'^(Re:|Fwd:)\s*', '', subject_raw, flags=re.IGNORECASE).strip()
-    from_name, from_email = message.get_addresses('from')[0]
-    body = clean_email_body(message)
-
-    return {
-        "uid": uid,
-        "date": date_str,
-        "from_name": from_name,
-        "sender": from_email,
-        "subject": subject_raw,
-        "subject_clean": subject_clean,
-        "body": body
-    }
+    return next(iter_email_data([uid]), None)
+
+
+def print_new_email(watch_imap, uid, fetched):
+    email_data = parse_email_data(uid, fetched)
+    print("\n" + "-" * 50)
+    print(f"New email from: {email_data['from_name']} <{email_data['sender']}>")
+    print(f"Subject: {email_data['subject']}")
+    print(f"Date: {email_data['date']}")
+    print("Body Preview:\n", email_data['body'][:500], "..." if len(email_data['body']) > 500 else "")
 
 
 def get_thread_by_subject(subject_clean):
-    UIDs = imap.search(['ALL'])
-    thread = []
+    """
+    Look the thread up in the local subject index and fetch only its messages.
+    Call index.update(imap) first so recently arrived mail is included.
+    """
+    uids = index.uids_for_subject(subject_clean)
+    thread = list(iter_email_data(uids))
 
-    for uid in UIDs:
-        email_data = get_email_data(uid)
-        if email_data['subject_clean'] == subject_clean:
-            thread.append(email_data)
+    found = {email_data['uid'] for email_data in thread}
+    index.forget([uid for uid in uids if uid not in found])
 
     thread.sort(key=lambda x: x['date'])
     return thread
@@ -99,14 +103,15 @@ try:
     while True:
         print("Choose an option:")
         print("1. Read and reply to unread emails")
-        print("2. Show all conversation threads grouped by subject")
+        print("2. Show all conversation threads")
         print("3. Count emails from a specific sender and group by subject")
-        print("4. Exit")
+        print("4. Watch for new emails")
+        print("5. Exit")
 
-        choice = input("Enter your choice (1, 2, 3, or 4): ").strip()
+        choice = input("Enter your choice (1, 2, 3, 4, or 5): ").strip()
         
         if not choice:
-            print("Invalid option. Please enter a valid option: 1, 2, 3, or 4.")
+            print("Invalid option. Please enter a valid option: 1, 2, 3, 4, or 5.")
             continue
 
         if choice == "1":
@@ -114,18 +119,24 @@ try:
             if not UIDs:
                 print("No unread emails found.")
                 continue
+
+            print(f"Indexed {index.update(imap, FETCH_CHUNK_SIZE)} new message(s).")
             
-            for uid in UIDs:
-                email_data = get_email_data(uid)
-                
+            # Triage from previews: only the start of each text part is downloaded, and the
+            # full thread is fetched only when asked for.
+            for email_data in iter_previews(imap, UIDs, PREVIEW_BYTES, FETCH_CHUNK_SIZE):
+                uid = email_data['uid']
+
                 print("\n" + "-" * 50)
                 print(f"From: {email_data['from_name']} <{email_data['sender']}>")
                 print(f"Subject: {email_data['subject']}")
-                print("Fetching full thread...")
+                print("Body Preview:\n", email_data['preview'][:500], "..." if email_data['truncated'] or len(email_data['preview']) > 500 else "")
 
-                thread = get_thread_by_subject(email_data['subject_clean'])
-
-                print(json.dumps({email_data['subject_clean']: thread}, indent=4, ensure_ascii=False))
+                view = input("Do you want to see the full thread? (yes/no): ").strip().lower()
+                if view == "yes":
+                    print("Fetching full thread...")
+                    thread = get_thread_by_subject(email_data['subject_clean'])
+                    print(json.dumps({email_data['subject_clean']: thread}, indent=4, ensure_ascii=False))
 
                 reply = input("Do you want to reply to this email? (yes/no): ").strip().lower()
                 if reply == "yes":
@@ -137,11 +148,11 @@ try:
                     msg['Subject'] = f"Re: {email_data['subject']}"
                     msg.attach(MIMEText(reply_text, 'plain'))
 
-                    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                        server.starttls()
-                        server.login(EMAIL, PASSWORD)
-                        server.sendmail(EMAIL, email_data['sender'], msg.as_string())
-                    print("Reply sent.")
+                    result = sender.send(msg, EMAIL, email_data['sender'])
+                    if result["status"] == "sent":
+                        print("Reply sent.")
+                    else:
+                        print("Reply failed:", result["error"])
 
                 imap.add_flags([uid], [b'\\Seen'])
                 
@@ -150,22 +161,21 @@ try:
 
         elif choice == "2":
             print("Fetching all emails to build conversation threads...")
+            sync_cache()
 
             UIDs = imap.search(['ALL'])
             if not UIDs:
                 print("No emails found.")
             else:
-                threads = defaultdict(list)
-
-                for uid in UIDs:
-                    email_data = get_email_data(uid)
-                    threads[email_data['subject_clean']].append(email_data)
-                    
-                for thread  in threads.values():
-                    thread .sort(key=lambda x: x['date'])
-
+                # Threads come from the server (X-GM-THRID / THREAD) or from headers only.
+                # Each one is printed as soon as its messages are read from the local cache,
+                # so only one conversation is held in memory at a time.
                 print("\nConversation Threads:\n" + "="*80)
-                print(json.dumps(threads, indent=4, ensure_ascii=False))
+                for uids_in_thread in thread_uids(imap, UIDs, chunk_size=FETCH_CHUNK_SIZE):
+                    thread = sorted(iter_email_data(uids_in_thread), key=lambda x: x['date'])
+                    if thread:
+                        conversation = {"subject": thread[0]['subject_clean'], "messages": thread}
+                        print(json.dumps(conversation, indent=4, ensure_ascii=False))
 
             input("\nTask complete. Press Enter to return to menu...")
             
@@ -179,10 +189,8 @@ try:
             else:
                 subject_counts = defaultdict(int)
 
-                for uid in UIDs:
-                    raw_message = imap.fetch([uid], ['BODY[]'])
-                    message = pyzmail.PyzMessage.factory(raw_message[uid][b'BODY[]'])
-                    subject = message.get_subject().strip()
+                for uid, headers in iter_headers(imap, UIDs, chunk_size=FETCH_CHUNK_SIZE):
+                    subject = str(headers.get('Subject', '')).strip()
                     subject_counts[subject] += 1
 
                 print(f"\nTotal Emails from: {sender_email} = {len(UIDs)}")
@@ -195,12 +203,33 @@ try:
             
             
         elif choice == "4":
+            # IDLE runs on its own connection so the menu connection stays usable afterwards.
+            print("Watching INBOX for new emails. Press Ctrl+C to return to menu...")
+            watcher = IdleWatcher(connect_imap, print_new_email, chunk_size=FETCH_CHUNK_SIZE)
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                print("\nStopped watching.")
+
+            # The menu connection sat unused while watching and may have been timed out.
+            try:
+                imap.noop()
+            except (imapclient.exceptions.IMAPClientError, OSError):
+                imap = connect_imap()
+                sync_extensions = enable_sync_extensions(imap)
+                imap.select_folder("INBOX")
+
+
+        elif choice == "5":
             print("Goodbye!")
             os.system('cls' if os.name == 'nt' else 'clear')
             break
         
         else:
-            print("Invalid option. Please enter 1, 2, 3, or 4.")
+            print("Invalid option. Please enter 1, 2, 3, 4, or 5.")
             
 finally:
+    sender.close()
+    cache.close()
+    index.close()
     imap.logout()
@@ -0,0 +1,109 @@
+"""
+In-memory stand-in for an IMAPClient connection to one folder, for the single_folder tests.
+
+It answers select_folder(), search() and fetch() the way IMAPClient does, and UID FETCH over
+a sequence set (with CHANGEDSINCE and VANISHED) through a mocked imaplib connection, so the
+code under test sees the same shapes it gets from a real server.
+"""
+import imaplib
+import re
+from datetime import datetime
+from unittest import mock
+
+
+class FakeIMAP:
+    def __init__(self, capabilities=(b'IMAP4REV1',), condstore=False):
+        self._capabilities = capabilities
+        self.condstore = condstore
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = {}
+        self.expunged = []
+        self.commands = []
+        self.normalise_times = True
+        self._imap = mock.Mock(spec=imaplib.IMAP4)
+        self._imap.uid.side_effect = self._uid_fetch
+        self._imap.response.side_effect = self._response
+        self._vanished = []
+
+    def add(self, subject, sender='Alice <alice@example.com>', flags=(), body='Hello'):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        raw = f'Subject: {subject}\r\nFrom: {sender}\r\nDate: Mon, 1 Jan 2024 10:00:00 +0000\r\n\r\n{body}\r\n'.encode()
+        self.messages[uid] = {
+            'raw': raw, 'flags': tuple(flags), 'date': datetime(2024, 1, 1, 10, 0, uid % 60), 'modseq': self.modseq,
+        }
+        return uid
+
+    def set_flags(self, uid, flags):
+        self.modseq += 1
+        self.messages[uid].update(flags=tuple(flags), modseq=self.modseq)
+
+    def expunge(self, uid):
+        self.modseq += 1
+        del self.messages[uid]
+        self.expunged.append((uid, self.modseq))
+
+    def capabilities(self):
+        return self._capabilities
+
+    def noop(self):
+        self.commands.append(('NOOP',))
+        return b'NOOP completed', []
+
+    def logout(self):
+        self.commands.append(('LOGOUT',))
+
+    def select_folder(self, folder, readonly=False):
+        self.commands.append(('SELECT', folder))
+        status = {b'UIDVALIDITY': self.uidvalidity, b'UIDNEXT': self.uidnext, b'EXISTS': len(self.messages)}
+        if self.condstore:
+            status[b'HIGHESTMODSEQ'] = self.modseq
+        return status
+
+    def search(self, criteria):
+        self.commands.append(('SEARCH', tuple(criteria)))
+        if criteria == ['ALL']:
+            return sorted(self.messages)
+        if criteria == ['UNSEEN']:
+            return sorted(uid for uid, message in self.messages.items() if b'\\Seen' not in message['flags'])
+        start = int(criteria[1].split(':')[0])
+        # Like a real server, "n:*" also matches the highest UID when it is below n.
+        return sorted(uid for uid in self.messages if uid >= start) or sorted(self.messages)[-1:]
+
+    def _item(self, uid, name):
+        message = self.messages[uid]
+        if name == 'FLAGS':
+            return b'FLAGS', message['flags']
+        if name == 'INTERNALDATE':
+            return b'INTERNALDATE', message['date']
+        if name == 'BODY.PEEK[]':
+            return b'BODY[]', message['raw']
+        if name.startswith('BODY.PEEK[HEADER.FIELDS'):
+            return name.replace('.PEEK', '').encode(), message['raw'].split(b'\r\n\r\n')[0] + b'\r\n\r\n'
+        raise AssertionError(f"unexpected fetch item {name}")
+
+    def fetch(self, uids, data, modifiers=None):
+        self.commands.append(('FETCH', tuple(uids), tuple(data)))
+        return {uid: dict(self._item(uid, name) for name in data) for uid in uids if uid in self.messages}
+
+    def _uid_fetch(self, command, uid_set, data, modifiers=None):
+        self.commands.append(('UID FETCH', uid_set, data, modifiers))
+        low, _, high = uid_set.partition(':')
+        changedsince = int(re.search(r'CHANGEDSINCE (\d+)', modifiers or '').group(1)) if modifiers else 0
+        lines = [
+            f"{seq} (UID {uid} FLAGS ({' '.join(f.decode() for f in message['flags'])}) MODSEQ ({message['modseq']}))".encode()
+            for seq, (uid, message) in enumerate(sorted(self.messages.items()), start=1)
+            if int(low) <= uid <= int(high or low) and message['modseq'] > changedsince
+        ]
+        if modifiers and 'VANISHED' in modifiers:
+            gone = [str(uid) for uid, modseq in self.expunged if modseq > changedsince]
+            if gone:
+                self._vanished.append(f"(EARLIER) {','.join(gone)}".encode())
+        return 'OK', lines or [None]
+
+    def _response(self, name):
+        vanished, self._vanished = self._vanished, []
+        return name, vanished or [None]
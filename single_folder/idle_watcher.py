@@ -0,0 +1,115 @@
+"""
+Long-running new-mail watcher built on IMAP IDLE.
+
+The watcher remembers the highest UID it has handed out and, whenever the server reports
+new messages, fetches only the UIDs above it and passes each one to a handler. Servers
+without IDLE are polled with NOOP instead. IDLE is renewed well before the 29 minute
+limit in RFC 2177, and dropped connections are re-established with backoff, picking up
+any mail that arrived in between.
+"""
+import time
+
+from imapclient.exceptions import IMAPClientError
+
+from imap_fetch import DEFAULT_CHUNK_SIZE, iter_fetch
+
+# Renew IDLE after this long; many NAT gateways drop silent connections after ~10 minutes.
+IDLE_RENEW_SECONDS = 9 * 60
+IDLE_CHECK_SECONDS = 30
+NOOP_POLL_SECONDS = 30
+RECONNECT_MAX_DELAY = 60
+
+# PEEK so that watching does not mark anything as read; the handler decides that.
+DEFAULT_FETCH_ITEMS = ['BODY.PEEK[]', 'INTERNALDATE']
+
+
+class IdleWatcher:
+    def __init__(self, connect, handler, folder="INBOX", fetch_items=DEFAULT_FETCH_ITEMS,
+                 chunk_size=DEFAULT_CHUNK_SIZE, renew_after=IDLE_RENEW_SECONDS,
+                 poll_interval=NOOP_POLL_SECONDS):
+        """
+        `connect()` must return a logged-in IMAPClient; it is called again after a disconnect.
+        `handler(imap, uid, fetched)` is called once per new message, in UID order.
+        """
+        self.connect = connect
+        self.handler = handler
+        self.folder = folder
+        self.fetch_items = fetch_items
+        self.chunk_size = chunk_size
+        self.renew_after = renew_after
+        self.poll_interval = poll_interval
+        self.uidvalidity = None
+        self.last_uid = None
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        """
+        Watch until stop() is called or the process is interrupted.
+        """
+        failures = 0
+        while not self.stopped:
+            imap = None
+            try:
+                imap = self.connect()
+                self._select(imap)
+                failures = 0
+                while not self.stopped:
+                    self.process_new(imap)
+                    self.wait(imap)
+            except (IMAPClientError, OSError) as exc:
+                failures += 1
+                delay = min(2 ** (failures - 1), RECONNECT_MAX_DELAY)
+                print(f"IMAP connection lost ({exc}); reconnecting in {delay}s")
+                time.sleep(delay)
+            finally:
+                if imap is not None:
+                    try:
+                        imap.logout()
+                    except (IMAPClientError, OSError):
+                        pass
+
+    def _select(self, imap):
+        status = imap.select_folder(self.folder)
+        uidvalidity = status[b'UIDVALIDITY']
+        if self.last_uid is None or uidvalidity != self.uidvalidity:
+            # Start from "now"; old UIDs mean nothing under a new UIDVALIDITY.
+            self.last_uid = status[b'UIDNEXT'] - 1
+        self.uidvalidity = uidvalidity
+
+    def process_new(self, imap):
+        """
+        Fetch messages above the last handled UID and pass them to the handler.
+        """
+        # "n:*" always matches the highest UID, even when it is below n.
+        uids = [uid for uid in imap.search(['UID', f"{self.last_uid + 1}:*"]) if uid > self.last_uid]
+        for uid, fetched in iter_fetch(imap, uids, self.fetch_items, self.chunk_size):
+            self.handler(imap, uid, fetched)
+            self.last_uid = uid
+        if uids:
+            # Skip UIDs expunged before they could be fetched.
+            self.last_uid = max(self.last_uid, max(uids))
+
+    def wait(self, imap):
+        """
+        Block until the server reports new mail or it is time to renew IDLE / poll again.
+        """
+        if b'IDLE' not in imap.capabilities():
+            time.sleep(self.poll_interval)
+            imap.noop()
+            return
+
+        deadline = time.monotonic() + self.renew_after
+        imap.idle()
+        try:
+            while not self.stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                responses = imap.idle_check(timeout=min(remaining, IDLE_CHECK_SECONDS))
+                if any(len(response) > 1 and response[1] == b'EXISTS' for response in responses):
+                    break
+        finally:
+            imap.idle_done()
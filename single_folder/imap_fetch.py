@@ -0,0 +1,126 @@
+"""
+Chunked IMAP FETCH helpers shared by the single_folder scripts.
+
+Instead of one FETCH round trip per UID, UIDs are grouped into chunks and each chunk is
+sent as a single UID FETCH. Results are yielded as each chunk arrives, so memory is
+bounded by the chunk size rather than the mailbox size.
+"""
+import imaplib
+from email import policy
+from email.parser import BytesHeaderParser
+
+import imapclient
+from imapclient.exceptions import IMAPClientError
+from imapclient.imapclient import seq_to_parenstr_upper
+from imapclient.response_parser import parse_fetch_response
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def uid_ranges(uids):
+    """
+    Compress sorted UIDs into IMAP sequence-set ranges: [1, 2, 3, 7] -> ['1:3', '7'].
+    For search criteria only; IMAPClient.fetch() needs the UIDs themselves.
+    """
+    ranges = []
+    start = prev = None
+    for uid in uids:
+        if start is None:
+            start = prev = uid
+        elif uid == prev + 1:
+            prev = uid
+        else:
+            ranges.append(f"{start}:{prev}" if prev != start else str(start))
+            start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if prev != start else str(start))
+    return ranges
+
+
+def chunked(items, size):
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+
+def iter_fetch(imap, uids, data, chunk_size=DEFAULT_CHUNK_SIZE, modifiers=None):
+    """
+    Fetch `data` items for many UIDs, one FETCH command per `chunk_size` UIDs.
+    Yields (uid, fetch_response) in ascending UID order; UIDs the server no longer has are skipped.
+    """
+    for chunk in chunked(sorted(set(uids)), chunk_size):
+        # IMAPClient.fetch() converts the ids back to ints to filter unsolicited
+        # responses, so ranges cannot be passed here.
+        response = imap.fetch(chunk, data, modifiers)
+        for uid in chunk:
+            if uid in response:
+                yield uid, response[uid]
+
+
+def _imaplib(imap):
+    """
+    The imaplib connection behind an IMAPClient. IMAPClient has no public way to FETCH over a
+    sequence-set string or to read VANISHED responses, so those two go through imaplib's
+    public uid() and response() instead; this is the one place that reaches inside IMAPClient.
+    """
+    conn = getattr(imap, '_imap', None)
+    if not isinstance(conn, imaplib.IMAP4):
+        raise IMAPClientError(f"IMAPClient {imapclient.__version__} has no imaplib connection to fetch with")
+    return conn
+
+
+def fetch_uid_set(imap, uid_set, data, modifiers=None):
+    """
+    UID FETCH over a sequence-set string such as "1:5000", which IMAPClient.fetch() cannot
+    take. Untagged responses other than FETCH (e.g. VANISHED) are kept for pop_untagged().
+    """
+    typ, response = _imaplib(imap).uid(
+        'FETCH', uid_set, seq_to_parenstr_upper(data), seq_to_parenstr_upper(modifiers) if modifiers else None,
+    )
+    if typ != 'OK':
+        raise IMAPClientError(f"fetch failed: {response}")
+    return parse_fetch_response([item for item in response if item is not None], imap.normalise_times, True)
+
+
+def pop_untagged(imap, name):
+    """
+    Remove and return the payloads of untagged `name` responses (e.g. VANISHED) received so far.
+    """
+    _, data = _imaplib(imap).response(name)
+    return [item for item in data if item is not None]
+
+
+HEADER_FIELDS = ("SUBJECT", "FROM", "DATE")
+
+
+def header_fetch_item(fields=HEADER_FIELDS):
+    return f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})]"
+
+
+def header_bytes(fetched):
+    """
+    The raw header block from a FETCH response; servers echo the section back without
+    .PEEK, and some quote the field names.
+    """
+    for key, value in fetched.items():
+        if key.upper().startswith(b'BODY[HEADER.FIELDS'):
+            return value or b''
+    return b''
+
+
+_header_parser = BytesHeaderParser(policy=policy.default)
+
+
+def parse_headers(fetched):
+    """
+    Parse the header block of a FETCH response into an email.message.EmailMessage
+    with RFC 2047 words already decoded.
+    """
+    return _header_parser.parsebytes(header_bytes(fetched))
+
+
+def iter_headers(imap, uids, fields=HEADER_FIELDS, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Fetch only the given header fields (without setting \\Seen) and yield (uid, headers).
+    """
+    for uid, fetched in iter_fetch(imap, uids, [header_fetch_item(fields)], chunk_size):
+        yield uid, parse_headers(fetched)
@@ -0,0 +1,257 @@
+"""
+Persistent local cache of raw RFC822 messages for an IMAP folder.
+
+Messages are stored as SQLite blobs keyed by (account, folder, UIDVALIDITY, UID) and can be
+read in place with open_raw(). After the first sync(), only UIDs from the last seen UIDNEXT
+are downloaded. Flag changes are pulled with CONDSTORE (UID FETCH ... CHANGEDSINCE) and
+expunged messages with QRESYNC VANISHED when the server supports them; otherwise all flags
+are refetched in one command and expunges are found with a single UID SEARCH, and only when
+the message count does not add up.
+"""
+import sqlite3
+from datetime import datetime
+
+from imap_fetch import DEFAULT_CHUNK_SIZE, fetch_uid_set, iter_fetch, pop_untagged
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uidnext INTEGER NOT NULL,
+    highestmodseq INTEGER,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    internaldate TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    raw BLOB NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, uid)
+);
+"""
+
+MESSAGE_FETCH_ITEMS = ['BODY.PEEK[]', 'FLAGS', 'INTERNALDATE']
+
+
+def enable_sync_extensions(imap):
+    """
+    Enable QRESYNC (or CONDSTORE) if the server offers it. ENABLE is only valid before a
+    folder is selected, so call this straight after login. Returns the enabled names.
+    """
+    capabilities = imap.capabilities()
+    wanted = [name for name in ('QRESYNC', 'CONDSTORE') if name.encode() in capabilities]
+    if b'ENABLE' not in capabilities or not wanted:
+        return set()
+    return {name.decode().upper() for name in imap.enable(*wanted)}
+
+
+def parse_uid_set(value):
+    """
+    Expand a VANISHED payload such as b'(EARLIER) 300:302,405' into UIDs.
+    """
+    uids = []
+    for item in value.decode().replace('(EARLIER)', '').strip().split(','):
+        if not item:
+            continue
+        start, _, end = item.partition(':')
+        low, high = sorted((int(start), int(end or start)))
+        uids.extend(range(low, high + 1))
+    return uids
+
+
+def _flags_text(flags):
+    return ' '.join(flag.decode() if isinstance(flag, bytes) else flag for flag in flags)
+
+
+class MessageCache:
+    def __init__(self, path, account="", folder="INBOX"):
+        self.account = account
+        self.folder = folder
+        self.uidvalidity = None
+        self.conn = sqlite3.connect(str(path))
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS folders;")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _key(self):
+        return (self.account, self.folder, self.uidvalidity)
+
+    def sync(self, imap, enabled=(), chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Bring the cache up to date and return counts of new, flag-changed and vanished messages.
+        `enabled` is the set returned by enable_sync_extensions() for this connection.
+        """
+        status = imap.select_folder(self.folder)
+        uidvalidity = status[b'UIDVALIDITY']
+        uidnext = status[b'UIDNEXT']
+        highestmodseq = status.get(b'HIGHESTMODSEQ')
+        self.uidvalidity = uidvalidity
+
+        state = self.conn.execute(
+            "SELECT uidvalidity, uidnext, highestmodseq FROM folders WHERE account = ? AND folder = ?",
+            (self.account, self.folder),
+        ).fetchone()
+        if state is None or state[0] != uidvalidity:
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM messages WHERE account = ? AND folder = ?", (self.account, self.folder)
+                )
+            state = (uidvalidity, 1, None)
+        old_uidnext, old_modseq = state[1], state[2]
+
+        result = {"new": 0, "flags": 0, "vanished": 0}
+        if old_uidnext > 1:
+            self._sync_known(imap, enabled, old_uidnext, old_modseq, highestmodseq, result)
+
+        if old_uidnext < uidnext:
+            # "n:*" always matches the highest UID, even when it is below n.
+            uids = [uid for uid in imap.search(['UID', f"{old_uidnext}:*"]) if uid >= old_uidnext]
+            rows = []
+            for uid, fetched in iter_fetch(imap, uids, MESSAGE_FETCH_ITEMS, chunk_size):
+                rows.append(self._key() + (
+                    uid, fetched[b'INTERNALDATE'].isoformat(), _flags_text(fetched[b'FLAGS']), fetched[b'BODY[]'],
+                ))
+                if len(rows) >= chunk_size:
+                    result["new"] += self._insert(rows)
+                    rows = []
+            result["new"] += self._insert(rows)
+
+        # Without QRESYNC, expunges only show up as a count mismatch; one UID SEARCH finds them.
+        if status.get(b'EXISTS') is not None and status[b'EXISTS'] != self.count():
+            result["vanished"] += self._forget_missing(imap.search(['ALL']))
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO folders (account, folder, uidvalidity, uidnext, highestmodseq) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.account, self.folder, uidvalidity, uidnext, highestmodseq),
+            )
+        return result
+
+    def _sync_known(self, imap, enabled, old_uidnext, old_modseq, highestmodseq, result):
+        """
+        Update flags (and, with QRESYNC, expunges) for UIDs already in the cache.
+        """
+        uid_set = f"1:{old_uidnext - 1}"
+        condstore = old_modseq is not None and highestmodseq is not None
+        if condstore and highestmodseq == old_modseq:
+            return
+        if condstore:
+            modifiers = [f"CHANGEDSINCE {old_modseq}"]
+            if "QRESYNC" in enabled:
+                modifiers.append("VANISHED")
+            changed = fetch_uid_set(imap, uid_set, ['FLAGS'], modifiers)
+        else:
+            changed = fetch_uid_set(imap, uid_set, ['FLAGS'])
+
+        params = []
+        for uid, fetched in changed.items():
+            if b'FLAGS' in fetched:
+                flags = _flags_text(fetched[b'FLAGS'])
+                params.append((flags,) + self._key() + (uid, flags))
+        with self.conn:
+            cursor = self.conn.executemany(
+                "UPDATE messages SET flags = ? WHERE account = ? AND folder = ? AND uidvalidity = ? "
+                "AND uid = ? AND flags != ?",
+                params,
+            )
+        result["flags"] = max(cursor.rowcount, 0)
+
+        uids = [uid for value in pop_untagged(imap, 'VANISHED') for uid in parse_uid_set(value)]
+        result["vanished"] = self.forget(uids)
+
+    def _insert(self, rows):
+        if rows:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def _forget_missing(self, server_uids):
+        server_uids = set(server_uids)
+        return self.forget([uid for uid in self.uids() if uid not in server_uids])
+
+    def forget(self, uids):
+        with self.conn:
+            cursor = self.conn.executemany(
+                "DELETE FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+                [self._key() + (uid,) for uid in uids],
+            )
+        return max(cursor.rowcount, 0)
+
+    def count(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ?", self._key()
+        ).fetchone()[0]
+
+    def uids(self):
+        rows = self.conn.execute(
+            "SELECT uid FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? ORDER BY uid",
+            self._key(),
+        )
+        return [uid for (uid,) in rows]
+
+    def missing(self, uids):
+        """
+        The subset of `uids` that is not in the cache; costs one query per batch of `uids`,
+        not a scan of the whole cache.
+        """
+        uids = list(uids)
+        cached = set()
+        for offset in range(0, len(uids), DEFAULT_CHUNK_SIZE):
+            batch = uids[offset:offset + DEFAULT_CHUNK_SIZE]
+            rows = self.conn.execute(
+                "SELECT uid FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? "
+                f"AND uid IN ({', '.join('?' * len(batch))})",
+                self._key() + tuple(batch),
+            )
+            cached.update(uid for (uid,) in rows)
+        return [uid for uid in uids if uid not in cached]
+
+    def _rowid(self, uid):
+        row = self.conn.execute(
+            "SELECT rowid FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            self._key() + (uid,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def open_raw(self, uid):
+        """
+        A read-only sqlite3.Blob over the raw message for incremental reads without loading
+        it whole, or None if the UID is not cached. Use it as a context manager.
+        """
+        rowid = self._rowid(uid)
+        if rowid is None:
+            return None
+        return self.conn.blobopen('messages', 'raw', rowid, readonly=True)
+
+    def iter_messages(self, uids, batch_size=DEFAULT_CHUNK_SIZE):
+        """
+        Yield (uid, fetch_response) for the cached `uids`, shaped like an IMAP FETCH of
+        BODY[], FLAGS and INTERNALDATE so the scripts can parse the local copy unchanged.
+        """
+        uids = sorted(set(uids))
+        for offset in range(0, len(uids), batch_size):
+            batch = uids[offset:offset + batch_size]
+            rows = self.conn.execute(
+                "SELECT uid, internaldate, flags, raw FROM messages "
+                "WHERE account = ? AND folder = ? AND uidvalidity = ? "
+                f"AND uid IN ({', '.join('?' * len(batch))}) ORDER BY uid",
+                self._key() + tuple(batch),
+            )
+            for uid, internaldate, flags, raw in rows:
+                yield uid, {
+                    b'BODY[]': raw,
+                    b'FLAGS': tuple(flag.encode() for flag in flags.split()),
+                    b'INTERNALDATE': datetime.fromisoformat(internaldate),
+                }
@@ -0,0 +1,156 @@
+"""
+Cheap message previews for triage.
+
+Instead of downloading BODY[] (attachments included) and parsing it, previews fetch the
+BODYSTRUCTURE and a few headers, pick the text part the same way the full parser would
+(text/plain first, then text/html, never attachments), and fetch only its first
+`max_bytes` with a partial BODY.PEEK[section]<0.N>. The full message is only needed when
+the user asks for it.
+"""
+import base64
+import binascii
+import codecs
+import quopri
+import re
+from collections import defaultdict
+from email.utils import parseaddr
+
+from conversations import normalize_subject
+from email_parsing import clean_text
+from imap_fetch import DEFAULT_CHUNK_SIZE, header_fetch_item, iter_fetch, parse_headers
+
+PREVIEW_BYTES = 4096
+TEXT_PREFERENCE = (b'PLAIN', b'HTML')
+
+_PARTIAL_TAG = re.compile(r'<[^>]*$')
+
+
+def _upper(value):
+    return value.upper() if isinstance(value, bytes) else b''
+
+
+def _params(part):
+    values = part[2] or ()
+    return {_upper(values[i]): values[i + 1] for i in range(0, len(values) - 1, 2)}
+
+
+def _is_attachment(part):
+    # For TEXT parts the disposition follows lines and md5 (RFC 3501 body-ext-1part).
+    disposition = part[9] if len(part) > 9 else None
+    return bool(disposition) and _upper(disposition[0]) == b'ATTACHMENT'
+
+
+def select_text_part(bodystructure):
+    """
+    Return (section, part) of the preferred text part in a BODYSTRUCTURE, or (None, None).
+    Message/rfc822 parts and attachments are not descended into.
+    """
+    best, best_rank = (None, None), len(TEXT_PREFERENCE)
+    stack = [("", bodystructure)]
+    while stack:
+        prefix, part = stack.pop()
+        if part.is_multipart:
+            children = [(f"{prefix}{i}" if not prefix else f"{prefix}.{i}", child)
+                        for i, child in enumerate(part[0], start=1)]
+            stack.extend(reversed(children))
+            continue
+        section = prefix or "1"
+        subtype = _upper(part[1])
+        if _upper(part[0]) != b'TEXT' or subtype not in TEXT_PREFERENCE or _is_attachment(part):
+            continue
+        rank = TEXT_PREFERENCE.index(subtype)
+        if rank < best_rank:
+            best, best_rank = (section, part), rank
+            if rank == 0:
+                break
+    return best
+
+
+def decode_partial(data, part):
+    """
+    Decode the first bytes of a part's body, tolerating a cut in the middle of a base64
+    quantum, a quoted-printable escape or a multi-byte character.
+    """
+    encoding = _upper(part[5])
+    if encoding == b'BASE64':
+        # Keep the '=' padding: a complete part is always whole quanta, so only a fetch that
+        # stopped mid-quantum leaves a remainder to drop.
+        data = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+        try:
+            data = base64.b64decode(data[:len(data) - len(data) % 4])
+        except binascii.Error:
+            data = b''
+    elif encoding == b'QUOTED-PRINTABLE':
+        data = quopri.decodestring(re.sub(rb'=[0-9A-Fa-f]?$', b'', data))
+
+    charset = _params(part).get(b'CHARSET', b'utf-8').decode('ascii', 'replace')
+    try:
+        decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    return decoder.decode(data, final=False)
+
+
+def _section_data(fetched, section):
+    prefix = f"BODY[{section}]".encode()
+    for key, value in fetched.items():
+        if isinstance(key, bytes) and key.upper().startswith(prefix):
+            return value or b''
+    return b''
+
+
+def iter_previews(imap, uids, max_bytes=PREVIEW_BYTES, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield a preview dict per message: uid, date, from_name, sender, subject, subject_clean,
+    preview (cleaned text), truncated and size (bytes of the selected part). Nothing is marked read.
+    """
+    items = ['BODYSTRUCTURE', 'INTERNALDATE', header_fetch_item()]
+    pending = []
+    for uid, fetched in iter_fetch(imap, uids, items, chunk_size):
+        pending.append((uid, fetched))
+        if len(pending) >= chunk_size:
+            yield from _previews(imap, pending, max_bytes)
+            pending = []
+    yield from _previews(imap, pending, max_bytes)
+
+
+def _previews(imap, fetched_chunk, max_bytes):
+    # One partial FETCH per distinct section ("1", "1.1", ...), usually just one or two.
+    sections = defaultdict(list)
+    parts = {}
+    for uid, fetched in fetched_chunk:
+        section, part = select_text_part(fetched[b'BODYSTRUCTURE'])
+        parts[uid] = (section, part)
+        if section:
+            sections[section].append(uid)
+
+    texts = {}
+    for section, section_uids in sections.items():
+        response = imap.fetch(section_uids, [f"BODY.PEEK[{section}]<0.{max_bytes}>"])
+        for uid in section_uids:
+            if uid in response:
+                texts[uid] = _section_data(response[uid], section)
+
+    for uid, fetched in fetched_chunk:
+        headers = parse_headers(fetched)
+        subject = str(headers.get('Subject', ''))
+        from_name, sender = parseaddr(str(headers.get('From', '')))
+        section, part = parts[uid]
+        preview, size = "", 0
+        if section:
+            size = part[6] or 0
+            text = decode_partial(texts.get(uid, b''), part)
+            if size > max_bytes:
+                text = _PARTIAL_TAG.sub('', text)
+            preview = clean_text(text)
+        yield {
+            "uid": uid,
+            "date": fetched[b'INTERNALDATE'].strftime("%Y-%m-%d %H:%M:%S"),
+            "from_name": from_name,
+            "sender": sender,
+            "subject": subject,
+            "subject_clean": normalize_subject(subject),
+            "preview": preview,
+            "truncated": size > max_bytes,
+            "size": size,
+        }
@@ -0,0 +1,137 @@
+"""
+Reusable SMTP sender for the single_folder scripts.
+
+One authenticated connection is kept open and reused for every message instead of a
+connect/STARTTLS/login handshake per reply. Messages can be queued and sent with flush(),
+which reports a status per message. If the server has dropped the connection (idle
+timeout, 421 "service closing") it is re-established and the message is retried.
+"""
+import smtplib
+from collections import deque
+
+# Many providers cap messages per session; start a fresh session after this many.
+MAX_MESSAGES_PER_CONNECTION = 100
+MAX_RETRIES = 2
+
+
+class SMTPSender:
+    def __init__(self, host, port, username, password, starttls=True, timeout=30,
+                 max_per_connection=MAX_MESSAGES_PER_CONNECTION, max_retries=MAX_RETRIES):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_per_connection = max_per_connection
+        self.max_retries = max_retries
+        self.queue = deque()
+        self.server = None
+        self.sent_on_connection = 0
+        self.connections = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.sent_on_connection = 0
+        self.connections += 1
+
+    def close(self):
+        """
+        QUIT the current connection, if any.
+        """
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _drop(self):
+        server, self.server = self.server, None
+        if server is not None:
+            server.close()
+
+    def _reset(self):
+        """
+        RSET after a rejected message so the session can be reused; drop it if that fails.
+        """
+        if self.server is None:
+            return
+        try:
+            self.server.rset()
+        except (smtplib.SMTPException, OSError):
+            self._drop()
+
+    def enqueue(self, msg, from_addr=None, to_addrs=None):
+        self.queue.append((msg, from_addr, to_addrs))
+
+    def send(self, msg, from_addr=None, to_addrs=None):
+        """
+        Send one message now and return its status dict (see flush()).
+        """
+        return self._send(msg, from_addr, to_addrs)
+
+    def flush(self):
+        """
+        Send every queued message over the shared connection.
+        Returns one dict per message: {"to", "subject", "status": "sent" | "failed", "error", "refused"}.
+        """
+        results = []
+        while self.queue:
+            results.append(self._send(*self.queue.popleft()))
+        return results
+
+    def _send(self, msg, from_addr, to_addrs):
+        result = {"to": to_addrs or msg['To'], "subject": msg['Subject'], "status": "failed", "error": None, "refused": {}}
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.server is None or self.sent_on_connection >= self.max_per_connection:
+                    self.close()
+                    self._connect()
+                refused = self.server.send_message(msg, from_addr, to_addrs)
+            except smtplib.SMTPRecipientsRefused as exc:
+                # Every recipient was rejected; retrying will not help.
+                self._reset()
+                result.update(error="All recipients refused.", refused=_decode_refused(exc.recipients))
+                return result
+            except smtplib.SMTPServerDisconnected as exc:
+                self._drop()
+                result["error"] = str(exc) or "Server disconnected."
+            except smtplib.SMTPResponseException as exc:
+                result["error"] = f"{exc.smtp_code} {_decode(exc.smtp_error)}"
+                if exc.smtp_code != 421:
+                    self._reset()
+                    return result
+                # 421: the server is closing the session; open a new one and retry.
+                self._drop()
+            except OSError as exc:
+                self._drop()
+                result["error"] = str(exc)
+            else:
+                self.sent_on_connection += 1
+                result.update(status="sent", error=None, refused=_decode_refused(refused))
+                return result
+        return result
+
+
+def _decode(value):
+    return value.decode(errors='replace') if isinstance(value, bytes) else str(value)
+
+
+def _decode_refused(refused):
+    return {address: f"{code} {_decode(message)}" for address, (code, message) in refused.items()}
@@ -0,0 +1,140 @@
+"""
+On-disk subject index for an IMAP folder.
+
+Header metadata is stored in SQLite keyed by (account, folder, UIDVALIDITY, UID). Each
+update() only fetches headers for UIDs at or above the UIDNEXT seen last time, and a
+UIDVALIDITY change throws the folder's rows away. A thread lookup is then a local query
+followed by a fetch of just the matching messages.
+"""
+import sqlite3
+from email.utils import parseaddr
+
+from conversations import normalize_subject
+from imap_fetch import DEFAULT_CHUNK_SIZE, header_fetch_item, iter_fetch, parse_headers
+
+# Bump whenever the stored columns or the subject normalisation change.
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uidnext INTEGER NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    from_name TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    subject_clean TEXT NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_subject ON messages (account, folder, uidvalidity, subject_clean);
+"""
+
+
+class SubjectIndex:
+    def __init__(self, path, account="", folder="INBOX"):
+        self.account = account
+        self.folder = folder
+        self.uidvalidity = None
+        self.conn = sqlite3.connect(str(path))
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # The index is only a cache of the server, so an old layout is simply rebuilt.
+            self.conn.executescript("DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS folders;")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _state(self):
+        return self.conn.execute(
+            "SELECT uidvalidity, uidnext FROM folders WHERE account = ? AND folder = ?",
+            (self.account, self.folder),
+        ).fetchone()
+
+    def update(self, imap, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Bring the index up to date with the server and return the number of messages added.
+        Selects the folder, which also refreshes the client's view of it.
+        """
+        status = imap.select_folder(self.folder)
+        uidvalidity = status[b'UIDVALIDITY']
+        uidnext = status[b'UIDNEXT']
+        self.uidvalidity = uidvalidity
+
+        state = self._state()
+        if state is None or state[0] != uidvalidity:
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM messages WHERE account = ? AND folder = ?", (self.account, self.folder)
+                )
+            start = 1
+        else:
+            start = state[1]
+
+        added = 0
+        if start < uidnext:
+            # "n:*" always matches the highest UID, even when it is below n.
+            uids = [uid for uid in imap.search(['UID', f"{start}:*"]) if uid >= start]
+            rows = []
+            for uid, fetched in iter_fetch(imap, uids, [header_fetch_item(), 'INTERNALDATE'], chunk_size):
+                rows.append(self._row(uid, fetched))
+                if len(rows) >= chunk_size:
+                    added += self._insert(rows)
+                    rows = []
+            added += self._insert(rows)
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO folders (account, folder, uidvalidity, uidnext) VALUES (?, ?, ?, ?)",
+                (self.account, self.folder, uidvalidity, uidnext),
+            )
+        return added
+
+    def _row(self, uid, fetched):
+        headers = parse_headers(fetched)
+        subject = str(headers.get('Subject', ''))
+        from_name, sender = parseaddr(str(headers.get('From', '')))
+        date = fetched[b'INTERNALDATE'].strftime("%Y-%m-%d %H:%M:%S")
+        return (
+            self.account, self.folder, self.uidvalidity, uid,
+            date, from_name, sender, subject, normalize_subject(subject),
+        )
+
+    def _insert(self, rows):
+        if rows:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+        return len(rows)
+
+    def uids_for_subject(self, subject_clean):
+        """
+        UIDs of indexed messages with this normalised subject, oldest first.
+        """
+        rows = self.conn.execute(
+            "SELECT uid FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? "
+            "AND subject_clean = ? ORDER BY date, uid",
+            (self.account, self.folder, self.uidvalidity, subject_clean),
+        )
+        return [uid for (uid,) in rows]
+
+    def forget(self, uids):
+        """
+        Drop UIDs that the server no longer has (expunged since they were indexed).
+        """
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+                [(self.account, self.folder, self.uidvalidity, uid) for uid in uids],
+            )
@@ -0,0 +1,88 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import account_pool
+from account_pool import load_accounts, run_accounts
+from fake_imap import FakeIMAP
+
+
+def account(name, server='imap.example.com'):
+    return {"name": name, "email": f"{name}@example.com", "password": "secret", "imap_server": server, "imap_port": 993}
+
+
+class RunAccountsTests(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        patcher = mock.patch.object(account_pool, 'connect', side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, acct):
+        if acct["name"] == "broken":
+            raise OSError("Connection refused")
+        imap = FakeIMAP()
+        imap.add("Hello")
+        return imap
+
+    def slow_task(self, acct, imap):
+        host = acct["imap_server"]
+        with self.lock:
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+        time.sleep(0.02)
+        with self.lock:
+            self.active[host] -= 1
+        return acct["name"]
+
+    def test_connections_per_host_are_capped(self):
+        accounts = [account(f"a{i}") for i in range(6)] + [account(f"b{i}", "imap.other.com") for i in range(6)]
+        results = list(run_accounts(accounts, self.slow_task, workers=12, per_host_limit=2))
+
+        self.assertEqual(sorted(r["result"] for r in results), sorted(a["name"] for a in accounts))
+        self.assertEqual(self.peak, {"imap.example.com": 2, "imap.other.com": 2})
+
+    def test_failing_account_does_not_stop_the_others(self):
+        results = {r["account"]: r for r in run_accounts([account("ok"), account("broken")], account_pool.unseen_count)}
+
+        self.assertEqual(results["ok"], {"account": "ok", "status": "ok", "result": {"unseen": 1}})
+        self.assertEqual(results["broken"]["status"], "error")
+        self.assertEqual(results["broken"]["error"], "OSError: Connection refused")
+
+    def test_task_errors_are_reported_and_the_connection_closed(self):
+        imap = FakeIMAP()
+        account_pool.connect.side_effect = lambda acct: imap
+
+        def fail(acct, imap):
+            raise ValueError("bad data")
+
+        [result] = run_accounts([account("a")], fail)
+        self.assertEqual(result["error"], "ValueError: bad data")
+        self.assertIn(('LOGOUT',), imap.commands)
+
+
+class LoadAccountsTests(unittest.TestCase):
+    def test_defaults_and_password_from_environment(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "accounts.json"
+            path.write_text(json.dumps([{"email": "a@example.com", "imap_server": "imap.example.com",
+                                         "password_env": "TEST_ACCOUNT_PASSWORD"}]))
+            with mock.patch.dict(os.environ, {"TEST_ACCOUNT_PASSWORD": "secret"}):
+                [acct] = load_accounts(path)
+
+        self.assertEqual(acct["name"], "a@example.com")
+        self.assertEqual((acct["imap_port"], acct["folder"], acct["password"]), (993, "INBOX", "secret"))
+
+
+if __name__ == '__main__':
+    unittest.main()
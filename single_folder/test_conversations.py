@@ -0,0 +1,105 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import unittest
+
+from conversations import jwz_thread, normalize_subject, thread_uids
+
+
+def header(uid, subject, message_id=None, in_reply_to=(), references=()):
+    return {
+        "uid": uid,
+        "message_id": message_id or f"<{uid}@example.com>",
+        "in_reply_to": list(in_reply_to),
+        "references": list(references),
+        "subject": subject,
+    }
+
+
+class NormalizeSubjectTests(unittest.TestCase):
+    def test_reply_and_forward_prefixes_are_stripped(self):
+        self.assertEqual(normalize_subject("Re: Fwd: RE[2]: AW:  Quarterly   report"), "Quarterly report")
+        self.assertEqual(normalize_subject("Reply needed"), "Reply needed")
+        self.assertEqual(normalize_subject(None), "")
+
+
+class JwzThreadTests(unittest.TestCase):
+    def test_replies_follow_references(self):
+        threads = jwz_thread([
+            header(1, "Plan"),
+            header(2, "Re: Plan", in_reply_to=["<1@example.com>"], references=["<1@example.com>"]),
+            header(3, "Re: Plan", references=["<1@example.com>", "<2@example.com>"]),
+            header(4, "Other"),
+        ])
+        self.assertEqual(threads, [[1, 2, 3], [4]])
+
+    def test_reply_arriving_before_its_parent(self):
+        threads = jwz_thread([
+            header(5, "Re: Plan", in_reply_to=["<1@example.com>"]),
+            header(1, "Plan"),
+        ])
+        self.assertEqual(threads, [[1, 5]])
+
+    def test_orphaned_replies_join_by_subject(self):
+        threads = jwz_thread([
+            header(1, "Plan"),
+            header(2, "Re: Plan", in_reply_to=["<missing@example.com>"]),
+            header(3, "RE: plan"),
+        ])
+        self.assertEqual(threads, [[1, 2], [3]])
+
+    def test_complete_threads_with_the_same_subject_stay_apart(self):
+        threads = jwz_thread([header(1, "Weekly update"), header(2, "Weekly update")])
+        self.assertEqual(threads, [[1], [2]])
+
+    def test_duplicate_message_ids_keep_both_messages(self):
+        threads = jwz_thread([header(1, "Plan", "<same@example.com>"), header(2, "Plan", "<same@example.com>")])
+        self.assertEqual(sorted(uid for thread in threads for uid in thread), [1, 2])
+
+    def test_reference_loops_terminate(self):
+        threads = jwz_thread([
+            header(1, "A", references=["<2@example.com>"]),
+            header(2, "Re: A", references=["<1@example.com>"]),
+        ])
+        self.assertEqual(threads, [[1, 2]])
+
+
+class FakeServer:
+    def __init__(self, capabilities, fetched=None, threads=()):
+        self._capabilities = capabilities
+        self.fetched = fetched or {}
+        self.threads = threads
+        self.thread_calls = []
+
+    def capabilities(self):
+        return self._capabilities
+
+    def fetch(self, uids, data, modifiers=None):
+        return {uid: self.fetched[uid] for uid in uids if uid in self.fetched}
+
+    def thread(self, algorithm, criteria):
+        self.thread_calls.append((algorithm, criteria))
+        return self.threads
+
+
+class ThreadUidsTests(unittest.TestCase):
+    def test_gmail_thread_ids(self):
+        imap = FakeServer((b'IMAP4REV1', b'X-GM-EXT-1'), {1: {b'X-GM-THRID': 7}, 2: {b'X-GM-THRID': 8}, 3: {b'X-GM-THRID': 7}})
+        self.assertEqual(thread_uids(imap, [3, 2, 1]), [[1, 3], [2]])
+
+    def test_server_side_references(self):
+        imap = FakeServer((b'IMAP4REV1', b'THREAD=REFERENCES'), threads=((1, (2, 9)), (3,), (10,)))
+        self.assertEqual(thread_uids(imap, [1, 2, 3]), [[1, 2], [3]])
+        self.assertEqual(imap.thread_calls, [('REFERENCES', ['UID', '1:3'])])
+
+    def test_local_threading_from_headers(self):
+        key = b'BODY[HEADER.FIELDS (MESSAGE-ID IN-REPLY-TO REFERENCES SUBJECT)]'
+        imap = FakeServer((b'IMAP4REV1',), {
+            1: {key: b'Message-ID: <a@x>\r\nSubject: Plan\r\n\r\n'},
+            2: {key: b'Message-ID: <b@x>\r\nIn-Reply-To: <a@x>\r\nSubject: Re: Plan\r\n\r\n'},
+        })
+        self.assertEqual(thread_uids(imap, [1, 2]), [[1, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import unittest
+from unittest import mock
+
+from fake_imap import FakeIMAP
+from idle_watcher import IdleWatcher
+
+
+class IdleWatcherTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('idle_watcher.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.imap = FakeIMAP()
+        self.handled = []
+
+    def handler(self, imap, uid, fetched):
+        self.handled.append((uid, fetched[b'BODY[]'].split(b'\r\n')[0]))
+
+    def test_only_mail_after_start_is_handled(self):
+        self.imap.add('Old')
+        watcher = IdleWatcher(lambda: self.imap, self.handler)
+        watcher._select(self.imap)
+        watcher.process_new(self.imap)
+        self.assertEqual(self.handled, [])
+
+        new = self.imap.add('New')
+        watcher.process_new(self.imap)
+        watcher.process_new(self.imap)
+        self.assertEqual(self.handled, [(new, b'Subject: New')])
+
+    def test_uidvalidity_change_restarts_from_uidnext(self):
+        self.imap.add('Old')
+        watcher = IdleWatcher(lambda: self.imap, self.handler)
+        watcher._select(self.imap)
+        self.imap.uidvalidity = 2
+        self.imap.add('Before reselect')
+        watcher._select(self.imap)
+        watcher.process_new(self.imap)
+        self.assertEqual(self.handled, [])
+
+    def test_reconnects_with_backoff_and_catches_up(self):
+        self.imap.add('Old')
+        connects = []
+
+        def connect():
+            connects.append(len(connects))
+            if len(connects) == 2:
+                raise OSError("Connection reset")
+            return self.imap
+
+        def wait(imap):
+            if len(connects) == 1:
+                self.imap.add('While away')
+                raise OSError("Connection reset")
+            watcher.stop()
+
+        watcher = IdleWatcher(connect, self.handler)
+        with mock.patch.object(watcher, 'wait', side_effect=wait):
+            watcher.run()
+
+        self.assertEqual([subject for _, subject in self.handled], [b'Subject: While away'])
+        self.assertEqual(len(connects), 3)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2])
+
+    def test_servers_without_idle_are_polled(self):
+        watcher = IdleWatcher(lambda: self.imap, self.handler, poll_interval=7)
+        watcher.wait(self.imap)
+        self.sleep.assert_called_once_with(7)
+        self.assertIn(('NOOP',), self.imap.commands)
+
+    def test_idle_ends_on_exists(self):
+        imap = mock.Mock()
+        imap.capabilities.return_value = (b'IDLE',)
+        imap.idle_check.side_effect = [[(b'OK', b'Still here')], [(3, b'EXISTS')]]
+        IdleWatcher(lambda: imap, self.handler).wait(imap)
+
+        self.assertEqual(imap.idle_check.call_count, 2)
+        imap.idle_done.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import imaplib
+import unittest
+from unittest import mock
+
+from imapclient.exceptions import IMAPClientError
+
+from imap_fetch import fetch_uid_set, iter_fetch, iter_headers, pop_untagged, uid_ranges
+
+
+class FakeClient:
+    """
+    Stands in for IMAPClient.fetch(): answers for the UIDs in `messages` and records each call.
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.calls = []
+        self.normalise_times = True
+        self._imap = mock.Mock(spec=imaplib.IMAP4)
+
+    def fetch(self, uids, data, modifiers=None):
+        self.calls.append((list(uids), data, modifiers))
+        return {uid: self.messages[uid] for uid in uids if uid in self.messages}
+
+
+class UidRangesTests(unittest.TestCase):
+    def test_consecutive_uids_are_compressed(self):
+        self.assertEqual(uid_ranges([1, 2, 3, 7, 9, 10]), ['1:3', '7', '9:10'])
+        self.assertEqual(uid_ranges([]), [])
+
+
+class IterFetchTests(unittest.TestCase):
+    def test_one_fetch_per_chunk_in_uid_order(self):
+        imap = FakeClient({uid: {b'FLAGS': ()} for uid in range(1, 8)})
+        fetched = list(iter_fetch(imap, [7, 3, 1, 2, 5, 3, 6, 4], ['FLAGS'], chunk_size=3))
+
+        self.assertEqual([uid for uid, _ in fetched], [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual([call[0] for call in imap.calls], [[1, 2, 3], [4, 5, 6], [7]])
+
+    def test_missing_uids_are_skipped(self):
+        imap = FakeClient({2: {b'FLAGS': ()}})
+        self.assertEqual([uid for uid, _ in iter_fetch(imap, [1, 2, 3], ['FLAGS'])], [2])
+
+    def test_headers_are_decoded(self):
+        raw = b'Subject: =?utf-8?q?Caf=C3=A9?=\r\nFrom: Alice <alice@example.com>\r\n\r\n'
+        imap = FakeClient({4: {b'BODY[HEADER.FIELDS (SUBJECT FROM DATE)]': raw}})
+        [(uid, headers)] = iter_headers(imap, [4])
+
+        self.assertEqual(uid, 4)
+        self.assertEqual(str(headers['Subject']), 'Café')
+        self.assertIn('BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)]', imap.calls[0][1])
+
+
+class FetchUidSetTests(unittest.TestCase):
+    def test_sequence_set_goes_out_as_one_uid_fetch(self):
+        imap = FakeClient({})
+        imap._imap.uid.return_value = ('OK', [b'1 (UID 5 FLAGS (\\Seen) MODSEQ (9))', b'2 (UID 8 FLAGS ())'])
+        changed = fetch_uid_set(imap, '1:10', ['FLAGS'], ['CHANGEDSINCE 7', 'VANISHED'])
+
+        imap._imap.uid.assert_called_once_with('FETCH', '1:10', '(FLAGS)', '(CHANGEDSINCE 7 VANISHED)')
+        self.assertEqual(changed[5][b'FLAGS'], (b'\\Seen',))
+        self.assertEqual(changed[8][b'FLAGS'], ())
+
+    def test_no_changes(self):
+        imap = FakeClient({})
+        imap._imap.uid.return_value = ('OK', [None])
+        self.assertEqual(dict(fetch_uid_set(imap, '1:10', ['FLAGS'])), {})
+
+    def test_failed_fetch_raises(self):
+        imap = FakeClient({})
+        imap._imap.uid.return_value = ('NO', [b'Invalid sequence set'])
+        with self.assertRaises(IMAPClientError):
+            fetch_uid_set(imap, '1:10', ['FLAGS'])
+
+    def test_pop_untagged_reads_through_response(self):
+        imap = FakeClient({})
+        imap._imap.response.return_value = ('VANISHED', [b'(EARLIER) 3:4', None])
+
+        self.assertEqual(pop_untagged(imap, 'VANISHED'), [b'(EARLIER) 3:4'])
+        imap._imap.response.assert_called_once_with('VANISHED')
+
+    def test_client_without_imaplib_connection_is_refused(self):
+        imap = FakeClient({})
+        imap._imap = object()
+        with self.assertRaises(IMAPClientError):
+            fetch_uid_set(imap, '1:10', ['FLAGS'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import unittest
+
+from fake_imap import FakeIMAP
+from message_cache import MessageCache, enable_sync_extensions, parse_uid_set
+
+
+class ParseUidSetTests(unittest.TestCase):
+    def test_ranges_and_earlier_tag(self):
+        self.assertEqual(parse_uid_set(b'(EARLIER) 300:302,405'), [300, 301, 302, 405])
+        self.assertEqual(parse_uid_set(b'7:5'), [5, 6, 7])
+
+
+class MessageCacheTests(unittest.TestCase):
+    def make_cache(self):
+        cache = MessageCache(':memory:', account='alice')
+        self.addCleanup(cache.close)
+        return cache
+
+    def fetches(self, imap):
+        return [c for c in imap.commands if c[0] in ('FETCH', 'UID FETCH')]
+
+    def test_first_sync_downloads_everything_then_only_new_uids(self):
+        imap = FakeIMAP()
+        uids = [imap.add(f'Message {i}') for i in range(3)]
+        cache = self.make_cache()
+
+        self.assertEqual(cache.sync(imap)['new'], 3)
+        self.assertEqual(cache.uids(), uids)
+
+        new = imap.add('Later')
+        imap.commands.clear()
+        self.assertEqual(cache.sync(imap)['new'], 1)
+        self.assertEqual([c[1] for c in imap.commands if c[0] == 'FETCH'], [(new,)])
+        self.assertEqual(cache.missing([uids[0], new, 99]), [99])
+
+    def test_cached_messages_read_like_a_fetch(self):
+        imap = FakeIMAP()
+        uid = imap.add('Cached', flags=[b'\\Seen'], body='Stored body')
+        cache = self.make_cache()
+        cache.sync(imap)
+
+        [(cached_uid, fetched)] = cache.iter_messages([uid])
+        self.assertEqual(cached_uid, uid)
+        self.assertEqual(fetched[b'FLAGS'], (b'\\Seen',))
+        self.assertEqual(fetched[b'INTERNALDATE'], imap.messages[uid]['date'])
+        with cache.open_raw(uid) as blob:
+            self.assertIn(b'Stored body', blob.read())
+        self.assertIsNone(cache.open_raw(99))
+
+    def test_flags_without_condstore_are_refetched_in_one_command(self):
+        imap = FakeIMAP()
+        uids = [imap.add(f'Message {i}') for i in range(3)]
+        cache = self.make_cache()
+        cache.sync(imap)
+        imap.set_flags(uids[1], [b'\\Seen'])
+        imap.commands.clear()
+
+        result = cache.sync(imap)
+        self.assertEqual(result, {'new': 0, 'flags': 1, 'vanished': 0})
+        self.assertEqual(self.fetches(imap), [('UID FETCH', '1:3', '(FLAGS)', None)])
+
+    def test_expunges_without_qresync_are_found_by_count(self):
+        imap = FakeIMAP()
+        uids = [imap.add(f'Message {i}') for i in range(3)]
+        cache = self.make_cache()
+        cache.sync(imap)
+        imap.expunge(uids[0])
+
+        self.assertEqual(cache.sync(imap)['vanished'], 1)
+        self.assertEqual(cache.uids(), uids[1:])
+
+    def test_condstore_skips_unchanged_folders_and_fetches_changes_since(self):
+        imap = FakeIMAP((b'IMAP4REV1', b'CONDSTORE'), condstore=True)
+        uids = [imap.add(f'Message {i}') for i in range(3)]
+        cache = self.make_cache()
+        cache.sync(imap)
+        imap.commands.clear()
+
+        self.assertEqual(cache.sync(imap), {'new': 0, 'flags': 0, 'vanished': 0})
+        self.assertEqual(self.fetches(imap), [])
+
+        modseq = imap.modseq
+        imap.set_flags(uids[2], [b'\\Flagged'])
+        self.assertEqual(cache.sync(imap)['flags'], 1)
+        self.assertEqual(self.fetches(imap), [('UID FETCH', '1:3', '(FLAGS)', f'(CHANGEDSINCE {modseq})')])
+
+    def test_qresync_reports_vanished_uids(self):
+        imap = FakeIMAP((b'IMAP4REV1', b'CONDSTORE', b'QRESYNC'), condstore=True)
+        uids = [imap.add(f'Message {i}') for i in range(3)]
+        cache = self.make_cache()
+        cache.sync(imap, enabled={'QRESYNC'})
+        imap.expunge(uids[1])
+        imap.commands.clear()
+
+        result = cache.sync(imap, enabled={'QRESYNC'})
+        self.assertEqual(result['vanished'], 1)
+        self.assertEqual(cache.uids(), [uids[0], uids[2]])
+        self.assertNotIn(('SEARCH', ('ALL',)), imap.commands)
+
+    def test_uidvalidity_change_drops_the_cache(self):
+        imap = FakeIMAP()
+        imap.add('Old')
+        cache = self.make_cache()
+        cache.sync(imap)
+        imap.uidvalidity = 2
+        imap.messages.clear()
+        imap.uidnext = 1
+        uid = imap.add('New')
+
+        self.assertEqual(cache.sync(imap)['new'], 1)
+        self.assertEqual(cache.uids(), [uid])
+
+
+class EnableSyncExtensionsTests(unittest.TestCase):
+    def test_only_offered_extensions_are_enabled(self):
+        imap = FakeIMAP((b'IMAP4REV1', b'ENABLE', b'CONDSTORE'))
+        imap.enable = lambda *names: [name.encode() for name in names]
+        self.assertEqual(enable_sync_extensions(imap), {'CONDSTORE'})
+        self.assertEqual(enable_sync_extensions(FakeIMAP((b'IMAP4REV1', b'CONDSTORE'))), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
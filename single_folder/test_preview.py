@@ -0,0 +1,45 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import base64
+import unittest
+
+from preview import decode_partial
+
+
+def text_part(encoding, charset=b'utf-8'):
+    # BODYSTRUCTURE fields of a single TEXT/PLAIN part: type, subtype, params, id, description, encoding, size.
+    return (b'TEXT', b'PLAIN', (b'CHARSET', charset), None, None, encoding, 0, 1)
+
+
+class DecodePartialTests(unittest.TestCase):
+    def test_padded_base64_keeps_last_quantum(self):
+        part = text_part(b'BASE64')
+        self.assertEqual(decode_partial(b'SGk=', part), 'Hi')
+        self.assertEqual(decode_partial(b'SGVsbG8=', part), 'Hello')
+        self.assertEqual(decode_partial(b'SGVsbG8hIQ==\r\n', part), 'Hello!!')
+
+    def test_base64_with_line_breaks(self):
+        encoded = base64.encodebytes(b'line one\nline two\n' * 10)
+        self.assertEqual(decode_partial(encoded, text_part(b'BASE64')), 'line one\nline two\n' * 10)
+
+    def test_truncated_base64_drops_partial_quantum(self):
+        encoded = base64.b64encode(b'Hello world')
+        self.assertEqual(decode_partial(encoded[:10], text_part(b'BASE64')), 'Hello ')
+
+    def test_truncated_base64_inside_multibyte_character(self):
+        encoded = base64.b64encode('café'.encode('utf-8'))
+        self.assertEqual(decode_partial(encoded[:4], text_part(b'BASE64')), 'caf')
+
+    def test_truncated_quoted_printable_escape(self):
+        part = text_part(b'QUOTED-PRINTABLE')
+        self.assertEqual(decode_partial(b'caf=C3=A9 ok', part), 'café ok')
+        self.assertEqual(decode_partial(b'caf=C', part), 'caf')
+
+    def test_charset_from_bodystructure(self):
+        part = text_part(b'7BIT', charset=b'iso-8859-1')
+        self.assertEqual(decode_partial(b'caf\xe9', part), 'café')
+
+
+if __name__ == '__main__':
+    unittest.main()
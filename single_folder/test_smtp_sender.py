@@ -0,0 +1,118 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import smtplib
+import unittest
+from email.mime.text import MIMEText
+from unittest import mock
+
+from smtp_sender import SMTPSender
+
+
+def make_message(to='bob@example.com', subject='Hello'):
+    msg = MIMEText('body')
+    msg['From'] = 'alice@example.com'
+    msg['To'] = to
+    msg['Subject'] = subject
+    return msg
+
+
+class SMTPSenderTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('smtp_sender.smtplib.SMTP')
+        self.smtp = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.servers = []
+        self.smtp.side_effect = self.new_server
+
+    def new_server(self, *args, **kwargs):
+        server = mock.Mock()
+        server.send_message.return_value = {}
+        self.servers.append(server)
+        return server
+
+    def sender(self, **kwargs):
+        return SMTPSender('smtp.example.com', 587, 'alice', 'secret', **kwargs)
+
+    def test_messages_share_one_connection(self):
+        with self.sender() as sender:
+            for i in range(3):
+                sender.enqueue(make_message(subject=f'Hello {i}'))
+            results = sender.flush()
+
+        self.assertEqual([r['status'] for r in results], ['sent'] * 3)
+        self.assertEqual(len(self.servers), 1)
+        server = self.servers[0]
+        server.starttls.assert_called_once_with()
+        server.login.assert_called_once_with('alice', 'secret')
+        self.assertEqual(server.send_message.call_count, 3)
+        server.quit.assert_called_once_with()
+
+    def test_reconnects_after_the_server_drops_the_connection(self):
+        with self.sender() as sender:
+            self.assertEqual(sender.send(make_message())['status'], 'sent')
+            self.servers[0].send_message.side_effect = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            result = sender.send(make_message(subject='Again'))
+
+        self.assertEqual(result['status'], 'sent')
+        self.assertIsNone(result['error'])
+        self.assertEqual(sender.connections, 2)
+        self.servers[0].close.assert_called_once_with()
+        self.servers[1].send_message.assert_called_once()
+
+    def test_421_opens_a_new_session(self):
+        with self.sender() as sender:
+            sender.send(make_message())
+            self.servers[0].send_message.side_effect = smtplib.SMTPResponseException(421, b'Service closing')
+            result = sender.send(make_message())
+
+        self.assertEqual(result['status'], 'sent')
+        self.assertEqual(len(self.servers), 2)
+
+    def test_gives_up_after_max_retries(self):
+        self.smtp.side_effect = OSError("Connection refused")
+        result = self.sender(max_retries=2).send(make_message())
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['error'], 'Connection refused')
+        self.assertEqual(self.smtp.call_count, 3)
+
+    def test_auth_failure_is_reported_without_retrying(self):
+        def reject_login(*args, **kwargs):
+            server = self.new_server()
+            server.login.side_effect = smtplib.SMTPAuthenticationError(535, b'5.7.8 Bad credentials')
+            return server
+
+        self.smtp.side_effect = reject_login
+        result = self.sender().send(make_message())
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['error'], '535 5.7.8 Bad credentials')
+        self.assertEqual(len(self.servers), 1)
+        self.servers[0].close.assert_called_once_with()
+
+    def test_refused_recipients_are_not_retried(self):
+        with self.sender() as sender:
+            sender.send(make_message())
+            self.servers[0].send_message.side_effect = smtplib.SMTPRecipientsRefused(
+                {'bob@example.com': (550, b'No such user')},
+            )
+            result = sender.send(make_message())
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['refused'], {'bob@example.com': '550 No such user'})
+        self.servers[0].rset.assert_called_once_with()
+        self.assertEqual(len(self.servers), 1)
+
+    def test_new_session_after_max_per_connection(self):
+        with self.sender(max_per_connection=2) as sender:
+            for _ in range(5):
+                sender.enqueue(make_message())
+            sender.flush()
+
+        self.assertEqual(len(self.servers), 3)
+        self.servers[0].quit.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Run from single_folder with: python -m unittest
+"""
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from fake_imap import FakeIMAP
+from subject_index import SubjectIndex
+
+
+class SubjectIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.imap = FakeIMAP()
+        self.index = SubjectIndex(':memory:', account='alice')
+        self.addCleanup(self.index.close)
+
+    def test_threads_are_looked_up_locally(self):
+        first = self.imap.add('Plan')
+        self.imap.add('Other')
+        reply = self.imap.add('Re: Plan')
+
+        self.assertEqual(self.index.update(self.imap), 3)
+        self.assertEqual(self.index.uids_for_subject('Plan'), [first, reply])
+
+    def test_update_only_fetches_new_uids(self):
+        self.imap.add('Plan')
+        self.index.update(self.imap)
+        self.imap.commands.clear()
+
+        self.assertEqual(self.index.update(self.imap), 0)
+        self.assertEqual([c for c in self.imap.commands if c[0] == 'FETCH'], [])
+
+        new = self.imap.add('Fwd: Plan')
+        self.assertEqual(self.index.update(self.imap), 1)
+        self.assertEqual([c[1] for c in self.imap.commands if c[0] == 'FETCH'], [(new,)])
+        self.assertEqual(len(self.index.uids_for_subject('Plan')), 2)
+
+    def test_uidvalidity_change_rebuilds_the_folder(self):
+        self.imap.add('Plan')
+        self.index.update(self.imap)
+        self.imap.uidvalidity = 2
+        self.imap.messages.clear()
+        uid = self.imap.add('Fresh')
+
+        self.index.update(self.imap)
+        self.assertEqual(self.index.uids_for_subject('Plan'), [])
+        self.assertEqual(self.index.uids_for_subject('Fresh'), [uid])
+
+    def test_forget_drops_expunged_uids(self):
+        uid = self.imap.add('Plan')
+        self.index.update(self.imap)
+        self.index.forget([uid])
+        self.assertEqual(self.index.uids_for_subject('Plan'), [])
+
+    def test_old_schema_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'index.sqlite3'
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE messages (uid INTEGER)")
+            conn.commit()
+            conn.close()
+
+            index = SubjectIndex(path)
+            uid = self.imap.add('Plan')
+            index.update(self.imap)
+            self.assertEqual(index.uids_for_subject('Plan'), [uid])
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()